@@ -4,6 +4,8 @@ import flask
 from audiapi.API import API
 from audiapi.Services import LogonService, CarService
 
+from ...utils.assets import ASSETS
+
 
 class AudiCache:
 
@@ -23,7 +25,7 @@ class AudiCache:
     def get_thumbnail(self):
         vehicle = self.find_vehicle()
         if vehicle is not None:
-            return flask.send_file("api/audi_cache/etron.png", mimetype='image/png')
+            return ASSETS.send_file("api/audi_cache/etron.png", 'image/png', max_age=86400)
         else:
             return flask.abort(501, description=f"Unknown Vehicle Alias")
 
@@ -1,76 +1,146 @@
 import calendar
+import csv
 import datetime
+import io
 import json
 import logging
 import threading
-import time
-from typing import List, Generator
+import zipfile
+from collections import defaultdict
+from typing import Dict, List, Generator, Iterator, Optional, Tuple
 
 import flask
 import jinja2
 
+from .session_index import SessionIndex
+from ..service_registry import ServiceRegistry
 from ...utils import get_cache_dir
+from ...utils.metrics import METRICS
+from ...utils.state_store import StateStore
 
 
 class Billing:
-    def __init__(self, config: dict, vehicles: dict, app: flask.Flask, logger: logging.Logger):
+    def __init__(self, config: dict, vehicles: dict, services: ServiceRegistry, logger: logging.Logger):
+        self.config = config
+        self.services: ServiceRegistry = services
         self.logger = logger
         self.vehicles = vehicles
 
+        self.sync_interval: float = self.config.get("sync_interval", 10)  # seconds
+        self.last_report: Optional[dict] = None  # the last seen report 100
+
         self.sessions_cache = get_cache_dir() / "sessions"
         self.sessions_cache.mkdir(exist_ok=True, parents=True)
+        self.index = SessionIndex(get_cache_dir() / "sessions.sqlite3", self.logger.getChild("index"))
+
+        # the document of the store is the one the watermark was written to before
+        self.state = StateStore(get_cache_dir() / "billing_sync.json", self.logger.getChild("state"))
+        self.watermark: Optional[int] = None
+
+        self.stopped = threading.Event()
+        self.daemon: Optional[threading.Thread] = None
 
-        self.daemon = threading.Thread(target=self.background_update, args=(app,), name="charge_manager_daemon",
-                                       daemon=True)
+    def start(self):
+        """
+        import the session files which are not indexed yet and start syncing the sessions of the wallbox.
+        """
+        self.index.import_files(self.sessions_cache)
+        self.watermark = self.restore_watermark()
+
+        self.stopped.clear()
+        self.daemon = threading.Thread(target=self.background_update, args=(), name="billing_daemon", daemon=True)
         self.daemon.start()
+        METRICS.watch_thread(self.daemon)
+
+    def stop(self, timeout: float = None):
+        self.stopped.set()
+        if self.daemon is not None:
+            self.daemon.join(timeout)
+
+    def restore_watermark(self) -> int:
+        watermark = self.state.get("session_id")
+        if watermark is None:
+            self.logger.warning("Could not restore sync watermark, starting from the latest indexed session")
+            return self.index.max_session_id()
+        return watermark
+
+    def persist_watermark(self):
+        # written right away, the sessions up to the watermark are already stored
+        self.state.put("session_id", self.watermark)
+        if not self.state.flush():
+            raise OSError(f"Could not persist the sync watermark {self.watermark}")
+
+    def background_update(self):
+        while not self.stopped.is_set():
+            try:
+                self.update_charging_session_cache()
+            except Exception:
+                self.logger.exception("exception occurred!")
+            self.stopped.wait(self.sync_interval)
+
+    def update_charging_session_cache(self):
+        """
+        poll report 100 and only fetch the session history if the latest session changed since the last poll.
+        """
+        keba = self.services["keba"]
+        report = keba.get_report(100)
+        last_report = self.last_report
+        if last_report is not None and (last_report["Session ID"], last_report["ended[s]"]) == \
+                (report["Session ID"], report["ended[s]"]):
+            return
+
+        if report["Session ID"] > self.watermark + 1:
+            self.sync_session_history()
+        if report["Session ID"] > self.watermark and report["ended[s]"] != 0:
+            # report 100 holds the latest session until the next one starts, so finished sessions show up right away
+            self.store_session(report)
+            self.watermark = report["Session ID"]
+        self.persist_watermark()
+        # only remembered once the sessions are stored, so a failed sync is retried with the next poll
+        self.last_report = report
 
-    def background_update(self, app):
-        client = app.test_client()
-        try:
-            while True:
-                self.update_charging_session_cache(client)
-                time.sleep(60 * 20)
-        except:
-            self.logger.exception("exception occurred!")
-            self.background_update(app)
-
-    def update_charging_session_cache(self, client):
+    def sync_session_history(self):
+        """
+        fetch all sessions newer than the watermark from the history reports 101-130 and store the missing ones.
+        """
+        keba = self.services["keba"]
+        synced = []
         for idx in range(101, 131):
-            raw_report = client.get(f"/keba/report?id={idx}").data
-            report = json.loads(raw_report)
-            if report["Session ID"] == -1:
+            report = keba.get_report(idx)
+            if report["Session ID"] == -1 or report["Session ID"] <= self.watermark:
                 break
-            fpath = self.sessions_cache / f"session_{report['Session ID']}.json"
-            if fpath.exists():
-                break
-            with open(fpath, "wb") as fp:
-                fp.write(raw_report)
+            if report["Session ID"] not in self.index:
+                self.store_session(report)
+            synced.append(report["Session ID"])
+
+        if synced:
+            self.logger.info(f"Synced sessions {synced}")
+            self.watermark = max(synced)
+
+    def store_session(self, report: dict):
+        with open(self.sessions_cache / f"session_{report['Session ID']}.json", "w") as fp:
+            json.dump(report, fp)
+        self.index.add(report)
 
     def attach_endpoints(self, app: flask.Flask):
         app.add_url_rule("/billing/downloads", "billing_download", self.create_bill, methods=["GET"])
+        app.add_url_rule("/billing/downloads/bulk", "billing_download_bulk", self.create_bulk_bills, methods=["GET"])
+        app.add_url_rule("/billing/export", "billing_export", self.export_sessions, methods=["GET"])
 
     def filter_sessions(self, year: int = None, month: int = None, rfid_tag: str = None):
-        max_idx = 0
-        for session in self.sessions_cache.iterdir():
-            idx = int(session.stem.split("_")[1])
-            if max_idx < idx:
-                max_idx = idx
-        for idx in range(max_idx, 0, -1):
-            fpath = self.sessions_cache / f"session_{idx}.json"
-            with open(fpath, "r") as fp:
-                session_info = json.load(fp)
+        return self.index.filter(year, month, rfid_tag)
 
+    def group_sessions(self, year: int = None, month: int = None,
+                       rfid_tag: str = None) -> Dict[Tuple[str, int, int], List[dict]]:
+        """
+        group the matching sessions by RFID tag and start month in a single pass over the session index.
+        :return: a dict mapping (rfid tag, year, month) to the sessions of that tag in that month, from new to old
+        """
+        groups = defaultdict(list)
+        for session_info in self.filter_sessions(year, month, rfid_tag):
             session_started = datetime.datetime.fromtimestamp(int(session_info["started[s]"]))
-
-            if (year is None or session_started.year == year) and (
-                    month is None or session_started.month == month) and (
-                    rfid_tag is None or session_info["RFID tag"] == rfid_tag) and (session_info["E pres"] != 0):
-                yield session_info
-
-            if (session_started - datetime.datetime(year=year, month=month, day=1)).total_seconds() < 0:
-                # since the sessions are sorted new to old we can exit the loop once we have
-                # found a session which started before the month, year that we are looking for
-                break
+            groups[(session_info["RFID tag"], session_started.year, session_started.month)].append(session_info)
+        return groups
 
     def create_billing_information(self, raw_sessions: Generator[dict, None, None], euros_per_kWh: float):
         total_Wh = 0
@@ -94,12 +164,27 @@ class Billing:
                 "energy": round(energy / 1000, 2),
                 "cost": round(cost, 2)
             }
+            session.update(self.get_energy_sources(s['Session ID'], energy))
             sessions.append(session)
 
         total_Wh = round(total_Wh, 3)
         total_cost = round(total_cost, 2)
         return sessions, total_Wh, total_cost
 
+    def get_energy_sources(self, session_id: int, energy: float) -> Dict[str, Optional[float]]:
+        """
+        split the energy of a session into solar, battery and grid energy in kWh as attributed by the energy
+        integrator of the manager. The shares are scaled to the energy counted by the wallbox.
+        :param energy: the energy of the session in Wh
+        """
+        attribution = None
+        if "manager" in self.services:
+            attribution = self.services["manager"].energy.get_session(session_id)
+        if attribution is None or attribution["energy"] <= 0:
+            return {"solar_energy": None, "battery_energy": None, "grid_energy": None}
+        return {f"{source}_energy": round(energy / 1000 * attribution[source] / attribution["energy"], 2)
+                for source in ("solar", "battery", "grid")}
+
     def render_bill(self, year, month, sessions, netto_euros_per_kWh: float,
                     brutto_euros_per_kWh: float, total_cost: float, total_Wh: float, rfid_tag: str):
 
@@ -112,15 +197,111 @@ class Billing:
                                      total_kWh=round(total_Wh / 1000, 2), start_day=start_day, end_day=end_day,
                                      rfid_tag=rfid_tag)
 
+    @staticmethod
+    def get_prices() -> Tuple[float, float]:
+        netto_euros_per_kWh = float(flask.request.args.get('euros_per_kWh', float))
+        brutto_euros_per_kWh = 1.16 * netto_euros_per_kWh
+        return netto_euros_per_kWh, brutto_euros_per_kWh
+
+    def get_bill_name(self, rfid_tag: str, year: int, month: int) -> str:
+        vehicle = {vehicle["rfid_token"]: vehicle for vehicle in self.vehicles}.get(rfid_tag)
+        owner = rfid_tag if vehicle is None else vehicle["alias"]
+        return f"bill_{year}_{month:02d}_{owner}"
+
     def create_bill(self):
         year = int(flask.request.args.get('year', int))
         month = int(flask.request.args.get('month', int))
         rfid_tag = flask.request.args.get('rfid', str)
-        netto_euros_per_kWh = float(flask.request.args.get('euros_per_kWh', float))
-        brutto_euros_per_kWh = 1.16 * netto_euros_per_kWh
+        netto_euros_per_kWh, brutto_euros_per_kWh = self.get_prices()
 
         self.logger.info(f"Creating bill for year {year} month {month} rfid tag {rfid_tag} for cost {netto_euros_per_kWh}")
         raw_sessions = self.filter_sessions(year, month, rfid_tag)
 
         sessions, total_Wh, total_cost = self.create_billing_information(raw_sessions, brutto_euros_per_kWh)
         return self.render_bill(year, month, sessions, netto_euros_per_kWh, brutto_euros_per_kWh, total_cost, total_Wh, rfid_tag)
+
+    def create_bulk_bills(self):
+        """
+        render the bills of every RFID tag and month matching the (optional) year, month and rfid filters and stream
+        them as a single ZIP archive.
+        """
+        year = flask.request.args.get('year', type=int)
+        month = flask.request.args.get('month', type=int)
+        rfid_tag = flask.request.args.get('rfid')
+        netto_euros_per_kWh, brutto_euros_per_kWh = self.get_prices()
+
+        self.logger.info(f"Creating bulk bills for year {year} month {month} rfid tag {rfid_tag} "
+                         f"for cost {netto_euros_per_kWh}")
+        groups = self.group_sessions(year, month, rfid_tag)
+
+        def render_bills() -> Iterator[Tuple[str, str]]:
+            for (tag, bill_year, bill_month), raw_sessions in sorted(groups.items()):
+                sessions, total_Wh, total_cost = self.create_billing_information(raw_sessions, brutto_euros_per_kWh)
+                yield f"{self.get_bill_name(tag, bill_year, bill_month)}.html", \
+                    self.render_bill(bill_year, bill_month, sessions, netto_euros_per_kWh, brutto_euros_per_kWh,
+                                     total_cost, total_Wh, tag)
+
+        archive_name = "bills" + "".join(f"_{value}" for value in (year, month, rfid_tag) if value is not None)
+        return flask.Response(flask.stream_with_context(stream_zip(render_bills())), mimetype="application/zip",
+                              headers={"Content-Disposition": f"attachment; filename={archive_name}.zip"})
+
+    def export_sessions(self):
+        """
+        export the per session rows of the bills matching the (optional) year, month and rfid filters as csv or json.
+        """
+        year = flask.request.args.get('year', type=int)
+        month = flask.request.args.get('month', type=int)
+        rfid_tag = flask.request.args.get('rfid')
+        export_format = flask.request.args.get('format', "csv")
+        netto_euros_per_kWh, brutto_euros_per_kWh = self.get_prices()
+        if export_format not in ("csv", "json"):
+            flask.abort(400, f"Unknown export format {export_format}, use csv or json")
+
+        rows = []
+        for (tag, bill_year, bill_month), raw_sessions in sorted(self.group_sessions(year, month, rfid_tag).items()):
+            sessions, _, _ = self.create_billing_information(raw_sessions, brutto_euros_per_kWh)
+            rows.extend({"rfid_tag": tag, "year": bill_year, "month": bill_month, **session} for session in sessions)
+
+        if export_format == "json":
+            return flask.jsonify(sessions=rows)
+
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=["rfid_tag", "year", "month", "uid", "started", "ended", "energy",
+                                                    "solar_energy", "battery_energy", "grid_energy", "cost"])
+        writer.writeheader()
+        writer.writerows(rows)
+        return flask.Response(output.getvalue(), mimetype="text/csv",
+                              headers={"Content-Disposition": "attachment; filename=sessions.csv"})
+
+
+class ChunkBuffer(io.RawIOBase):
+    """
+    A write only, non seekable stream which collects the written bytes until they are drained.
+    """
+    def __init__(self):
+        super().__init__()
+        self.chunks: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(files: Iterator[Tuple[str, str]]) -> Iterator[bytes]:
+    """
+    create a ZIP archive from (name, content) pairs and yield it chunk by chunk while the contents are produced.
+    """
+    buffer = ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+            yield buffer.drain()
+    yield buffer.drain()
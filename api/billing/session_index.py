@@ -0,0 +1,83 @@
+import datetime
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+from typing import Generator
+
+
+class SessionIndex:
+    """
+    A SQLite index of the charging session reports, keyed by session id with secondary indices on the start month
+    and the RFID tag.
+    """
+    def __init__(self, path: pathlib.Path, logger: logging.Logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                                    "session_id INTEGER PRIMARY KEY, "
+                                    "rfid_tag TEXT NOT NULL, "
+                                    "start_year INTEGER NOT NULL, "
+                                    "start_month INTEGER NOT NULL, "
+                                    "energy INTEGER NOT NULL, "
+                                    "report TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_start_month "
+                                    "ON sessions (start_year, start_month)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_rfid_tag "
+                                    "ON sessions (rfid_tag, start_year, start_month)")
+
+    def __contains__(self, session_id: int) -> bool:
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row is not None
+
+    def max_session_id(self) -> int:
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(session_id) FROM sessions").fetchone()
+        return 0 if row[0] is None else row[0]
+
+    def add(self, report: dict):
+        session_started = datetime.datetime.fromtimestamp(int(report["started[s]"]))
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                                    (int(report["Session ID"]), report["RFID tag"], session_started.year,
+                                     session_started.month, int(report["E pres"]), json.dumps(report)))
+
+    def import_files(self, sessions_dir: pathlib.Path):
+        """
+        add all session_N.json files in sessions_dir which are not yet part of the index.
+        """
+        with self.lock:
+            known = {row[0] for row in self.connection.execute("SELECT session_id FROM sessions")}
+
+        imported = 0
+        for fpath in sessions_dir.glob("session_*.json"):
+            if int(fpath.stem.split("_")[1]) in known:
+                continue
+            try:
+                with open(fpath, "r") as fp:
+                    self.add(json.load(fp))
+                imported += 1
+            except (json.JSONDecodeError, KeyError, ValueError):
+                self.logger.exception(f"Could not import session file {fpath}")
+        self.logger.info(f"Imported {imported} session files into the session index")
+
+    def filter(self, year: int = None, month: int = None, rfid_tag: str = None) -> Generator[dict, None, None]:
+        """
+        yield all sessions with non zero energy matching the given filters, ordered from new to old.
+        """
+        conditions = ["energy != 0"]
+        params = []
+        for column, value in (("start_year", year), ("start_month", month), ("rfid_tag", rfid_tag)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+
+        with self.lock:
+            rows = self.connection.execute(f"SELECT report FROM sessions WHERE {' AND '.join(conditions)} "
+                                           f"ORDER BY session_id DESC", params).fetchall()
+        for row in rows:
+            yield json.loads(row[0])
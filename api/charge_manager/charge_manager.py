@@ -3,33 +3,73 @@ import datetime
 import json
 import logging
 import threading
-import time
+from typing import Optional
+
 import urllib3
 
 import flask
-import requests
 
-from .utils import MovingAverageFilter
+from ..meter_sampler import MeterSampler
+from ..service_registry import ServiceRegistry
+from ...utils import Clock, get_cache_dir
+from ...utils.metrics import METRICS
+from ...utils.state_store import StateStore
+from .utils import FilterBank
 from .charge_target import ChargeTarget
+from .forecast import ProfileForecast
+from .scheduler import ChargeScheduler
 
 
 class ChargeManager:
-    def __init__(self, config, vehicles, logger: logging.Logger):
+    def __init__(self, config, vehicles, sampler: MeterSampler, services: ServiceRegistry, logger: logging.Logger,
+                 clock: Clock = None):
         self.vehicles = vehicles
         self.config = config
+        self.sampler: MeterSampler = sampler
+        self.services: ServiceRegistry = services
+        self.clock: Clock = clock or Clock()
         assert self.config["wallbox_update_interval"] >= self.config["power_read_interval"]
 
         self.logger: logging.Logger = logger
-        self.target = ChargeTarget(self.logger.getChild("target"))
+        self.state = StateStore(get_cache_dir() / "charge_manager_state.json", self.logger.getChild("state"),
+                                self.config.get("state_flush_delay", 2.))
+        self.target = ChargeTarget(self.logger.getChild("target"), self.clock, self.state)
 
         self.meter_information = None
 
         self.wallbox_target_power = 0.  # Watts
         self.wallbox_actual_power = 0.  # Watts
-        self.avg_filter = MovingAverageFilter()
-
-        self.daemon = threading.Thread(target=self.background_update, args=(), name="charge_manager_daemon")
-        self.daemon.start()
+        self.meter_filter = FilterBank(self.config.get("power_smoothing_filter", "mean"),
+                                       self.config["power_smoothing_window"])
+
+        # "forecast" plans the charging power until the target time, "reactive" only follows the current excess
+        self.forecast = ProfileForecast(("solar", "house"))
+        self.scheduler = None
+        if self.config.get("scheduler", "forecast") == "forecast":
+            self.scheduler = ChargeScheduler(self.forecast, self.logger.getChild("scheduler"),
+                                             self.config["minimum_power"], self.config["max_charging_power"] * 1000)
+
+        self.stopped = threading.Event()
+        self.daemon: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        fit the forecast to the meter history and start the control loop. The manager has to be started before.
+        """
+        if self.scheduler is not None:
+            self.fit_forecast()
+        if self.config.get("control_loop", "threaded") != "external":
+            self.stopped.clear()
+            self.daemon = threading.Thread(target=self.background_update, args=(), name="charge_manager_daemon",
+                                           daemon=True)
+            self.daemon.start()
+            METRICS.watch_thread(self.daemon)
+
+    def stop(self, timeout: float = None):
+        self.stopped.set()
+        if self.daemon is not None:
+            self.daemon.join(timeout)
+        self.state.flush()
 
     def attach_endpoints(self, app: flask.Flask):
         self.logger.info("Attached endpoints.")
@@ -42,21 +82,33 @@ class ChargeManager:
         app.add_url_rule("/charge_manager/meters/consumption", "charge_manager_get_consumption",
                          self.get_consumption, methods=["GET"])
 
+        app.add_url_rule("/charge_manager/plan", "charge_manager_get_plan", self.get_plan, methods=["GET"])
+
+    def get_plan(self):
+        if self.scheduler is None:
+            return flask.abort(404, description="Charge planning is disabled")
+        if self.scheduler.plan is None:
+            return flask.abort(503, description="No charge plan was computed yet")
+        return flask.jsonify(self.scheduler.plan.to_dict())
+
+    def fit_forecast(self):
+        # learn the profiles from the stored history, the forecast keeps learning from the live readings
+        if "manager" not in self.services or self.services["manager"].history is None:
+            self.logger.warning("No meter history available, the forecast starts without a profile")
+            return
+        start = self.clock.time() - self.config.get("forecast_days", 14) * 86400
+        resolution, entries = self.services["manager"].history.query(start, None, self.forecast.slot)
+        self.forecast.fit(entries)
+        self.logger.info(f"Fitted the forecast to {len(entries)} history entries with resolution {resolution}")
+
     def get_consumption(self):
         # ("powerwall", "grid", "solar", "house", "wallbox"):
         meter_name = flask.request.args.get('meter')
         if self.meter_information is not None:
             if meter_name == "powerwall":
-                return flask.jsonify(load=float(self.meter_information["battery"]["instant_power"]))
-            elif meter_name == "grid":
-                return flask.jsonify(load=float(self.meter_information["site"]["instant_power"]))
-            elif meter_name == "solar":
-                return flask.jsonify(load=float(self.meter_information["solar"]["instant_power"]))
-            elif meter_name == "house":
-                load = float(self.meter_information["load"]["instant_power"]) - self.wallbox_actual_power
-                return flask.jsonify(load=load)
-            elif meter_name == "wallbox":
-                return flask.jsonify(load=self.wallbox_actual_power)
+                meter_name = "battery"
+            if meter_name in self.meter_information:
+                return flask.jsonify(load=self.meter_information[meter_name])
             else:
                 return flask.abort(400, description=f"Unknown meter {meter_name}")
 
@@ -64,47 +116,65 @@ class ChargeManager:
             return flask.jsonify(load=0.0)
 
     def background_update(self):
-        while True:
-            self.target.update_target_time()
-            last_update = time.time()
-            while time.time() - last_update < self.config["wallbox_update_interval"]:
-                load_power, solar_power = self.get_power_readings()
-                time.sleep(self.config["power_read_interval"])
-
-            self.update_wallbox_target_power()
-            self.send_wallbox_target()
+        while not self.stopped.is_set():
+            try:
+                self.target.update_target_time()
+                last_update = self.clock.time()
+                while self.clock.time() - last_update < self.config["wallbox_update_interval"] and \
+                        not self.stopped.is_set():
+                    load_power, solar_power = self.get_power_readings()
+                    self.clock.sleep(self.config["power_read_interval"])
+
+                self.update_wallbox_target_power()
+                self.send_wallbox_target()
+            except Exception:
+                # e.g. a stale meter snapshot or no vehicle state yet, the next tick tries again
+                self.logger.exception("exception occurred!")
+                self.clock.sleep(self.config["power_read_interval"])
 
     def ensure_target_completion(self):
-        self.logger.info("Querying current vehicle soc from Flow API")
-        resp = requests.get(f'http://127.0.0.1:80/bmw/state?vehicle={self.config["vehicle_alias"]}', verify=False)
-        if resp.ok:
-            percent_soc = json.loads(resp.text)["chargingLevelHv"]
-
-            if float(percent_soc) < float(self.target.target_soc):
-                # we have not yet reached the charging goal
-                current_soc = self.config["vehicle_capacity"] * percent_soc / 100
-                critical_time = self.target.get_critical_time(current_soc, self.config["vehicle_capacity"],
-                                                              self.config["max_charging_power"],
-                                                              self.config["safety_offset"])
-                self.logger.info(f"computed critical time {critical_time}")
-
-                if critical_time < datetime.datetime.now():
-                    self.logger.info(f"Overwriting max charging power to maximum {self.config['max_charging_power']} "
-                                     f"to ensure target completion")
-                    self.wallbox_target_power = self.config["max_charging_power"]
-                else:
-                    self.logger.info(f"Critical time {critical_time} was not yet reached for target time "
-                                     f"{self.target.target_time}")
+        self.logger.info("Querying current vehicle soc from the connected drive cache")
+        vehicle_state = self.services["connected_drive_cache"].get_vehicle_state(self.config["vehicle_alias"])
+        percent_soc = vehicle_state["chargingLevelHv"]
+        if float(percent_soc) < float(self.target.target_soc):
+            # we have not yet reached the charging goal
+            current_soc = self.config["vehicle_capacity"] * percent_soc / 100
+            critical_time = self.target.get_critical_time(current_soc, self.config["vehicle_capacity"],
+                                                          self.config["max_charging_power"],
+                                                          self.config["safety_offset"])
+            self.logger.info(f"computed critical time {critical_time}")
+
+            if critical_time < self.clock.now():
+                self.logger.info(f"Overwriting max charging power to maximum {self.config['max_charging_power']} "
+                                 f"to ensure target completion")
+                self.wallbox_target_power = self.config["max_charging_power"]
             else:
-                self.wallbox_target_power = 0
-                self.logger.info(f"Set charging power to 0 because goal of {self.target.target_soc} % was reached."
-                                 f"Current vehicle soc {percent_soc} %")
-
+                self.logger.info(f"Critical time {critical_time} was not yet reached for target time "
+                                 f"{self.target.target_time}")
         else:
-            raise requests.RequestException(resp)
+            self.wallbox_target_power = 0
+            self.logger.info(f"Set charging power to 0 because goal of {self.target.target_soc} % was reached."
+                             f"Current vehicle soc {percent_soc} %")
+
+    def follow_plan(self, excess: float):
+        vehicle_state = self.services["connected_drive_cache"].get_vehicle_state(self.config["vehicle_alias"])
+        percent_soc = float(vehicle_state["chargingLevelHv"])
+        energy = max(0., float(self.target.target_soc) - percent_soc) / 100 * self.config["vehicle_capacity"] * 1000
+        deadline = self.target.target_time - datetime.timedelta(minutes=self.config["safety_offset"])
+
+        now = self.clock.time()
+        self.scheduler.update(now, deadline.timestamp(), energy)
+        self.wallbox_target_power = self.scheduler.current_power(now, excess)
+        self.logger.info(f"New planned wallbox target {self.wallbox_target_power} with excess {excess}, "
+                         f"{energy:.0f} Wh missing to reach {self.target.target_soc} %")
 
     def update_wallbox_target_power(self):
-        excess = self.avg_filter["solar_power"] - self.avg_filter["load_power"]
+        smoothed = self.meter_filter.values()
+        if self.scheduler is not None:
+            self.follow_plan(smoothed["solar"] - smoothed["house"])
+            return
+
+        excess = smoothed["solar"] - smoothed["load"]
 
         if self.wallbox_target_power > 0 or excess > self.config["required_minimum_excess"]:
             # adjust the target power according to the excess, if we are already charging (target power > 0).
@@ -126,15 +196,15 @@ class ChargeManager:
         pass
 
     def get_power_readings(self):
-        logging.captureWarnings(True)
-        resp = requests.get(f'{self.config["powerwall_host"]}/api/meters/aggregates', verify=False)
-        logging.captureWarnings(False)
-        meters = json.loads(resp.text)
+        snapshot = self.sampler.get_snapshot(timeout=self.config["power_read_interval"])
+        meters = snapshot.meters
 
         self.meter_information = meters
+        self.wallbox_actual_power = meters["wallbox"]
+        self.forecast.add(snapshot.timestamp, meters)
 
-        load_power = self.avg_filter("load_power", float(meters["load"]["instant_power"]), self.config["power_smoothing_window"])
-        solar_power = self.avg_filter("solar_power", float(meters["solar"]["instant_power"]), self.config["power_smoothing_window"])
+        smoothed = self.meter_filter.update({**meters, "load": meters["house"] + meters["wallbox"]})
+        load_power, solar_power = smoothed["load"], smoothed["solar"]
         self.logger.debug(f"Got Power Reading: Load {load_power} Solar {solar_power}")
         return load_power, solar_power
 
@@ -3,18 +3,37 @@ import datetime
 
 import flask
 
+from ...utils import Clock
+from ...utils.state_store import StateStore
+
 
 class ChargeTarget:
-    def __init__(self, logger):
+    def __init__(self, logger, clock: Clock = None, state: StateStore = None):
         self.logger = logger
+        self.clock: Clock = clock or Clock()
+        self.state: StateStore = state
         self.default_target_soc = 60  # in percentage points
         self.default_target_time: int = 6
 
         self.target_time = None
         self.target_soc = copy.copy(self.default_target_soc)
         self.mode = "auto"
+        self.restore()
         self.update_target_time()
 
+    def restore(self):
+        # a manual target survives a restart, update_target_time drops it if it passed in the meantime
+        target = self.state.get("target") if self.state is not None else None
+        if target is not None and target["mode"] == "manual":
+            self.mode = "manual"
+            self.target_time = datetime.datetime.fromtimestamp(target["time"])
+            self.target_soc = target["soc"]
+            self.logger.info(f"Restored manual target of {self.target_soc}% at {self.target_time}")
+
+    def persist(self):
+        if self.state is not None:
+            self.state.put("target", {"mode": self.mode, "time": self.target_time.timestamp(), "soc": self.target_soc})
+
     def get_mode(self):
         return flask.jsonify(mode=self.mode)
 
@@ -43,15 +62,16 @@ class ChargeTarget:
     def update_target_time(self):
         if self.mode == "auto":
             self.target_soc = self.default_target_soc
-            target_date = datetime.date.today()
-            if datetime.datetime.now().hour > self.default_target_time:
+            target_date = self.clock.now().date()
+            if self.clock.now().hour > self.default_target_time:
                 target_date = target_date + datetime.timedelta(days=1)
 
             self.target_time = datetime.datetime.combine(target_date, datetime.time(hour=self.default_target_time))
+            self.persist()
 
         elif self.mode == "manual":
             # if we have passed a manually set target time we return to automatic mode
-            if self.target_time < datetime.datetime.now():
+            if self.target_time < self.clock.now():
                 self.mode = "auto"
                 self.update_target_time()
 
@@ -68,9 +88,10 @@ class ChargeTarget:
                 return 'You must specify time and 0 < soc <= 100 when setting manual mode', 400
             else:
                 self.logger.info(f"Setting new target time with offset {int(target_time)}")
-                self.target_time = datetime.datetime.now() + datetime.timedelta(hours=int(target_time))
+                self.target_time = self.clock.now() + datetime.timedelta(hours=int(target_time))
                 self.target_soc = int(target_soc)
                 self.mode = mode
+                self.persist()
                 return "switched to manual mode", 200
         elif mode == "auto":
             self.mode = mode
@@ -0,0 +1,91 @@
+import datetime
+import threading
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence
+
+
+class ProfileForecast:
+    """
+    Forecasts the power of some meters from their time of day profile. Every slot of the day holds an exponentially
+    smoothed mean over the previous days. A smoothed level, the ratio of the recent readings to the profile, corrects
+    the next slots for today's weather and decays towards the plain profile over the horizon.
+    """
+    def __init__(self, meters: Sequence[str] = ("solar", "house"), slot: int = 900, alpha: float = 0.3,
+                 level_alpha: float = 0.5, level_decay: float = 0.8):
+        self.meters: Sequence[str] = meters
+        self.slot: int = slot  # seconds
+        self.alpha: float = alpha  # weight of the latest day in the profile
+        self.level_alpha: float = level_alpha  # weight of the latest slot in the level
+        self.level_decay: float = level_decay  # per slot decay of the level correction
+
+        self.lock = threading.Lock()
+        self.profile: Dict[int, Dict[str, float]] = {}  # slot of the day -> meter -> power in Watts
+        self.level: Dict[str, float] = {meter: 1. for meter in self.meters}
+
+        self.bucket_start: Optional[float] = None
+        self.count: int = 0
+        self.sums: Dict[str, float] = {}
+
+    def slot_of_day(self, timestamp: float) -> int:
+        moment = datetime.datetime.fromtimestamp(timestamp)
+        return (moment.hour * 3600 + moment.minute * 60 + moment.second) // self.slot
+
+    def add(self, timestamp: float, meters: Mapping[str, float]):
+        """
+        add a reading. The profile and the level are updated once the slot of the reading has passed.
+        """
+        bucket_start = timestamp - timestamp % self.slot
+        with self.lock:
+            if self.bucket_start is not None and bucket_start < self.bucket_start:
+                return
+            if bucket_start != self.bucket_start:
+                self.close_bucket()
+                self.bucket_start = bucket_start
+                self.count = 0
+                self.sums = {meter: 0. for meter in self.meters}
+            self.count += 1
+            for meter in self.meters:
+                self.sums[meter] += meters[meter]
+
+    def fit(self, entries: Iterable[dict]):
+        """
+        learn the profile from history entries with a timestamp and the mean power of every meter.
+        """
+        for entry in entries:
+            self.add(entry["timestamp"], entry)
+
+    def close_bucket(self):
+        if self.bucket_start is None or self.count == 0:
+            return
+        slot = self.slot_of_day(self.bucket_start)
+        means = {meter: total / self.count for meter, total in self.sums.items()}
+        previous = self.profile.get(slot)
+        if previous is None:
+            self.profile[slot] = means
+            return
+
+        for meter, mean in means.items():
+            expected = previous[meter]
+            if abs(expected) > 100.:
+                # readings close to zero, e.g. solar at dawn, say nothing about the level
+                ratio = min(2., max(0., mean / expected))
+                self.level[meter] += self.level_alpha * (ratio - self.level[meter])
+            previous[meter] = expected + self.alpha * (mean - expected)
+
+    def predict(self, start: float, count: int) -> List[Dict[str, float]]:
+        """
+        forecast the mean power of every meter for count slots.
+        :param start: a timestamp in the first slot
+        :return: one dict per slot with the start of the slot and the forecast power of every meter in Watts
+        """
+        first = start - start % self.slot
+        with self.lock:
+            forecast = []
+            for idx in range(count):
+                slot_start = first + idx * self.slot
+                profile = self.profile.get(self.slot_of_day(slot_start), {})
+                decay = self.level_decay ** idx
+                slot = {meter: profile.get(meter, 0.) * (1 + (self.level[meter] - 1) * decay)
+                        for meter in self.meters}
+                slot["timestamp"] = slot_start
+                forecast.append(slot)
+            return forecast
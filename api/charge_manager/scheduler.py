@@ -0,0 +1,134 @@
+import logging
+import math
+from typing import List, NamedTuple, Optional
+
+from .forecast import ProfileForecast
+
+
+class PlanSlot(NamedTuple):
+    start: float  # timestamp
+    duration: float  # seconds
+    solar: float  # forecast power in Watts
+    house: float  # forecast power in Watts
+    power: float  # planned charging power in Watts
+
+    @property
+    def excess(self) -> float:
+        return max(0., self.solar - self.house)
+
+    @property
+    def grid_power(self) -> float:
+        return max(0., self.power - self.excess)
+
+
+class ChargePlan(NamedTuple):
+    created: float  # timestamp
+    target_time: float  # timestamp
+    energy: float  # Wh required to reach the target
+    slots: List[PlanSlot]
+
+    @property
+    def unplanned_energy(self) -> float:
+        return max(0., self.energy - sum(slot.power * slot.duration / 3600 for slot in self.slots))
+
+    def to_dict(self) -> dict:
+        return {"created": self.created,
+                "target_time": self.target_time,
+                "energy": self.energy,
+                "solar_energy": sum(min(slot.power, slot.excess) * slot.duration / 3600 for slot in self.slots),
+                "grid_energy": sum(slot.grid_power * slot.duration / 3600 for slot in self.slots),
+                "feasible": self.unplanned_energy < 1.,
+                "slots": [dict(slot._asdict(), grid_power=slot.grid_power) for slot in self.slots]}
+
+
+class ChargeScheduler:
+    """
+    Plans the charging power from now until the target time such that as much of the required energy as possible is
+    covered by the forecast solar excess. The slots with the largest excess are filled first, and the energy the
+    excess cannot provide is drawn from the grid in the slots with the most excess left and otherwise as late as
+    possible, so later plans can still replace it with solar energy.
+    The plan is recomputed when a new slot starts, the target changes or the required energy deviates from the plan.
+    """
+    def __init__(self, forecast: ProfileForecast, logger: logging.Logger, min_power: float, max_power: float):
+        self.forecast: ProfileForecast = forecast
+        self.logger: logging.Logger = logger
+        self.min_power: float = min_power  # W
+        self.max_power: float = max_power  # W
+
+        self.plan: Optional[ChargePlan] = None
+
+    def update(self, now: float, target_time: float, energy: float) -> ChargePlan:
+        """
+        return the plan for the current slot, recomputing it if it is outdated.
+        :param now: the current timestamp
+        :param target_time: the timestamp at which the vehicle must have received energy
+        :param energy: the energy in Wh the vehicle still requires
+        """
+        if self.is_outdated(now, target_time, energy):
+            self.plan = self.compute_plan(now, target_time, energy)
+            self.logger.info(f"New charge plan for {energy:.0f} Wh until {target_time}: "
+                             f"{self.plan.to_dict()['grid_energy']:.0f} Wh from the grid")
+        return self.plan
+
+    def is_outdated(self, now: float, target_time: float, energy: float) -> bool:
+        if self.plan is None or self.plan.target_time != target_time:
+            return True
+        slot = self.forecast.slot
+        if now - now % slot != self.plan.created - self.plan.created % slot:
+            return True
+        # within a slot the required energy drops by at most one slot of charging at full power
+        return abs(self.plan.energy - energy) > self.max_power * slot / 3600
+
+    def compute_plan(self, now: float, target_time: float, energy: float) -> ChargePlan:
+        slot = self.forecast.slot
+        count = max(0, math.ceil((target_time - (now - now % slot)) / slot))
+        forecast = self.forecast.predict(now, count)
+
+        starts = [max(now, entry["timestamp"]) for entry in forecast]
+        durations = [max(0., min(entry["timestamp"] + slot, target_time) - start)
+                     for entry, start in zip(forecast, starts)]
+        excess = [max(0., entry["solar"] - entry["house"]) for entry in forecast]
+        powers = [0.] * count
+        remaining = energy
+
+        # cover as much as possible from the solar excess
+        for idx in sorted(range(count), key=lambda i: -excess[i]):
+            if remaining <= 0:
+                break
+            if durations[idx] == 0:
+                continue
+            power = min(excess[idx], self.max_power, remaining * 3600 / durations[idx])
+            if power >= self.min_power:
+                powers[idx] = power
+                remaining -= power * durations[idx] / 3600
+
+        # draw the rest from the grid, topping up the slots with the most excess first and otherwise the latest ones
+        for idx in sorted(range(count), key=lambda i: (-excess[i], -i)):
+            if remaining <= 0:
+                break
+            if durations[idx] == 0:
+                continue
+            power = max(self.min_power, min(self.max_power, powers[idx] + remaining * 3600 / durations[idx]))
+            remaining -= (power - powers[idx]) * durations[idx] / 3600
+            powers[idx] = power
+
+        slots = [PlanSlot(start, duration, entry["solar"], entry["house"], power)
+                 for start, duration, entry, power in zip(starts, durations, forecast, powers) if duration > 0]
+        return ChargePlan(now, target_time, energy, slots)
+
+    def current_power(self, now: float, excess: float) -> float:
+        """
+        compute the charging power for now from the plan and the measured excess. The measured excess replaces the
+        forecast one, while the grid share of the plan is kept.
+        :param excess: the measured solar excess in Watts
+        """
+        if self.plan is None or not self.plan.slots or self.plan.energy <= 0:
+            return 0.
+        slot = self.plan.slots[0]
+        if now >= slot.start + slot.duration:
+            return 0.
+
+        power = min(self.max_power, slot.grid_power + max(0., excess))
+        if power < self.min_power:
+            return self.min_power if slot.grid_power > 0 else 0.
+        return power
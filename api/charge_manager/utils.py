@@ -1,19 +1,178 @@
-from typing import Dict, List, Union
+import array
+import bisect
+import collections
+from typing import Callable, Dict, Mapping, Optional, Union
 
 
-class MovingAverageFilter:
-    def __init__(self):
-        self.keys: Dict[str, List] = {}
+class RingBuffer:
+    """
+    A fixed size buffer backed by a preallocated array of doubles. Pushing a value into a full buffer evicts the
+    oldest value.
+    """
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(f"The size of a ring buffer must be at least 1, got {size}")
+        self.size: int = size
+        self.values = array.array("d", bytes(8 * size))
+        self.head: int = 0  # the index the next value is written to
+        self.count: int = 0
 
-    def __call__(self, key: str, value: Union[int, float], window_size: int = 5):
-        if key not in self.keys:
-            self.keys[key] = [value]
+    def __len__(self):
+        return self.count
+
+    def push(self, value: float) -> Optional[float]:
+        """
+        :return: the evicted value or None if the buffer was not full yet
+        """
+        evicted = self.values[self.head] if self.count == self.size else None
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        return evicted
+
+
+class WindowFilter:
+    def __call__(self, value: float) -> float:
+        raise NotImplementedError
+
+    @property
+    def value(self) -> float:
+        raise NotImplementedError
+
+
+class MovingAverage(WindowFilter):
+    # the running sum is recomputed from the buffer after this many updates to bound the floating point drift
+    resum_interval = 10000
+
+    def __init__(self, window_size: int):
+        self.buffer = RingBuffer(window_size)
+        self.sum: float = 0.
+        self.updates: int = 0
+
+    def __call__(self, value: float) -> float:
+        evicted = self.buffer.push(value)
+        self.sum += value - (evicted or 0.)
+        self.updates += 1
+        if self.updates % self.resum_interval == 0:
+            self.sum = float(sum(self.buffer.values[:len(self.buffer)]))
+        return self.value
+
+    @property
+    def value(self) -> float:
+        return self.sum / len(self.buffer)
+
+
+class ExponentialFilter(WindowFilter):
+    def __init__(self, window_size: int):
+        # the smoothing factor for which the center of mass of the weights matches a moving average of window_size
+        self.alpha: float = 2 / (window_size + 1)
+        self.smoothed: Optional[float] = None
+
+    def __call__(self, value: float) -> float:
+        if self.smoothed is None:
+            self.smoothed = value
         else:
-            self.keys[key].append(value)
-            while len(self.keys[key]) > window_size:
-                self.keys[key].pop(0)
+            self.smoothed += self.alpha * (value - self.smoothed)
+        return self.smoothed
+
+    @property
+    def value(self) -> float:
+        return self.smoothed
+
+
+class MovingMedian(WindowFilter):
+    def __init__(self, window_size: int):
+        self.buffer = RingBuffer(window_size)
+        self.sorted = []
+
+    def __call__(self, value: float) -> float:
+        evicted = self.buffer.push(value)
+        if evicted is not None:
+            del self.sorted[bisect.bisect_left(self.sorted, evicted)]
+        bisect.insort(self.sorted, value)
+        return self.value
+
+    @property
+    def value(self) -> float:
+        mid = len(self.sorted) // 2
+        if len(self.sorted) % 2:
+            return self.sorted[mid]
+        return (self.sorted[mid - 1] + self.sorted[mid]) / 2
 
-        return float(sum(self.keys[key]) / len(self.keys[key]))
 
-    def __getitem__(self, item):
-        return float(sum(self.keys[item]) / len(self.keys[item]))
\ No newline at end of file
+class MovingExtremum(WindowFilter):
+    """
+    Tracks the minimum or maximum of the window with a monotonic queue in amortized O(1) per sample.
+    """
+    def __init__(self, window_size: int, maximum: bool):
+        self.window_size: int = window_size
+        self.maximum: bool = maximum
+        self.queue = collections.deque()  # (sample index, value) with monotonic values
+        self.index: int = 0
+
+    def __call__(self, value: float) -> float:
+        while self.queue and (self.queue[-1][1] <= value if self.maximum else self.queue[-1][1] >= value):
+            self.queue.pop()
+        self.queue.append((self.index, value))
+        if self.queue[0][0] <= self.index - self.window_size:
+            self.queue.popleft()
+        self.index += 1
+        return self.value
+
+    @property
+    def value(self) -> float:
+        return self.queue[0][1]
+
+
+class MovingMinimum(MovingExtremum):
+    def __init__(self, window_size: int):
+        super().__init__(window_size, maximum=False)
+
+
+class MovingMaximum(MovingExtremum):
+    def __init__(self, window_size: int):
+        super().__init__(window_size, maximum=True)
+
+
+WINDOW_FILTERS = {"mean": MovingAverage, "exponential": ExponentialFilter, "median": MovingMedian,
+                  "min": MovingMinimum, "max": MovingMaximum}
+
+
+class FilterBank:
+    """
+    Smooths several signals, e.g. one per meter, with one window filter per signal.
+    """
+    def __init__(self, kind: str = "mean", window_size: int = 5):
+        if kind not in WINDOW_FILTERS:
+            raise ValueError(f"Unknown filter {kind}, choose one of {list(WINDOW_FILTERS.keys())}")
+        self.factory: Callable[[int], WindowFilter] = WINDOW_FILTERS[kind]
+        self.window_size: int = window_size
+        self.filters: Dict[str, WindowFilter] = {}
+
+    def __call__(self, key: str, value: Union[int, float]) -> float:
+        if key not in self.filters:
+            self.filters[key] = self.factory(self.window_size)
+        return float(self.filters[key](value))
+
+    def __getitem__(self, item) -> float:
+        return float(self.filters[item].value)
+
+    def update(self, values: Mapping[str, float]) -> Dict[str, float]:
+        """
+        feed one sample of every signal and return the smoothed values.
+        """
+        return {key: self(key, value) for key, value in values.items()}
+
+    def values(self) -> Dict[str, float]:
+        return {key: float(window_filter.value) for key, window_filter in self.filters.items()}
+
+
+class MovingAverageFilter(FilterBank):
+    def __init__(self):
+        super().__init__("mean")
+
+    def __call__(self, key: str, value: Union[int, float], window_size: int = 5):
+        if key in self.filters and self.filters[key].buffer.size != window_size:
+            del self.filters[key]
+        self.window_size = window_size
+        return super().__call__(key, value)
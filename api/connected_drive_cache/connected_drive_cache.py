@@ -1,7 +1,9 @@
 import json
 import logging
+import os
 import pathlib
 import sys
+import threading
 import time
 from typing import List, Dict, Optional
 
@@ -11,6 +13,20 @@ from bimmer_connected.country_selector import get_region_from_name
 from bimmer_connected.vehicle import VehicleViewDirection, ConnectedDriveVehicle
 
 from ...utils import get_cache_dir
+from ...utils.assets import ASSETS
+from ...utils.metrics import CACHE_REQUESTS, METRICS, track_call
+
+
+class UnknownVehicleError(KeyError):
+    pass
+
+
+class VehicleNotInAccountError(LookupError):
+    pass
+
+
+class VehicleStateUnavailableError(RuntimeError):
+    pass
 
 
 class ConnectedDriveCache:
@@ -24,61 +40,230 @@ class ConnectedDriveCache:
 
         self.max_staleness = self.config["max_staleness"]  # minutes
 
-        credentials = self.config["credentials"]
-        region = get_region_from_name(credentials["region"])
-        self.account = ConnectedDriveAccount(credentials["user"], credentials["pwd"], region)
+        # the login is deferred to the first use of the account, so a slow cloud API does not delay the startup
+        self.login_lock = threading.Lock()
+        self.connection: Optional[ConnectedDriveAccount] = None
         self.vehicle_aliases: Dict[str, str] = {vehicle["vin"]: vehicle["alias"] for vehicle in self.vehicles}
         self.vehicle_update_timestamps: Dict[str, float] = {vehicle["vin"]: 0. for vehicle in self.vehicles}
+        self.vehicle_states: Dict[str, dict] = {}
+        # the refreshes of several vehicles run concurrently, the lock guards the states while they are persisted
+        self.state_lock = threading.Lock()
+        self.restore_states()
+
+        # vehicles are refreshed in the background once refresh_ahead * max_staleness seconds have passed
+        self.refresh_ahead: float = self.config.get("refresh_ahead", 0.8)
+        self.refresh_timeout: float = self.config.get("refresh_timeout", 60.)  # seconds
+        self.refresh_lock = threading.Lock()
+        self.refreshes: Dict[str, threading.Event] = {}  # the in-flight refresh per VIN
+
+        self.stopped = threading.Event()
+        self.daemon: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        start the background refresh, which also logs into the account. Until then requests are served from the
+        restored states.
+        """
+        if self.config.get("background_refresh", True):
+            self.stopped.clear()
+            self.daemon = threading.Thread(target=self.background_update, name="connected_drive_cache_daemon",
+                                           daemon=True)
+            self.daemon.start()
+            METRICS.watch_thread(self.daemon)
+
+    def stop(self, timeout: float = None):
+        self.stopped.set()
+        if self.daemon is not None:
+            self.daemon.join(timeout)
+
+    def is_healthy(self) -> bool:
+        return self.connection is not None
+
+    @property
+    def account(self) -> ConnectedDriveAccount:
+        """
+        the Connected Drive account, which logs in on first use.
+        """
+        with self.login_lock:
+            if self.connection is None:
+                credentials = self.config["credentials"]
+                with track_call("connected_drive", "login"):
+                    self.connection = ConnectedDriveAccount(credentials["user"], credentials["pwd"],
+                                                            get_region_from_name(credentials["region"]))
+                self.logger.info("Logged into the Connected Drive account")
+            return self.connection
+
+    def restore_states(self):
+        """
+        load the vehicle states persisted before the last shutdown, so that requests can be answered from the cache
+        right away.
+        """
+        try:
+            with open(self.cache / "connected_drive_state.json", "r") as fp:
+                snapshot = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.logger.warning("Could not restore persisted vehicle states")
+            return
+
+        for vin, entry in snapshot.items():
+            if vin in self.vehicle_update_timestamps:
+                self.vehicle_states[vin] = entry["attributes"]
+                self.vehicle_update_timestamps[vin] = entry["timestamp"]
+        self.logger.info(f"Restored persisted vehicle states of {list(self.vehicle_states.keys())}")
+
+    def persist_states(self):
+        with self.state_lock:
+            snapshot = {vin: {"timestamp": self.vehicle_update_timestamps[vin], "attributes": attributes}
+                        for vin, attributes in self.vehicle_states.items()}
+            tmp_path = self.cache / "connected_drive_state.json.tmp"
+            with open(tmp_path, "w") as fp:
+                json.dump(snapshot, fp, separators=(",", ":"), default=str)
+            os.replace(tmp_path, self.cache / "connected_drive_state.json")
+
+    def background_update(self):
+        while not self.stopped.is_set():
+            try:
+                for vehicle in self.account.vehicles:
+                    if vehicle.vin in self.vehicle_aliases and self.get_age(vehicle.vin) > \
+                            self.refresh_ahead * self.max_staleness:
+                        self.request_refresh(vehicle.vin)
+            except Exception:
+                self.logger.exception("exception occurred!")
+            self.stopped.wait(max(1., (1 - self.refresh_ahead) * self.max_staleness / 2))
 
     def get_last_update(self):
-        vehicle = self.find_vehicle()
-        return flask.jsonify(last_update=self.vehicle_update_timestamps[vehicle.vin])
+        return flask.jsonify(last_update=self.vehicle_update_timestamps[self.find_vin()])
+
+    def get_last_update_timestamp(self, alias: str) -> float:
+        return self.vehicle_update_timestamps[self.get_vin(alias)]
 
     def attach_endpoints(self, app):
         app.add_url_rule("/bmw/last_update", "get_bmw_last_update", self.get_last_update)
         app.add_url_rule("/bmw/state", "get_bmw_state", self.get_full_state)
         app.add_url_rule("/bmw/thumbnail", "get_bmw_thumbnail", self.get_thumbnail)
 
+    def find_vin(self) -> Optional[str]:
+        try:
+            return self.get_vin(flask.request.args.get('vehicle'))
+        except UnknownVehicleError as e:
+            flask.abort(404, description=str(e))
+        return None
+
     def find_vehicle(self) -> Optional[ConnectedDriveVehicle]:
         alias = flask.request.args.get('vehicle')
-        if alias not in self.vehicle_aliases.values():
-            self.logger.warning(f"Unknown vehicle requested: {alias}. "
-                                f"Known aliases are {self.vehicle_aliases.values()}")
-            flask.abort(404, description=f"Unknown Vehicle {alias}")
-            return None
+        try:
+            return self.get_vehicle(alias)
+        except UnknownVehicleError as e:
+            flask.abort(404, description=str(e))
+        except VehicleNotInAccountError as e:
+            flask.abort(501, description=str(e))
+        return None
+
+    def get_vin(self, alias: str) -> str:
+        """
+        resolve an alias from the config, without logging into the account.
+        """
+        for vin, vehicle_alias in self.vehicle_aliases.items():
+            if vehicle_alias == alias:
+                return vin
+        self.logger.warning(f"Unknown vehicle requested: {alias}. Known aliases are {self.vehicle_aliases.values()}")
+        raise UnknownVehicleError(f"Unknown Vehicle {alias}")
 
+    def get_vehicle(self, alias: str) -> ConnectedDriveVehicle:
+        """
+        the vehicle of the account, which logs in if this is its first use.
+        """
+        vin = self.get_vin(alias)
         for vehicle in self.account.vehicles:
-            if vehicle.vin in self.vehicle_aliases.keys() and self.vehicle_aliases[vehicle.vin] == alias:
+            if vehicle.vin == vin:
                 return vehicle
 
-        flask.abort(501, description=f"Unable to find vehicle in your account with VIN corresponding to alias {alias}. "
-                                     f"Check the config of the ConnectedDriveCache.")
-        return None
+        raise VehicleNotInAccountError(f"Unable to find vehicle in your account with VIN corresponding to alias "
+                                       f"{alias}. Check the config of the ConnectedDriveCache.")
 
     def get_full_state(self):
-        vehicle = self.find_vehicle()
+        vin = self.find_vin()
         allow_cache_query: str = flask.request.args.get('allow_cache')
         allow_cache: bool = allow_cache_query is None or allow_cache_query == "true"
-        self.check_staleness(vehicle, allow_cache)
-        return flask.jsonify(**vehicle.state.attributes)
+        try:
+            return flask.jsonify(**self.get_vehicle_state(self.vehicle_aliases[vin], allow_cache))
+        except VehicleStateUnavailableError as e:
+            flask.abort(503, description=str(e))
 
-    def check_staleness(self, vehicle, allow_cache: bool = True):
-        if time.time() - self.vehicle_update_timestamps[vehicle.vin] > self.max_staleness or not allow_cache:
-            self.logger.info(f"Fetching fresh data from {self.account.server_url}...")
-            vehicle.update_state()
-            self.vehicle_update_timestamps[vehicle.vin] = time.time()
+    def get_vehicle_state(self, alias: str, allow_cache: bool = True) -> dict:
+        """
+        the cached state of the vehicle. Cached and restored states are served without touching the account, only
+        the refresh logs in.
+        """
+        vin = self.get_vin(alias)
+        self.check_staleness(vin, allow_cache)
+        if vin not in self.vehicle_states:
+            raise VehicleStateUnavailableError(f"No state of vehicle {alias} is available yet")
+        return dict(self.vehicle_states[vin])
+
+    def get_age(self, vin: str) -> float:
+        return time.time() - self.vehicle_update_timestamps[vin]
+
+    def check_staleness(self, vin: str, allow_cache: bool = True):
+        """
+        make sure the state of the vehicle is fresh enough to be served. Stale data is served right away while a
+        refresh runs in the background. Only requests which do not allow cached data or find no data at all wait for
+        the refresh, joining the refresh that is already in flight if there is one.
+        """
+        if not allow_cache or self.vehicle_update_timestamps[vin] == 0.:
+            CACHE_REQUESTS.inc(cache="connected_drive", result="miss")
+            if not self.request_refresh(vin).wait(self.refresh_timeout):
+                self.logger.warning(f"Refresh of {vin} did not finish within {self.refresh_timeout} seconds")
+        elif self.get_age(vin) > self.max_staleness:
+            CACHE_REQUESTS.inc(cache="connected_drive", result="stale")
+            self.request_refresh(vin)
+            self.logger.debug(f"Serving stale data with timestamp {self.vehicle_update_timestamps[vin]} "
+                              f"while refreshing")
         else:
-            self.logger.info(f"Serving cached data with timestamp {self.vehicle_update_timestamps[vehicle.vin]}")
+            CACHE_REQUESTS.inc(cache="connected_drive", result="hit")
+            self.logger.debug(f"Serving cached data with timestamp {self.vehicle_update_timestamps[vin]}")
+
+    def request_refresh(self, vin: str) -> threading.Event:
+        """
+        start a background refresh of the vehicle state unless one is already running.
+        :return: an event which is set once the refresh finished
+        """
+        with self.refresh_lock:
+            event = self.refreshes.get(vin)
+            if event is None:
+                event = threading.Event()
+                self.refreshes[vin] = event
+                threading.Thread(target=self.refresh, args=(vin, event), name=f"refresh_{vin}", daemon=True).start()
+            return event
+
+    def refresh(self, vin: str, event: threading.Event):
+        try:
+            # runs on its own thread, so a login on first use does not block the request
+            vehicle = self.get_vehicle(self.vehicle_aliases[vin])
+            self.logger.info(f"Fetching fresh data from {self.account.server_url}...")
+            with track_call("connected_drive", "update_state"):
+                vehicle.update_state()
+            attributes = dict(vehicle.state.attributes)
+            with self.state_lock:
+                self.vehicle_states[vin] = attributes
+                self.vehicle_update_timestamps[vin] = time.time()
+            self.persist_states()
+        except Exception:
+            self.logger.exception(f"Could not refresh the state of {vin}")
+        finally:
+            with self.refresh_lock:
+                del self.refreshes[vin]
+            event.set()
 
     def get_thumbnail(self):
         if not self.cache.exists():
             self.cache.mkdir(exist_ok=True)
 
-        vehicle = self.find_vehicle()
-        fpath = self.cache / f"{self.vehicle_aliases[vehicle.vin]}.png"
+        fpath = self.cache / f"{self.vehicle_aliases[self.find_vin()]}.png"
         if not fpath.is_file():
+            vehicle = self.find_vehicle()
             img_bytes = vehicle.get_vehicle_image(600, 600, VehicleViewDirection.FRONTSIDE)
             with open(fpath, "wb") as fp:
                 fp.write(img_bytes)
 
-        return flask.send_file(fpath, mimetype='image/png')
+        return ASSETS.send_file(fpath, 'image/png', max_age=86400)
@@ -0,0 +1 @@
+from .control_plane import ControlPlane, ControlPlaneClient
\ No newline at end of file
@@ -0,0 +1,264 @@
+import io
+import logging
+import os
+import pathlib
+import queue
+import socket
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from ...utils import get_cache_dir
+
+# the parts of a wsgi environ which are not plain strings and are recreated on the other side
+WSGI_DEFAULTS = {"wsgi.version": (1, 0), "wsgi.multithread": True, "wsgi.multiprocess": True, "wsgi.run_once": False}
+ENVIRON_TYPES = (str, int, float, bool)
+# headers which describe the connection between the worker and its client and are set by the worker's server
+HOP_BY_HOP_HEADERS = ("connection", "keep-alive", "transfer-encoding")
+
+
+def get_address(config: dict) -> str:
+    """
+    the address of the control plane, by default a unix socket in the cache directory.
+    """
+    return config.get("address", str(get_cache_dir() / "control_plane.sock"))
+
+
+def get_key_path(config: dict) -> pathlib.Path:
+    return pathlib.Path(config.get("key_file", get_cache_dir() / "control_plane.key"))
+
+
+class ControlPlane:
+    """
+    Answers the HTTP requests which the workers forward through a local socket. The control plane is the single
+    process that owns the devices, the control loops and the state of the modules, the workers parse HTTP, serve the
+    dashboard and the static files and can run on every core without starting their own control loops.
+    Every worker connection is served by its own thread, which passes the requests to the flask app of the modules
+    one at a time. Streaming responses like the telemetry stream are passed on chunk by chunk.
+    """
+    def __init__(self, app: Callable, config: dict, logger: logging.Logger):
+        self.app = app
+        self.address: str = get_address(config)
+        self.key_path: pathlib.Path = get_key_path(config)
+        self.logger: logging.Logger = logger
+        self.listener: Optional[Listener] = None
+        self.key: Optional[bytes] = None
+        self.stopped = threading.Event()
+        self.daemon: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.connections: Dict[Connection, threading.Thread] = {}  # the open worker connections and their threads
+
+    def create_key(self) -> bytes:
+        # a fresh key per start, only readable by the user running the server
+        key = os.urandom(32)
+        fd = os.open(self.key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(key)
+        return key
+
+    def start(self):
+        if not self.address.startswith("\0") and os.path.exists(self.address):
+            # a socket left behind by a previous run
+            os.unlink(self.address)
+        self.key = self.create_key()
+        self.listener = Listener(self.address, authkey=self.key)
+        self.stopped.clear()
+        self.daemon = threading.Thread(target=self.accept, name="control_plane", daemon=True)
+        self.daemon.start()
+        self.logger.info(f"Control plane is listening on {self.address}")
+
+    def stop(self, timeout: float = 5.):
+        """
+        stop accepting workers, close their connections and wait up to timeout seconds for all threads.
+        """
+        deadline = time.monotonic() + timeout
+        self.stopped.set()
+        if self.daemon is not None:
+            # closing the listener does not wake a thread blocked in accept, a connection of our own does
+            try:
+                Client(self.address, authkey=self.key).close()
+            except (OSError, EOFError, AuthenticationError):
+                pass
+            self.daemon.join(max(0., deadline - time.monotonic()))
+        if self.listener is not None:
+            self.listener.close()
+
+        with self.lock:
+            connections = dict(self.connections)
+        for connection in connections:
+            # wakes the thread blocked in recv, which then closes the connection itself
+            try:
+                with socket.socket(fileno=os.dup(connection.fileno())) as sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, ValueError):
+                pass
+        for thread in connections.values():
+            thread.join(max(0., deadline - time.monotonic()))
+
+    def accept(self):
+        while not self.stopped.is_set():
+            try:
+                connection = self.listener.accept()
+            except Exception:
+                if not self.stopped.is_set():
+                    # e.g. a client with the wrong key, the listener itself stays usable
+                    self.logger.exception("Could not accept worker connection")
+                continue
+            if self.stopped.is_set():
+                connection.close()
+                return
+            thread = threading.Thread(target=self.serve, args=(connection,), name="control_plane_connection",
+                                      daemon=True)
+            with self.lock:
+                self.connections[connection] = thread
+            thread.start()
+
+    def serve(self, connection: Connection):
+        try:
+            with connection:
+                while not self.stopped.is_set():
+                    try:
+                        environ, body = connection.recv()
+                    except (EOFError, OSError):
+                        return
+                    if not self.handle(connection, environ, body):
+                        return
+        finally:
+            with self.lock:
+                self.connections.pop(connection, None)
+
+    def handle(self, connection: Connection, environ: dict, body: bytes) -> bool:
+        """
+        pass a forwarded request to the app and send the response back. Responses with a Content-Length are sent as
+        one message, all others are followed by their chunks and None.
+        :return: whether the connection can be used for the next request
+        """
+        environ.update(WSGI_DEFAULTS)
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["wsgi.errors"] = sys.stderr
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        try:
+            chunks = self.app(environ, start_response)
+        except Exception:
+            self.logger.exception(f"Could not handle {environ.get('PATH_INFO')}")
+            return self.send(connection, ("500 INTERNAL SERVER ERROR", [], b"", False))
+
+        try:
+            status, headers = started
+            streaming = not any(name.lower() == "content-length" for name, _ in headers)
+            if not streaming:
+                return self.send(connection, (status, headers, b"".join(chunks), False))
+            if not self.send(connection, (status, headers, b"", True)):
+                return False
+            for chunk in chunks:
+                if chunk and not self.send(connection, chunk):
+                    return False
+            return self.send(connection, None)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    @staticmethod
+    def send(connection: Connection, message) -> bool:
+        try:
+            connection.send(message)
+            return True
+        except (OSError, ValueError):
+            # the worker went away, e.g. the client of a stream disconnected
+            return False
+
+
+class ControlPlaneClient:
+    """
+    Forwards wsgi requests to the control plane. Connections are kept in a pool, so a request does not pay for
+    the authentication of a new connection, and a connection which was lost while idle is replaced transparently.
+    """
+    def __init__(self, config: dict, logger: logging.Logger):
+        self.address: str = get_address(config)
+        self.key_path: pathlib.Path = get_key_path(config)
+        self.logger: logging.Logger = logger
+        self.pool_size: int = config.get("pool_size", 8)  # idle connections kept open
+        self.timeout: float = config.get("timeout", 60.)  # seconds until the control plane has to answer
+        self.pool: queue.LifoQueue = queue.LifoQueue()
+
+    def connect(self) -> Connection:
+        return Client(self.address, authkey=self.key_path.read_bytes())
+
+    def release(self, connection: Connection):
+        if self.pool.qsize() < self.pool_size:
+            self.pool.put(connection)
+        else:
+            connection.close()
+
+    def request(self, message) -> Tuple[Connection, tuple]:
+        """
+        send a request over a pooled connection, or a new one if the pooled one was closed in the meantime.
+        :return: the connection, which must be released or closed, and the first message of the response
+        """
+        while True:
+            try:
+                connection, pooled = self.pool.get_nowait(), True
+            except queue.Empty:
+                connection, pooled = self.connect(), False
+            try:
+                connection.send(message)
+            except (OSError, ValueError):
+                connection.close()
+                if pooled:
+                    continue
+                raise
+            if not connection.poll(self.timeout):
+                connection.close()
+                raise TimeoutError(f"The control plane did not answer within {self.timeout} seconds")
+            try:
+                return connection, connection.recv()
+            except (EOFError, OSError):
+                # the request may have been handled, so it is not sent again
+                connection.close()
+                raise
+
+    def forward(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        """
+        a wsgi app which answers every request through the control plane.
+        """
+        length = environ.get("CONTENT_LENGTH")
+        body = environ["wsgi.input"].read(int(length)) if length else b""
+        forwarded = {key: value for key, value in environ.items()
+                     if isinstance(value, ENVIRON_TYPES) and key not in WSGI_DEFAULTS}
+        try:
+            connection, (status, headers, body, streaming) = self.request((forwarded, body))
+        except (OSError, EOFError, TimeoutError, AuthenticationError):
+            self.logger.exception(f"Could not forward {environ.get('PATH_INFO')}")
+            start_response("503 SERVICE UNAVAILABLE", [("Content-Type", "text/plain")])
+            return [b"The control plane is not available"]
+
+        start_response(status, [(name, value) for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS])
+        if not streaming:
+            self.release(connection)
+            return [body]
+        return self.stream(connection)
+
+    def stream(self, connection: Connection) -> Iterable[bytes]:
+        finished = False
+        try:
+            while True:
+                chunk = connection.recv()
+                if chunk is None:
+                    finished = True
+                    return
+                yield chunk
+        except (EOFError, OSError):
+            return
+        finally:
+            # a stream closed by its client leaves unread chunks behind, the connection can not be reused
+            if finished:
+                self.release(connection)
+            else:
+                connection.close()
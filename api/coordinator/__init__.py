@@ -0,0 +1 @@
+from .coordinator import LoadCoordinator, allocate
\ No newline at end of file
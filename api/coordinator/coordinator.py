@@ -0,0 +1,205 @@
+import concurrent.futures
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import flask
+
+from ..charge_manager.utils import FilterBank
+from ..manager import Manager
+from ..meter_sampler import MeterSampler, StaleSnapshotError
+from ..service_registry import ServiceRegistry
+from ...utils import Clock
+from ...utils.metrics import METRICS, TICK_DURATION, TICK_JITTER
+
+
+class Demand(NamedTuple):
+    wallbox: str
+    lower: int  # the minimum charging current in mA
+    upper: int  # the maximum charging current in mA
+    priority: Tuple  # smaller values are served first
+
+
+def allocate(total: float, demands: List[Demand]) -> Dict[str, int]:
+    """
+    share total mA between the demands with a max-min fair allocation. Every served demand receives at least its lower
+    bound, and the rest is split evenly, where a demand that reaches its upper bound passes its remaining share on to
+    the others. If the lower bounds do not fit into total, the demands with the lowest priority are not served.
+    :return: the current in mA per wallbox, 0 for demands which are not served
+    """
+    served = sorted(demands, key=lambda demand: demand.priority)
+    while served and sum(demand.lower for demand in served) > total:
+        served.pop()
+
+    currents = {demand.wallbox: 0 for demand in demands}
+    remaining = total - sum(demand.lower for demand in served)
+    by_headroom = sorted(served, key=lambda demand: demand.upper - demand.lower)
+    for idx, demand in enumerate(by_headroom):
+        extra = min(demand.upper - demand.lower, remaining / (len(by_headroom) - idx))
+        currents[demand.wallbox] = int(demand.lower + extra)
+        remaining -= extra
+    return currents
+
+
+class LoadCoordinator:
+    """
+    Controls the charging current of several wallboxes. Every tick the sessions of all wallboxes are read, the solar
+    excess and the grid connection limit are shared between the active sessions with a max-min fair allocation and
+    all changed current limits are sent in one batch.
+    Vehicles below min_soc always charge with the minimum current, the other vehicles only charge from the excess.
+    If the excess does not cover the minimum current of all of them, the vehicles with the lowest soc and the least
+    energy charged in their session are served first.
+    """
+    min_current = 6000  # mA
+
+    def __init__(self, config: dict, vehicles: List[dict], sampler: MeterSampler, services: ServiceRegistry,
+                 logger: logging.Logger, clock: Clock = None):
+        self.config = config
+        self.vehicles = {vehicle["rfid_token"]: vehicle for vehicle in vehicles}
+        self.sampler: MeterSampler = sampler
+        self.services: ServiceRegistry = services
+        self.logger: logging.Logger = logger
+        self.clock: Clock = clock or Clock()
+
+        # service name of the wallbox -> maximum current in mA
+        self.wallboxes: Dict[str, int] = {name: wallbox.get("max_current", 32000)
+                                          for name, wallbox in self.config["wallboxes"].items()}
+        self.grid_limit: float = self.config.get("grid_limit", 22000.)  # W
+        self.min_soc: float = self.config.get("min_soc", 60.)  # percentage
+        self.tick_interval: float = self.config.get("tick_interval", 5.)  # seconds
+        self.excess_filter = FilterBank("mean", self.config.get("smoothing_window", 3))
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.wallboxes),
+                                                              thread_name_prefix="coordinator_io")
+        self.limits: Dict[str, int] = {}  # the current limits which were sent last
+        self.allocation: Optional[dict] = None
+
+        self.stopped = threading.Event()
+        self.daemon: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.config.get("control_loop", "threaded") != "external":
+            self.stopped.clear()
+            self.daemon = threading.Thread(target=self.background_update, name="coordinator_daemon", daemon=True)
+            self.daemon.start()
+            METRICS.watch_thread(self.daemon)
+
+    def stop(self, timeout: float = None):
+        self.stopped.set()
+        if self.daemon is not None:
+            self.daemon.join(timeout)
+        self.executor.shutdown(wait=False)
+
+    def attach_endpoints(self, app: flask.Flask):
+        app.add_url_rule("/coordinator/allocation", "coordinator_allocation", self.handle_allocation,
+                         methods=["GET"])
+        self.logger.info("Attached endpoints.")
+
+    def handle_allocation(self):
+        if self.allocation is None:
+            return flask.abort(503, "No allocation was computed yet")
+        return self.allocation
+
+    def background_update(self):
+        while not self.stopped.is_set():
+            scheduled = self.clock.time() + self.tick_interval
+            self.clock.sleep(self.tick_interval)
+            if self.stopped.is_set():
+                return
+            TICK_JITTER.observe(max(0., self.clock.time() - scheduled), loop="coordinator")
+            try:
+                with TICK_DURATION.time(loop="coordinator"):
+                    self.control_step()
+            except StaleSnapshotError:
+                self.logger.warning("No fresh meter snapshot available, keeping the current limits")
+            except Exception:
+                self.logger.exception("exception occurred!")
+
+    def read_wallbox(self, name: str) -> dict:
+        wallbox = self.services[name]
+        session = wallbox.get_session()
+        state = wallbox.get_report(2)
+        power = wallbox.get_power()
+        # plug state 5 and 7 mean that a vehicle is connected
+        return {"session": session, "plugged": state.get("Plug", 7) >= 5, "power": float(power["power"])}
+
+    def get_soc(self, session: dict) -> Optional[float]:
+        vehicle = self.vehicles.get(session["RFID tag"])
+        if vehicle is None or not vehicle.get("charge_management", False):
+            return None
+        try:
+            state = self.services["connected_drive_cache"].get_vehicle_state(vehicle["alias"])
+            return float(state["chargingLevelHv"])
+        except Exception:
+            self.logger.exception(f"Could not get the state of charge of {vehicle['alias']}")
+            return None
+
+    def control_step(self):
+        names = list(self.wallboxes)
+        readings = dict(zip(names, self.executor.map(self.read_wallbox, names)))
+        snapshot = self.sampler.get_snapshot()
+
+        # the sampler only subtracts the power of its own wallbox from the house load
+        meters = snapshot.meters
+        base_load = meters["house"] + meters["wallbox"] - sum(reading["power"] for reading in readings.values())
+        excess = self.excess_filter("excess", meters["solar"] - base_load)
+        # the wallboxes must not push the grid import above the limit of the connection
+        capacity = self.grid_limit + meters["solar"] - base_load
+
+        manager = self.services["manager"] if "manager" in self.services else None
+        if manager is not None and "keba" in readings:
+            manager.update_session(readings["keba"]["session"])
+            manager.persist_session()
+
+        demands = []
+        mandatory_total = 0
+        fixed: Dict[str, int] = {}
+        socs: Dict[str, Optional[float]] = {}
+        for name, reading in readings.items():
+            if not reading["plugged"]:
+                fixed[name] = 0
+                continue
+            if manager is not None and name == "keba" and not manager.automatic_mode:
+                # the manual limit of the manager is served before the others
+                fixed[name] = min(manager.compute_current(100., None), self.wallboxes[name])
+                continue
+            soc = socs[name] = self.get_soc(reading["session"])
+            mandatory = soc is not None and soc < self.min_soc
+            if mandatory:
+                mandatory_total += self.min_current
+            energy = float(reading["session"].get("E pres", 0))
+            demands.append(Demand(name, self.min_current, self.wallboxes[name],
+                                  (not mandatory, 100. if soc is None else soc, energy)))
+
+        fixed_total = sum(fixed.values())
+        budget = max(1000 * Manager.power_to_phase_current(excess), mandatory_total)
+        budget = min(budget, 1000 * Manager.power_to_phase_current(capacity)) - fixed_total
+        currents = dict(fixed, **allocate(max(0., budget), demands))
+
+        self.apply(currents)
+        self.allocation = {"timestamp": self.clock.time(),
+                           "excess": excess,
+                           "capacity": capacity,
+                           "wallboxes": {name: {"current": currents[name],
+                                                "power": readings[name]["power"],
+                                                "plugged": readings[name]["plugged"],
+                                                "soc": socs.get(name),
+                                                "vehicle alias": readings[name]["session"].get("vehicle alias")}
+                                         for name in names}}
+
+    def apply(self, currents: Dict[str, int]):
+        """
+        send all changed current limits at once. Every wallbox is a separate device, so the limits are sent
+        concurrently and the tick waits for the slowest one.
+        """
+        changed = {name: current for name, current in currents.items() if self.limits.get(name) != current}
+        futures = {name: self.executor.submit(self.services[name].set_current, current, 1)
+                   for name, current in changed.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+                self.limits[name] = changed[name]
+            except Exception:
+                self.logger.exception(f"Could not set the current limit of {name}")
+        if changed:
+            self.logger.info(f"Sent current limits {changed}")
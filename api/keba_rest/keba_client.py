@@ -0,0 +1,100 @@
+import logging
+import math
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+from keba_udp import KebaUDP
+
+from ...utils.metrics import CACHE_REQUESTS, track_call
+
+
+SESSION_HISTORY_REPORTS = range(101, 131)
+
+
+class KebaClient:
+    """
+    Serializes all access to the UDP interface of the wallbox and caches every report with its own time to live.
+    Threads that request a report while another thread is fetching it wait for the running exchange and are served
+    from the cache afterwards, so concurrent requests for the same report share one datagram exchange.
+    The historic session reports 101-130 are cached until report 100 shows a new session id.
+    The UDP interface is connected by the first exchange if connect() was not called before.
+    """
+    default_ttls = {1: 3600., 2: 1., 3: 1., 100: 1.}  # seconds
+
+    def __init__(self, udp: KebaUDP, logger: logging.Logger, ttls: Dict[int, float] = None):
+        self.udp: KebaUDP = udp
+        self.logger = logger
+        self.ttls: Dict[int, float] = dict(self.default_ttls)
+        self.ttls.update({idx: math.inf for idx in SESSION_HISTORY_REPORTS})
+        self.ttls.update(ttls or {})
+
+        self.io_lock = threading.Lock()
+        self.cache: Dict[int, Tuple[float, dict]] = {}
+        self.connected: bool = False
+
+    def connect(self):
+        with self.io_lock:
+            self.ensure_connected()
+
+    def ensure_connected(self):
+        # the caller holds the io lock
+        if not self.connected:
+            with track_call("keba", "connect"):
+                self.udp.connect()
+            self.connected = True
+
+    def cached(self, report_id: int):
+        entry = self.cache.get(report_id)
+        if entry is not None and time.time() - entry[0] <= self.ttls.get(report_id, 0.):
+            return entry[1]
+        return None
+
+    def get_report(self, report_id: int) -> dict:
+        return self.get_reports((report_id,))[report_id]
+
+    def get_reports(self, report_ids: Iterable[int]) -> Dict[int, dict]:
+        """
+        return the requested reports. The reports which are not cached are fetched one after the other under a
+        single acquisition of the lock, so no other exchange gets between them. This is not pipelining:
+        KebaUDP.get_report sends a request and blocks until its reply arrives on the one socket of the wallbox, and the
+        wallbox handles one datagram at a time and drops requests that arrive while it is busy. Each missing report
+        costs one round trip.
+        """
+        report_ids = tuple(report_ids)
+        reports = {report_id: self.cached(report_id) for report_id in report_ids}
+        missing = [report_id for report_id, report in reports.items() if report is None]
+        CACHE_REQUESTS.inc(len(report_ids) - len(missing), cache="keba_reports", result="hit")
+        if missing:
+            with self.io_lock:
+                for report_id in missing:
+                    # another thread might have fetched the report while we were waiting for the lock
+                    report = self.cached(report_id)
+                    if report is None:
+                        CACHE_REQUESTS.inc(cache="keba_reports", result="miss")
+                        report = self.fetch(report_id)
+                    else:
+                        CACHE_REQUESTS.inc(cache="keba_reports", result="shared")
+                    reports[report_id] = report
+        return {report_id: dict(report) for report_id, report in reports.items()}
+
+    def fetch(self, report_id: int) -> dict:
+        self.ensure_connected()
+        with track_call("keba", f"report_{report_id}"):
+            report = self.udp.get_report(report_id)
+        if report_id == 100:
+            previous = self.cache.get(100)
+            if previous is not None and previous[1]["Session ID"] != report["Session ID"]:
+                self.logger.info(f"Session id changed to {report['Session ID']}, invalidating session history")
+                for idx in SESSION_HISTORY_REPORTS:
+                    self.cache.pop(idx, None)
+        self.cache[report_id] = (time.time(), report)
+        return report
+
+    def set_currtime(self, current, delay):
+        with self.io_lock:
+            self.ensure_connected()
+            with track_call("keba", "currtime"):
+                self.udp.set_currtime(current, delay)
+            # the current limit is part of report 2
+            self.cache.pop(2, None)
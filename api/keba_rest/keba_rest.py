@@ -4,13 +4,22 @@ from keba_udp import KebaUDP
 
 import flask
 
+from .keba_client import KebaClient
+
 
 class KebaP30:
     def __init__(self, config: dict, vehicles: dict, logger: logging.Logger):
-        self.udp = KebaUDP(config["host"], logger=logger.getChild("udp_interface"))
         self.logger = logger
+        ttls = {int(report_id): ttl for report_id, ttl in config.get("report_ttls", {}).items()}
+        self.client = KebaClient(KebaUDP(config["host"], logger=logger.getChild("udp_interface")),
+                                 logger.getChild("client"), ttls)
         self.vehicles = {vehicle["rfid_token"]: vehicle for vehicle in vehicles}
-        self.udp.connect()
+
+    def start(self):
+        self.client.connect()
+
+    def is_healthy(self) -> bool:
+        return self.client.connected
 
     def attach_endpoints(self, app: flask.Flask):
         self.logger.info("Attached endpoints.")
@@ -20,10 +29,16 @@ class KebaP30:
 
     def report(self):
         report_id = flask.request.args.get('id', type=int)
+        try:
+            return self.get_report(report_id)
+        except ValueError as e:
+            flask.abort(400, str(e))
+
+    def get_report(self, report_id: int) -> dict:
         if report_id in (1, 2, 3) or report_id in range(100, 131):
-            return self.udp.get_report(report_id)
+            return self.client.get_report(report_id)
         else:
-            flask.abort(400, f"Requested report_id {report_id} neither in (1,2,3) nor in range(100, 131)")
+            raise ValueError(f"Requested report_id {report_id} neither in (1,2,3) nor in range(100, 131)")
 
     def power(self):
         if flask.request.method == 'PUT':
@@ -31,15 +46,28 @@ class KebaP30:
             if current is None:
                 flask.abort(400, "PUT requests must specify current value")
             delay = flask.request.args.get('delay')
-            self.udp.set_currtime(current, delay)
+            self.set_current(current, delay)
             return {}
         elif flask.request.method == "GET":
-            report3 = self.udp.get_report(3)
-            report2 = self.udp.get_report(2)
-            return {"power": report3["P"] / 1000, "current_limit": report2["Curr timer"]}
+            return self.get_power()
+
+    def set_current(self, current, delay):
+        """
+        :param current: the charging current limit in mA
+        :param delay: the delay in seconds after which the new limit becomes active
+        """
+        self.client.set_currtime(current, delay)
+
+    def get_power(self) -> dict:
+        reports = self.client.get_reports((3, 2))
+        report3, report2 = reports[3], reports[2]
+        return {"power": report3["P"] / 1000, "current_limit": report2["Curr timer"]}
 
     def session(self):
-        report = self.udp.get_report(100)
+        return self.get_session()
+
+    def get_session(self) -> dict:
+        report = self.client.get_report(100)
         vehicle = self.vehicles.get(report["RFID tag"], None)
         if vehicle is not None:
             report["vehicle name"] = vehicle["name"]
@@ -0,0 +1,104 @@
+import asyncio
+import concurrent.futures
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from ..meter_sampler import StaleSnapshotError
+from ...utils.metrics import TICK_DURATION, TICK_JITTER
+
+
+class AsyncControlLoop:
+    """
+    Runs the control cycle of the Manager on an asyncio event loop. The wallbox session and the vehicle state are
+    fetched concurrently in a thread pool with a timeout per call, and every tick decides on the data that arrived in
+    time. A call that is still running from a previous tick is joined instead of being started again, so a slow cloud
+    API can neither stall the tick nor pile up requests.
+    """
+    def __init__(self, manager, logger: logging.Logger):
+        self.manager = manager
+        self.logger = logger
+
+        self.io_timeout: float = self.manager.config.get("io_timeout", 2.)  # seconds
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="manager_io")
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.vehicle_soc: Dict[str, float] = {}  # the last known soc in percent per vehicle alias
+
+    def run(self):
+        asyncio.run(self.control_loop())
+
+    async def control_loop(self):
+        loop = asyncio.get_running_loop()
+        tick = 0
+        next_tick = loop.time()
+        while not self.manager.stopped.is_set():
+            next_tick += self.manager.tick_interval
+            await asyncio.sleep(max(0., next_tick - loop.time()))
+
+            jitter = loop.time() - next_tick
+            TICK_JITTER.observe(max(0., jitter), loop="manager")
+            self.logger.debug(f"Tick {tick} started {jitter * 1000:.1f} ms late")
+            if jitter > self.manager.tick_interval:
+                # skip the missed ticks instead of running them back to back
+                next_tick = loop.time()
+
+            try:
+                with TICK_DURATION.time(loop="manager"):
+                    await self.step(tick)
+            except Exception:
+                self.logger.exception("exception occurred!")
+            tick += 1
+
+    async def call(self, key: str, function: Callable, *args) -> Optional[Any]:
+        """
+        run function in the thread pool and wait at most io_timeout seconds for its result.
+        :param key: identifies the call. If a call with the same key is still running it is joined
+        :return: the result of the function or None if it failed or did not finish in time
+        """
+        future = self.pending.get(key)
+        if future is None or future.done():
+            if future is not None and not future.cancelled():
+                # mark the outcome of a call that finished after its timeout as retrieved
+                future.exception()
+            future = asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+            self.pending[key] = future
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.io_timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"{key} did not finish within {self.io_timeout} seconds")
+        except Exception:
+            self.logger.exception(f"{key} failed")
+        return None
+
+    async def step(self, tick: int):
+        keba = self.manager.services["keba"]
+        connected_drive_cache = self.manager.services["connected_drive_cache"]
+
+        alias = self.manager.get_vehicle_alias()
+        fetches = [self.call("keba_session", keba.get_session)]
+        if self.manager.automatic_mode and alias is not None:
+            fetches.append(self.call(f"vehicle_state_{alias}", connected_drive_cache.get_vehicle_state, alias))
+        session, *vehicle_state = await asyncio.gather(*fetches)
+
+        if session is not None:
+            self.manager.update_session(session)
+        if self.manager.session_info is None:
+            self.logger.warning("No wallbox session is known yet")
+            return
+        if tick % 2 == 0:
+            self.manager.persist_session()
+
+        if vehicle_state and vehicle_state[0] is not None:
+            self.vehicle_soc[alias] = vehicle_state[0]["chargingLevelHv"]
+        percent_soc = self.vehicle_soc.get(alias, 100.)
+
+        try:
+            powerwall_soe = self.manager.sampler.get_snapshot().powerwall_soe
+        except StaleSnapshotError:
+            self.logger.warning("No fresh powerwall soe available, keeping the previous charging decision")
+            powerwall_soe = None
+
+        current = self.manager.compute_current(percent_soc, powerwall_soe)
+        # one key for all currents: while a command is still in flight the new current is not sent, so two commands
+        # never reach the wallbox out of order. The next tick sends the current it computes then
+        await self.call("set_current", keba.set_current, current, 1)
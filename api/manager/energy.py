@@ -0,0 +1,142 @@
+import datetime
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from ..meter_sampler import MeterSnapshot
+from ...utils.state_store import StateStore
+
+# the signed grid and battery meters are split into both directions
+ENERGY_METERS = ("house", "wallbox", "solar", "grid_import", "grid_export", "battery_charge", "battery_discharge")
+SOURCES = ("solar", "battery", "grid")
+
+
+def directional_power(meters) -> Dict[str, float]:
+    """
+    the power of every energy meter in Watts. The grid is positive when importing and the battery when discharging.
+    """
+    return {"house": max(0., meters["house"]),
+            "wallbox": max(0., meters["wallbox"]),
+            "solar": max(0., meters["solar"]),
+            "grid_import": max(0., meters["grid"]),
+            "grid_export": max(0., -meters["grid"]),
+            "battery_charge": max(0., -meters["battery"]),
+            "battery_discharge": max(0., meters["battery"])}
+
+
+def source_shares(power: Dict[str, float]) -> Dict[str, float]:
+    """
+    the share of every source in the power consumed by the house and the wallbox. The solar power that is neither
+    exported nor charged into the battery is consumed locally.
+    """
+    supply = {"solar": max(0., power["solar"] - power["grid_export"] - power["battery_charge"]),
+              "battery": power["battery_discharge"],
+              "grid": power["grid_import"]}
+    total = sum(supply.values())
+    if total <= 0:
+        return {"solar": 0., "battery": 0., "grid": 1.}
+    return {source: value / total for source, value in supply.items()}
+
+
+class EnergyIntegrator:
+    """
+    Integrates the power of every meter over the snapshots of the sampler with the trapezoidal rule and keeps the
+    energy per day. The energy of the wallbox is attributed to the sources which supplied the house and the wallbox
+    in the same interval, in proportion to their power, and summed up per charging session.
+    Daily totals and the sessions are kept in a StateStore, so the accumulated energy survives a restart.
+    """
+    def __init__(self, state: StateStore, logger: logging.Logger, max_gap: float = 60., retention_days: int = 400,
+                 max_sessions: int = 500):
+        self.state: StateStore = state
+        self.logger: logging.Logger = logger
+        self.max_gap: float = max_gap  # seconds, longer gaps between two snapshots are not integrated
+        self.retention_days: int = retention_days
+        self.max_sessions: int = max_sessions
+
+        self.lock = threading.Lock()
+        self.previous: Optional[MeterSnapshot] = None
+        self.days: Dict[str, Dict[str, float]] = self.state.get("days", {})  # ISO date -> meter -> Wh
+        # the running day is stored separately, so every sample only rewrites the totals of one day
+        today = self.state.get("today")
+        if today is not None:
+            self.days[today["date"]] = today["totals"]
+        self.sessions: Dict[str, Dict[str, float]] = self.state.get("sessions", {})  # session id -> source -> Wh
+        self.session: Optional[dict] = self.state.get("session")  # the attribution of the current session
+
+    def add(self, snapshot: MeterSnapshot, session_id: Optional[int] = None):
+        """
+        integrate the interval from the previous snapshot to this one.
+        :param session_id: the id of the current charging session of the wallbox, if there is one
+        """
+        with self.lock:
+            previous, self.previous = self.previous, snapshot
+            if session_id is not None and (self.session is None or self.session["id"] != session_id):
+                self.finish_session()
+                self.session = {"id": session_id, "started": snapshot.timestamp, "energy": 0.,
+                                **{source: 0. for source in SOURCES}}
+
+            if previous is None:
+                return
+            dt = snapshot.timestamp - previous.timestamp
+            if dt <= 0 or dt > self.max_gap:
+                return
+
+            start, end = directional_power(previous.meters), directional_power(snapshot.meters)
+            energy = {meter: (start[meter] + end[meter]) / 2 * dt / 3600 for meter in ENERGY_METERS}  # Wh
+
+            day = datetime.date.fromtimestamp(snapshot.timestamp).isoformat()
+            totals = self.days.get(day)
+            if totals is None:
+                totals = self.days[day] = {meter: 0. for meter in ENERGY_METERS}
+                self.prune_days(day)
+                self.state.put("days", {key: value for key, value in self.days.items() if key != day})
+            for meter, value in energy.items():
+                totals[meter] += value
+            self.state.put("today", {"date": day, "totals": totals})
+
+            if self.session is not None and energy["wallbox"] > 0:
+                shares = source_shares({meter: (start[meter] + end[meter]) / 2 for meter in ENERGY_METERS})
+                self.session["energy"] += energy["wallbox"]
+                for source, share in shares.items():
+                    self.session[source] += share * energy["wallbox"]
+                self.state.put("session", self.session)
+
+    def finish_session(self):
+        # the caller holds the lock
+        if self.session is None or self.session["energy"] <= 0:
+            return
+        self.sessions[str(self.session["id"])] = {key: value for key, value in self.session.items() if key != "id"}
+        while len(self.sessions) > self.max_sessions:
+            del self.sessions[min(self.sessions, key=int)]
+        self.state.put("sessions", self.sessions)
+
+    def prune_days(self, today: str):
+        # the caller holds the lock
+        cutoff = (datetime.date.fromisoformat(today) - datetime.timedelta(days=self.retention_days)).isoformat()
+        for day in [day for day in self.days if day < cutoff]:
+            del self.days[day]
+
+    def get_days(self, start: datetime.date, end: datetime.date) -> List[dict]:
+        """
+        :return: the energy of every meter in kWh for the days between start and end, both inclusive
+        """
+        with self.lock:
+            days = {day: dict(totals) for day, totals in self.days.items()
+                    if start.isoformat() <= day <= end.isoformat()}
+        return [{"date": day, **{meter: value / 1000 for meter, value in totals.items()}}
+                for day, totals in sorted(days.items())]
+
+    def get_session(self, session_id: int) -> Optional[dict]:
+        """
+        :return: the energy of the session in kWh and its shares of solar, battery and grid energy or None if the
+        session was not recorded
+        """
+        with self.lock:
+            if self.session is not None and self.session["id"] == session_id:
+                session = dict(self.session)
+            else:
+                session = self.sessions.get(str(session_id))
+                if session is None:
+                    return None
+                session = dict(session, id=session_id)
+        return {key: value / 1000 if key in SOURCES or key == "energy" else value for key, value in session.items()}
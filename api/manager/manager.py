@@ -4,52 +4,126 @@ import logging
 import threading
 import time
 from math import sqrt
-from typing import List
+from typing import List, Optional, Tuple
 
 import flask
-import requests
 
-from ...utils import get_cache_dir
+from .control_loop import AsyncControlLoop
+from .energy import EnergyIntegrator
+from .meter_store import SegmentStore
+from .rollup import RollupTier
+from ..meter_sampler import MeterSampler, MeterSnapshot, StaleSnapshotError
+from ..service_registry import ServiceRegistry
+from ...utils import Clock, get_cache_dir
+from ...utils.state_store import StateStore
+from ...utils.metrics import METRICS, TICK_DURATION, TICK_JITTER
 
 
 class MeterHistory:
-    def __init__(self, logger: logging.Logger, max_entries: int = 100):
+    meters = ("house", "wallbox", "solar", "grid", "battery")
+    # rollup resolution in seconds and the number of days it is retained
+    rollup_tiers = {10: 90, 60: 365, 900: 3650, 3600: 3650}
+
+    def __init__(self, logger: logging.Logger, max_entries: int = 100, retention_days: int = 90,
+                 max_points: int = 500):
         self.logger = logger
         self.cache = get_cache_dir()
 
-        self.max_entries: int = max_entries
-        self.entries: List = self.restore_entries()
+        self.max_entries: int = max_entries  # the number of entries returned if no timestamp is specified
+        self.max_points: int = max_points  # the number of entries a query returns at most if no resolution is given
+        # one segment holds one day of samples at the default sampling rate of 1 Hz
+        self.store = SegmentStore(self.cache / "meter_history", "<d5f", self.logger.getChild("store"),
+                                  records_per_segment=86400, max_segments=retention_days)
+        self.tiers: List[RollupTier] = [RollupTier(self.cache / "meter_history", resolution, self.meters,
+                                                   self.logger.getChild(f"rollup_{resolution}"), days)
+                                        for resolution, days in self.rollup_tiers.items()]
+        if len(self.store) == 0:
+            self.restore_entries()
+        self.restore_tiers()
 
     def restore_entries(self):
+        # import the history written by the previous json based implementation
         try:
             with open(self.cache / "meter_history.json", "r") as fp:
-                return json.load(fp)["history"]
-        except (FileNotFoundError, json.JSONDecodeError):
+                for entry in json.load(fp)["history"]:
+                    self.add_entry(entry, entry["timestamp"])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
             self.logger.warning("Could not restore previous meter history")
-            return []
-
-    def save_entries(self):
-        with open(self.cache / "meter_history.json", "w") as fp:
-            json.dump({"history": self.entries}, fp)
-
-    def add_entry(self, meter_info: dict):
-        meter_info["timestamp"] = time.time()
-        self.entries.append(meter_info)
 
-        while len(self.entries) > self.max_entries:
-            self.entries.pop(0)
-
-        self.save_entries()
-
-    def filter_entries(self, timestamp: float):
-        return [info for info in self.entries if info["timestamp"] > timestamp]
+    def restore_tiers(self):
+        # feed the raw samples which are not yet contained in a written bucket back into every rollup tier. A tier
+        # without any bucket, e.g. a newly added one, is only filled within its retention window
+        _, latest = self.store.time_range()
+        if latest is None:
+            return
+        for tier in self.tiers:
+            start = max(tier.flushed_until, latest - tier.retention_days * 86400)
+            count = 0
+            for record in self.store.iterate(start):
+                tier.add(record[0], record[1:])
+                count += 1
+            self.logger.info(f"Restored the rollup tier of {tier.resolution} seconds from {count} samples")
+
+    def flush(self):
+        """
+        write the buffered samples and buckets to disk.
+        """
+        self.store.flush()
+        for tier in self.tiers:
+            tier.store.flush()
+
+    def add_entry(self, meter_info: dict, timestamp: float = None):
+        if timestamp is None:
+            timestamp = time.time()
+        values = tuple(meter_info[meter] for meter in self.meters)
+        self.store.append((timestamp, *values))
+        for tier in self.tiers:
+            tier.add(timestamp, values)
+
+    def to_entry(self, record: tuple) -> dict:
+        entry = dict(zip(self.meters, record[1:]))
+        entry["timestamp"] = record[0]
+        return entry
+
+    @property
+    def entries(self) -> List[dict]:
+        return [self.to_entry(record) for record in self.store.latest(self.max_entries)]
+
+    def filter_entries(self, timestamp: float, end: float = None) -> List[dict]:
+        return [self.to_entry(record) for record in self.store.query(timestamp, end)]
+
+    def query(self, start: float, end: float = None, resolution: float = None) -> Tuple[Optional[int], List[dict]]:
+        """
+        return the history between start and end from the raw samples or from the coarsest rollup tier whose
+        resolution does not exceed the requested resolution.
+        :param start: the exclusive lower bound of the timestamps
+        :param end: the inclusive upper bound of the timestamps, defaults to now
+        :param resolution: the requested resolution in seconds. If it is None a resolution is chosen such that at
+        most max_points entries are returned
+        :return: the resolution of the returned entries (None for raw samples) and the entries
+        """
+        if resolution is None:
+            span = (time.time() if end is None else end) - start
+            resolution = span / self.max_points
+
+        if resolution < self.tiers[0].resolution:
+            return None, self.filter_entries(start, end)
+        tier = [tier for tier in self.tiers if tier.resolution <= resolution][-1]
+        return tier.resolution, tier.query(start, end)
 
 
 class Manager:
-    def __init__(self, config, app, logger: logging.Logger):
+    def __init__(self, config, vehicles, sampler: MeterSampler, services: ServiceRegistry, logger: logging.Logger,
+                 clock: Clock = None):
         self.config = config
+        self.vehicles = {vehicle["rfid_token"]: vehicle for vehicle in vehicles}
+        self.sampler: MeterSampler = sampler
+        self.services: ServiceRegistry = services
         self.logger: logging.Logger = logger
+        self.clock: Clock = clock or Clock()
         self.cache = get_cache_dir()
+        self.state = StateStore(self.cache / "manager_state.json", self.logger.getChild("state"),
+                                self.config.get("state_flush_delay", 2.))
 
         self.automatic_mode = None
         self.manual_power_limit = None
@@ -57,78 +131,164 @@ class Manager:
 
         self.restore_session()
 
-        self.history = MeterHistory(self.logger.getChild("history"))
-
-        self.daemon = threading.Thread(target=self.background_update, args=(app, ), name="charge_manager_daemon", daemon=True)
+        # the history is loaded by start, reading the stored samples back into the rollup tiers takes a while
+        self.history: Optional[MeterHistory] = None
+        self.energy = EnergyIntegrator(StateStore(self.cache / "energy.json", self.logger.getChild("energy_state"),
+                                                  self.config.get("energy_flush_delay", 60.)),
+                                       self.logger.getChild("energy"))
+
+        self.tick_interval: float = self.config.get("tick_interval", 5.)  # seconds
+        self.stopped = threading.Event()
+        self.daemon: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        load the meter history and start the control loop.
+        """
+        if self.history is None:
+            self.history = MeterHistory(self.logger.getChild("history"),
+                                        retention_days=self.config.get("history_retention_days", 90))
+            self.sampler.subscribe(self.record_history)
+            self.sampler.subscribe(self.record_energy)
+
+        control_loop = self.config.get("control_loop", "threaded")
+        if control_loop == "external":
+            # the owner, e.g. the simulation, drives the control cycle by calling control_step
+            return
+        if control_loop == "asyncio":
+            self.control_loop = AsyncControlLoop(self, self.logger.getChild("control_loop"))
+            target = self.control_loop.run
+        else:
+            target = self.background_update
+        self.stopped.clear()
+        self.daemon = threading.Thread(target=target, args=(), name="manager_daemon", daemon=True)
         self.daemon.start()
+        METRICS.watch_thread(self.daemon)
+
+    def stop(self, timeout: float = None):
+        self.stopped.set()
+        if self.daemon is not None:
+            self.daemon.join(timeout)
+        self.persist_session()
+        self.state.flush()
+        self.energy.state.flush()
+        if self.history is not None:
+            self.history.flush()
 
     def restore_session(self):
-        try:
-            with open(self.cache / "manager_session.json", "r") as fp:
-                sess = json.load(fp)
-                self.session_info = sess
-                self.automatic_mode = sess["automatic_mode"]
-                self.manual_power_limit = sess["manual_power_limit"]
-        except (FileNotFoundError, json.JSONDecodeError):
+        sess = self.state.get("session")
+        if sess is None:
+            # import the session written by the previous implementation
+            try:
+                with open(self.cache / "manager_session.json", "r") as fp:
+                    sess = json.load(fp)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+        if sess is None or "automatic_mode" not in sess:
             self.logger.warning("Could not restore previous manager session")
             self.session_info = None
             self.automatic_mode = True
             self.manual_power_limit = 23000.0
+            return
+        self.session_info = sess
+        self.automatic_mode = sess["automatic_mode"]
+        self.manual_power_limit = sess["manual_power_limit"]
 
     def persist_session(self):
-        with open(self.cache / "manager_session.json", "w") as fp:
-            self.session_info["automatic_mode"] = self.automatic_mode
-            self.session_info["manual_power_limit"] = self.manual_power_limit
-            json.dump(self.session_info, fp)
+        """
+        hand the session and the mode to the state store, which only writes them if they changed.
+        """
+        if self.session_info is None:
+            return
+        self.session_info["automatic_mode"] = self.automatic_mode
+        self.session_info["manual_power_limit"] = self.manual_power_limit
+        self.state.put("session", self.session_info)
+
+    def background_update(self):
+        keba = self.services["keba"]
+        while not self.stopped.is_set():
+            try:
+                # the session is updated every other tick
+                self.update_session(keba.get_session())
+                self.persist_session()
+                for _ in range(2):
+                    scheduled = self.clock.time() + self.tick_interval
+                    self.clock.sleep(self.tick_interval)
+                    if self.stopped.is_set():
+                        return
+                    TICK_JITTER.observe(max(0., self.clock.time() - scheduled), loop="manager")
+                    with TICK_DURATION.time(loop="manager"):
+                        self.control_step()
+            except Exception:
+                self.logger.exception("exception occurred!")
+                self.clock.sleep(self.tick_interval)
+
+    def control_step(self):
+        """
+        set the current limit of the wallbox from the state of charge of the vehicle and the powerwall soe.
+        """
+        percent_soc = 100.
+        alias = self.get_vehicle_alias()
+        if self.automatic_mode and alias is not None:
+            percent_soc = self.services["connected_drive_cache"].get_vehicle_state(alias)["chargingLevelHv"]
+
+        powerwall_soe = None
+        if self.automatic_mode and percent_soc >= 60.:
+            powerwall_soe = self.get_snapshot().powerwall_soe
+
+        self.services["keba"].set_current(self.compute_current(percent_soc, powerwall_soe), 1)
+
+    def update_session(self, sess: dict):
+        if self.session_info is None or sess["Session ID"] != self.session_info["Session ID"]:
+            self.start_session(sess)
+
+    def get_vehicle_alias(self) -> Optional[str]:
+        """
+        :return: the alias of the vehicle of the current session if its state of charge is available
+        """
+        if self.session_info is None:
+            return None
+        vehicle = self.vehicles.get(self.session_info["RFID tag"])
+        if vehicle is not None and vehicle.get("charge_management", False):
+            return vehicle["alias"]
+        return None
+
+    def compute_current(self, percent_soc: float, powerwall_soe: Optional[float]) -> int:
+        """
+        compute the current limit of the wallbox in mA.
+        :param percent_soc: the state of charge of the connected vehicle in percent
+        :param powerwall_soe: the state of energy of the powerwall in percent. If it is None the previous charging
+        decision is kept
+        """
+        if self.automatic_mode:
+            if percent_soc < 60.:
+                return 6000
+
+            if powerwall_soe is not None and powerwall_soe > 80.:
+                self.session_info["charging"] = True
+            elif powerwall_soe is not None and powerwall_soe < 50.:
+                self.session_info["charging"] = False
+            else:
+                self.session_info["charging"] = self.session_info.get("charging", False)
 
-    def background_update(self, app):
-        client = app.test_client()
-        try:
-            while True:
-                meter_info = self.handle_meters(client)
-                self.history.add_entry(meter_info)
-
-                for _ in range(20):
-                    sess = json.loads(client.get("/keba/session").data)
-                    if self.session_info is None or sess["Session ID"] != self.session_info["Session ID"]:
-                        self.start_session(sess)
-                    self.persist_session()
-                    for _ in range(2):
-                        time.sleep(5)
-                        if self.automatic_mode:
-                            percent_soc = 100.
-
-                            if self.session_info["RFID tag"] == "0400069ad8648500":
-                                vehicle_info: dict = json.loads(client.get(f"/bmw/state?vehicle=i32020").data)
-                                percent_soc = vehicle_info["chargingLevelHv"]
-
-                            if percent_soc < 60.:
-                                client.put(f"/keba/power?current={6000}&delay=1")
-                            else:
-                                meter_info = self.handle_meters(client)
-                                powerwall_soe = self.handle_powerwall_soe()["percentage"]
-
-                                if powerwall_soe > 80.:
-                                    self.session_info["charging"] = True
-                                elif powerwall_soe < 50.:
-                                    self.session_info["charging"] = False
-                                else:
-                                    self.session_info["charging"] = self.session_info.get("charging", False)
-
-                                if self.session_info["charging"]:
-                                    client.put(f"/keba/power?current={6000}&delay=1")
-                                else:
-                                    client.put(f"/keba/power?current=0&delay=1")
-                        else:
-                            current = 1000 * self.power_to_phase_current(self.manual_power_limit)  # current limit in mA
-                            if current < 6000 and current != 0:
-                                current = 6000
-                            if current > 63000:
-                                current = 63000
-                            client.put(f"/keba/power?current={current}&delay=1")
-        except:
-            self.logger.exception("exception occurred!")
-            self.background_update(app)
+            if self.session_info["charging"]:
+                return 6000
+            else:
+                return 0
+        else:
+            current = 1000 * self.power_to_phase_current(self.manual_power_limit)  # current limit in mA
+            if current < 6000 and current != 0:
+                current = 6000
+            if current > 63000:
+                current = 63000
+            return int(current)
+
+    def record_history(self, snapshot: MeterSnapshot):
+        self.history.add_entry(snapshot.meters, snapshot.timestamp)
+
+    def record_energy(self, snapshot: MeterSnapshot):
+        session = self.session_info
+        self.energy.add(snapshot, None if session is None else session["Session ID"])
 
     def start_session(self, new_session_info: dict):
         self.logger.info("New session started!")
@@ -147,24 +307,52 @@ class Manager:
         app.add_url_rule("/manager/mode", "manager_mode", self.handle_mode, methods=["GET", "PUT"])
         app.add_url_rule("/manager/limit", "manager_limit", self.handle_manual_current_limit, methods=["GET", "PUT"])
         app.add_url_rule("/manager/session", "manager_session", self.handle_session, methods=["GET"])
+        app.add_url_rule("/manager/energy", "manager_energy", self.handle_energy, methods=["GET"])
         app.add_url_rule("/manager/powerwall/soe", "manager_powerwall_soe", self.handle_powerwall_soe, methods=["GET"])
         self.logger.info("Attached endpoints.")
 
     def handle_powerwall_soe(self):
-        logging.captureWarnings(True)
-        resp = requests.get(f'{self.config["powerwall_host"]}/api/system_status/soe', verify=False)
-        logging.captureWarnings(False)
-        return json.loads(resp.text)
+        try:
+            return {"percentage": self.sampler.get_snapshot().powerwall_soe}
+        except StaleSnapshotError as e:
+            flask.abort(503, str(e))
 
     def handle_history(self):
-        timestamp = flask.request.args.get('timestamp')
-        if timestamp is None:
-            return {"history": self.history.entries}
+        if self.history is None:
+            return flask.abort(503, "The meter history is still loading")
+        # timestamp is the name of the from parameter in older versions of the dashboard
+        start = flask.request.args.get('from', type=float)
+        if start is None:
+            start = flask.request.args.get('timestamp', type=float)
+        end = flask.request.args.get('to', type=float)
+        resolution = flask.request.args.get('resolution', type=float)
+        if start is None and end is None and resolution is None:
+            return {"history": self.history.entries, "resolution": None}
         else:
-            self.logger.info(f"sending history more recent than {timestamp}")
-            return {"history": self.history.filter_entries(float(timestamp))}
+            if start is None:
+                start = (time.time() if end is None else end) - self.history.max_points * (resolution or 1)
+            self.logger.debug(f"sending history from {start} to {end} with resolution {resolution}")
+            resolution, entries = self.history.query(start, end, resolution)
+            return {"history": entries, "resolution": resolution}
+
+    def handle_energy(self):
+        """
+        the energy per meter and day in kWh between the optional ISO dates from and to, by default of the last seven
+        days, and the solar, battery and grid energy of the current session.
+        """
+        try:
+            end = datetime.date.fromisoformat(flask.request.args.get('to', datetime.date.today().isoformat()))
+            start = flask.request.args.get('from')
+            start = end - datetime.timedelta(days=6) if start is None else datetime.date.fromisoformat(start)
+        except ValueError as e:
+            return flask.abort(400, str(e))
+        session = None if self.session_info is None else self.energy.get_session(self.session_info["Session ID"])
+        return {"days": self.energy.get_days(start, end), "session": session}
 
     def handle_session(self):
+        return self.get_session()
+
+    def get_session(self) -> dict:
         return self.session_info
 
     def handle_manual_current_limit(self):
@@ -177,6 +365,7 @@ class Manager:
                 self.logger.info(f"setting new limit {limit}")
                 if 0 <= limit <= 23:
                     self.manual_power_limit = limit * 1000
+                    self.persist_session()
                     return flask.jsonify(limit=limit)
                 else:
                     flask.abort(400, "the limit must be between 4 and 23 kW.")
@@ -192,6 +381,7 @@ class Manager:
             self.logger.info(f"setting new mode {mode}")
             if mode in ("manual", "automatic"):
                 self.automatic_mode = mode == "automatic"
+                self.persist_session()
                 return flask.jsonify(mode=mode)
             else:
                 flask.abort(400, "you must specify the mode")
@@ -204,26 +394,15 @@ class Manager:
         else:
             flask.abort(405)
 
-    def handle_meters(self, client=None):
-        tesla_power_readings = self.get_tesla_power_reading()
-        wallbox_power: float = self.get_wallbox_power(client)
-        house = float(tesla_power_readings["load"]["instant_power"]) - wallbox_power
-        return {"house": house,
-                "wallbox": wallbox_power,
-                "solar": float(tesla_power_readings["solar"]["instant_power"]),
-                "grid": float(tesla_power_readings["site"]["instant_power"]),
-                "battery": float(tesla_power_readings["battery"]["instant_power"])
-                }
-
-    def get_tesla_power_reading(self):
-        logging.captureWarnings(True)
-        resp = requests.get(f'{self.config["powerwall_host"]}/api/meters/aggregates', verify=False)
-        logging.captureWarnings(False)
-        return json.loads(resp.text)
-
-    def get_wallbox_power(self, client) -> float:
-        if client is None:
-            client = flask.current_app.test_client()
-        self.logger.info("Getting wallbox power")
-        resp = client.get('/keba/power')
-        return float(json.loads(resp.data)["power"])
+    def handle_meters(self):
+        try:
+            return dict(self.sampler.get_snapshot().meters)
+        except StaleSnapshotError as e:
+            flask.abort(503, str(e))
+
+    def get_snapshot(self):
+        # the control loop waits up to one freshness period for the sampler instead of failing right away
+        return self.sampler.get_snapshot(timeout=self.sampler.max_age)
+
+    def get_meters(self) -> dict:
+        return dict(self.get_snapshot().meters)
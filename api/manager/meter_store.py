@@ -0,0 +1,229 @@
+import logging
+import math
+import mmap
+import pathlib
+import struct
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+
+class Segment:
+    """
+    A single file of fixed width records in ascending timestamp order. The first field of every record is the
+    float64 timestamp. Records are read through a read only memory map which is remapped when the file has grown.
+    """
+    def __init__(self, path: pathlib.Path, record: struct.Struct):
+        self.path: pathlib.Path = path
+        self.record: struct.Struct = record
+        self.length: int = self.path.stat().st_size // self.record.size if self.path.exists() else 0
+
+        self.mm: Optional[mmap.mmap] = None
+        self.mapped_length: int = 0
+
+    def __len__(self):
+        return self.length
+
+    def view(self) -> mmap.mmap:
+        if self.mm is None or self.mapped_length != self.length:
+            self.close()
+            with open(self.path, "rb") as fp:
+                self.mm = mmap.mmap(fp.fileno(), self.length * self.record.size, access=mmap.ACCESS_READ)
+            self.mapped_length = self.length
+        return self.mm
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def timestamp(self, idx: int) -> float:
+        return struct.unpack_from("<d", self.view(), idx * self.record.size)[0]
+
+    def read(self, idx: int) -> tuple:
+        return self.record.unpack_from(self.view(), idx * self.record.size)
+
+    def bisect(self, timestamp: float) -> int:
+        """
+        :return: the index of the first record with a timestamp larger than timestamp
+        """
+        lo, hi = 0, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class SegmentStore:
+    """
+    An append-only time series of fixed width binary records, split into segment files of at most
+    records_per_segment records. Once more than max_segments segments exist the oldest one is deleted.
+    Appended records are buffered and written once max_pending of them are pending or a reader needs them, so an
+    append costs no system call. A crash loses at most max_pending records.
+    """
+    def __init__(self, directory: pathlib.Path, record_format: str, logger: logging.Logger,
+                 records_per_segment: int = 86400, max_segments: int = 90, max_pending: int = 60):
+        self.directory: pathlib.Path = directory
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.record = struct.Struct(record_format)
+        self.logger = logger
+
+        self.records_per_segment: int = records_per_segment
+        self.max_segments: int = max_segments
+        self.max_pending: int = max_pending
+
+        self.lock = threading.Lock()
+        self.segments: List[Segment] = [Segment(path, self.record)
+                                        for path in sorted(self.directory.glob("segment_*.bin"))]
+        if not self.segments:
+            self.segments.append(self.create_segment(0))
+
+        self.truncate_partial_record(self.segments[-1])
+        self.fp = open(self.segments[-1].path, "ab")
+        self.pending: int = 0  # records in the buffer of fp, which readers do not see yet
+        last = self.last()
+        self.last_timestamp: float = last[0] if last is not None else -math.inf
+
+    def create_segment(self, number: int) -> Segment:
+        path = self.directory / f"segment_{number:08d}.bin"
+        path.touch()
+        return Segment(path, self.record)
+
+    def truncate_partial_record(self, segment: Segment):
+        # a crash in the middle of an append can leave an incomplete record at the end of the active segment
+        size = segment.path.stat().st_size
+        if size % self.record.size != 0:
+            self.logger.warning(f"Dropping incomplete record at the end of {segment.path}")
+            with open(segment.path, "r+b") as fp:
+                fp.truncate(len(segment) * self.record.size)
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments) + self.pending
+
+    def last(self) -> Optional[tuple]:
+        with self.lock:
+            self.write_pending()
+            for segment in reversed(self.segments):
+                if len(segment) > 0:
+                    return segment.read(len(segment) - 1)
+        return None
+
+    def append(self, values: tuple):
+        with self.lock:
+            if values[0] < self.last_timestamp:
+                self.logger.warning(f"Ignoring record with timestamp {values[0]} older than the latest record")
+                return
+
+            if len(self.segments[-1]) + self.pending >= self.records_per_segment:
+                self.rotate()
+
+            self.fp.write(self.record.pack(*values))
+            self.last_timestamp = values[0]
+            self.pending += 1
+            if self.pending >= self.max_pending:
+                self.write_pending()
+
+    def flush(self):
+        """
+        write the buffered records to the active segment.
+        """
+        with self.lock:
+            self.write_pending()
+
+    def write_pending(self):
+        # the caller holds the lock
+        if self.pending > 0:
+            self.fp.flush()
+            self.segments[-1].length += self.pending
+            self.pending = 0
+
+    def rotate(self) -> Segment:
+        self.write_pending()
+        self.fp.close()
+        number = int(self.segments[-1].path.stem.split("_")[1]) + 1
+        self.segments.append(self.create_segment(number))
+        self.fp = open(self.segments[-1].path, "ab")
+
+        while len(self.segments) > self.max_segments:
+            expired = self.segments.pop(0)
+            expired.close()
+            expired.path.unlink()
+            self.logger.info(f"Deleted expired segment {expired.path}")
+        return self.segments[-1]
+
+    def query(self, start: float, end: float = None) -> List[tuple]:
+        """
+        return all records with start < timestamp <= end in ascending timestamp order.
+        """
+        with self.lock:
+            self.write_pending()
+            records = []
+            for segment, first in self.find_segments(start):
+                for idx in range(first, len(segment)):
+                    record = segment.read(idx)
+                    if end is not None and record[0] > end:
+                        return records
+                    records.append(record)
+            return records
+
+    def iterate(self, start: float, end: float = None, chunk_size: int = 4096) -> Iterator[tuple]:
+        """
+        yield all records with start < timestamp <= end in ascending timestamp order without loading them into memory
+        at once. The lock is only held while a chunk of chunk_size records is read, so appends are not blocked by a
+        slow consumer.
+        """
+        with self.lock:
+            self.write_pending()
+            segments = self.find_segments(start)
+
+        for segment, first in segments:
+            idx = first
+            while True:
+                with self.lock:
+                    if segment not in self.segments:
+                        # the segment expired in the meantime
+                        break
+                    chunk = [segment.read(i) for i in range(idx, min(idx + chunk_size, len(segment)))]
+                if not chunk:
+                    break
+                idx += len(chunk)
+                for record in chunk:
+                    if end is not None and record[0] > end:
+                        return
+                    yield record
+
+    def find_segments(self, start: float) -> List[Tuple[Segment, int]]:
+        """
+        :return: every segment with records after start and the index of its first such record
+        """
+        segments = [segment for segment in self.segments if len(segment) > 0]
+        # skip every segment that ends before the requested range
+        lo, hi = 0, len(segments)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if segments[mid].timestamp(len(segments[mid]) - 1) <= start:
+                lo = mid + 1
+            else:
+                hi = mid
+        return [(segment, segment.bisect(start)) for segment in segments[lo:]]
+
+    def latest(self, count: int) -> List[tuple]:
+        with self.lock:
+            self.write_pending()
+            records: List[tuple] = []
+            for segment in reversed(self.segments):
+                first = max(0, len(segment) - (count - len(records)))
+                records = [segment.read(idx) for idx in range(first, len(segment))] + records
+                if len(records) >= count:
+                    break
+            return records
+
+    def time_range(self) -> Tuple[Optional[float], Optional[float]]:
+        with self.lock:
+            self.write_pending()
+            segments = [segment for segment in self.segments if len(segment) > 0]
+            if not segments:
+                return None, None
+            return segments[0].timestamp(0), segments[-1].timestamp(len(segments[-1]) - 1)
@@ -0,0 +1,79 @@
+import logging
+import math
+import pathlib
+from typing import List, Optional, Sequence
+
+from .meter_store import SegmentStore
+
+
+class RollupTier:
+    """
+    Downsamples a stream of meter samples into buckets of a fixed resolution and stores the minimum, mean and maximum
+    of every meter per bucket. A bucket is written once the first sample of the next bucket arrives.
+    """
+    segment_days = 30
+
+    def __init__(self, directory: pathlib.Path, resolution: int, meters: Sequence[str], logger: logging.Logger,
+                 retention_days: int):
+        self.resolution: int = resolution
+        self.meters: Sequence[str] = meters
+        self.retention_days: int = retention_days
+        self.logger = logger
+
+        # bucket start, sample count and the minimum, mean and maximum of every meter
+        record_format = "<dI" + "f" * (3 * len(self.meters))
+        self.store = SegmentStore(directory / f"rollup_{self.resolution}", record_format, self.logger,
+                                  records_per_segment=86400 // self.resolution * self.segment_days,
+                                  max_segments=math.ceil(retention_days / self.segment_days) + 1)
+
+        last = self.store.last()
+        self.flushed_until: float = last[0] if last is not None else -math.inf
+
+        self.bucket_start: Optional[float] = None
+        self.count: int = 0
+        self.mins: List[float] = []
+        self.sums: List[float] = []
+        self.maxs: List[float] = []
+
+    def add(self, timestamp: float, values: Sequence[float]):
+        bucket_start = timestamp - timestamp % self.resolution
+        if bucket_start <= self.flushed_until or (self.bucket_start is not None and bucket_start < self.bucket_start):
+            # the bucket was already written
+            return
+
+        if bucket_start != self.bucket_start:
+            self.flush()
+            self.bucket_start = bucket_start
+            self.count = 0
+            self.mins = list(values)
+            self.sums = [0.] * len(values)
+            self.maxs = list(values)
+
+        self.count += 1
+        for idx, value in enumerate(values):
+            self.sums[idx] += value
+            if value < self.mins[idx]:
+                self.mins[idx] = value
+            elif value > self.maxs[idx]:
+                self.maxs[idx] = value
+
+    def flush(self):
+        if self.bucket_start is None or self.count == 0:
+            return
+        means = [total / self.count for total in self.sums]
+        self.store.append((self.bucket_start, self.count, *self.mins, *means, *self.maxs))
+        self.flushed_until = self.bucket_start
+
+    def to_entry(self, record: tuple) -> dict:
+        n = len(self.meters)
+        entry = dict(zip(self.meters, record[2 + n:2 + 2 * n]))
+        entry["timestamp"] = record[0]
+        entry["min"] = dict(zip(self.meters, record[2:2 + n]))
+        entry["max"] = dict(zip(self.meters, record[2 + 2 * n:]))
+        return entry
+
+    def query(self, start: float, end: float = None) -> List[dict]:
+        """
+        return all completed buckets which start after start and at or before end.
+        """
+        return [self.to_entry(record) for record in self.store.query(start, end)]
@@ -0,0 +1,2 @@
+from .meter_sampler import MeterSampler, MeterSnapshot, StaleSnapshotError
+from .powerwall_client import CircuitOpenError, PowerwallClient
\ No newline at end of file
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from types import MappingProxyType
+from typing import Callable, List, Mapping, NamedTuple, Optional
+
+from .powerwall_client import CircuitOpenError, PowerwallClient
+from ...utils.metrics import METRICS, TICK_DURATION, TICK_JITTER
+
+
+class StaleSnapshotError(RuntimeError):
+    pass
+
+
+class MeterSnapshot(NamedTuple):
+    timestamp: float
+    meters: Mapping[str, float]  # house, wallbox, solar, grid and battery power in Watts
+    powerwall_soe: float  # percentage
+
+
+class MeterSampler:
+    """
+    Polls the Powerwall gateway and the wallbox at a fixed rate and publishes the readings as an immutable
+    MeterSnapshot. HTTP handlers and control loops read the latest snapshot instead of querying the devices.
+    """
+    def __init__(self, config: dict, keba, logger: logging.Logger):
+        self.config = config
+        self.logger: logging.Logger = logger
+        self.keba = keba
+
+        self.sample_interval: float = self.config.get("sample_interval", 1.0)  # seconds
+        self.max_age: float = self.config.get("max_age", 10.0)  # seconds
+        self.powerwall = PowerwallClient(self.config, logger.getChild("powerwall"))
+
+        self.snapshot: Optional[MeterSnapshot] = None
+        self.subscribers: List[Callable[[MeterSnapshot], None]] = []
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.daemon: Optional[threading.Thread] = None
+
+    def start(self):
+        self.stopped.clear()
+        self.daemon = threading.Thread(target=self.background_update, name="meter_sampler_daemon", daemon=True)
+        self.daemon.start()
+        METRICS.watch_thread(self.daemon)
+
+    def stop(self, timeout: float = None):
+        self.stopped.set()
+        if self.daemon is not None:
+            self.daemon.join(timeout)
+        self.powerwall.close()
+
+    def is_healthy(self) -> bool:
+        return self.is_fresh(self.snapshot, self.max_age)
+
+    def subscribe(self, callback: Callable[[MeterSnapshot], None]):
+        """
+        register a callback which is called from the sampler thread with every new snapshot.
+        """
+        self.subscribers.append(callback)
+
+    def get_snapshot(self, max_age: float = None, timeout: float = 0.) -> MeterSnapshot:
+        """
+        return the latest snapshot if it is at most max_age seconds old.
+        :param max_age: the freshness bound in seconds, defaults to the configured max_age
+        :param timeout: the time in seconds to wait for a fresh snapshot if the current one is stale
+        :return: the latest MeterSnapshot
+        """
+        if max_age is None:
+            max_age = self.max_age
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.is_fresh(self.snapshot, max_age), timeout=timeout)
+            snapshot = self.snapshot
+
+        if not self.is_fresh(snapshot, max_age):
+            raise StaleSnapshotError(f"No meter snapshot younger than {max_age} seconds available")
+        return snapshot
+
+    @staticmethod
+    def is_fresh(snapshot: Optional[MeterSnapshot], max_age: float) -> bool:
+        return snapshot is not None and time.time() - snapshot.timestamp <= max_age
+
+    def background_update(self):
+        next_sample = time.time()
+        while not self.stopped.is_set():
+            TICK_JITTER.observe(max(0., time.time() - next_sample), loop="meter_sampler")
+            try:
+                with TICK_DURATION.time(loop="meter_sampler"):
+                    self.publish(self.sample())
+            except CircuitOpenError as e:
+                # the client logged when it stopped calling the gateway
+                self.logger.debug(str(e))
+            except Exception:
+                self.logger.exception("Could not sample meters")
+
+            next_sample += self.sample_interval
+            delay = next_sample - time.time()
+            if delay > 0:
+                self.stopped.wait(delay)
+            else:
+                # we fell behind, skip the missed samples instead of bursting to catch up
+                next_sample = time.time()
+
+    def sample(self) -> MeterSnapshot:
+        aggregates, soe = self.powerwall.get_meters()
+        wallbox = float(self.keba.get_power()["power"])
+        return self.to_snapshot(time.time(), aggregates, soe, wallbox)
+
+    @staticmethod
+    def to_snapshot(timestamp: float, aggregates: dict, soe: dict, wallbox: float) -> MeterSnapshot:
+        """
+        build a snapshot from the json of the Powerwall aggregates and soe endpoints and the wallbox power in Watts.
+        """
+        meters = {"house": float(aggregates["load"]["instant_power"]) - wallbox,
+                  "wallbox": wallbox,
+                  "solar": float(aggregates["solar"]["instant_power"]),
+                  "grid": float(aggregates["site"]["instant_power"]),
+                  "battery": float(aggregates["battery"]["instant_power"])
+                  }
+        return MeterSnapshot(timestamp, MappingProxyType(meters), float(soe["percentage"]))
+
+    def publish(self, snapshot: MeterSnapshot):
+        with self.condition:
+            self.snapshot = snapshot
+            self.condition.notify_all()
+
+        for callback in self.subscribers:
+            try:
+                callback(snapshot)
+            except Exception:
+                self.logger.exception(f"Meter snapshot subscriber {callback} failed")
@@ -0,0 +1,134 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+import requests
+import urllib3
+
+from ...utils.metrics import METRICS, track_call
+
+AGGREGATES_PATH = "/api/meters/aggregates"
+SOE_PATH = "/api/system_status/soe"
+
+CIRCUIT_OPEN = METRICS.gauge("flow_circuit_open", "1 while the calls to a device are skipped after repeated failures",
+                             ("target",))
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class PowerwallClient:
+    """
+    Talks to the local API of the Powerwall gateway over one keep-alive session, so consecutive samples reuse their
+    TCP and TLS connections instead of repeating the handshake with the gateway. Failed calls are retried with an
+    exponential backoff. Once failure_threshold calls in a row failed the circuit opens: calls fail right away for
+    reset_timeout seconds, then a single call probes whether the gateway is back.
+    """
+    def __init__(self, config: dict, logger: logging.Logger):
+        self.host: str = config["powerwall_host"]
+        self.logger: logging.Logger = logger
+        self.timeout: Tuple[float, float] = (config.get("connect_timeout", 2.0),
+                                             config.get("request_timeout", 5.0))  # seconds
+        self.retries: int = config.get("retries", 1)
+        self.backoff: float = config.get("retry_backoff", 0.1)  # seconds before the first retry, doubled afterwards
+        self.failure_threshold: int = config.get("failure_threshold", 3)
+        self.reset_timeout: float = config.get("reset_timeout", 30.)  # seconds
+
+        self.session = requests.Session()
+        # the gateway is on the local network, so the proxies and CA bundles of the environment are not looked up on
+        # every call. A CA bundle from the environment would also override verify
+        self.session.trust_env = False
+        # the gateway presents a self signed certificate, which can be pinned with powerwall_certificate
+        self.session.verify = config.get("powerwall_certificate", False)
+        if self.session.verify is False:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        # get_meters uses two connections at once
+        self.session.mount(self.host, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+        self.lock = threading.Lock()
+        self.failures: int = 0
+        self.opened_at: Optional[float] = None
+        self.probing: bool = False
+
+    def close(self):
+        """
+        close the pooled connections. The client reconnects on its next call.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.session.close()
+
+    def get_json(self, path: str) -> dict:
+        return self.guarded(lambda: self.fetch(path))
+
+    def get_meters(self) -> Tuple[dict, dict]:
+        """
+        fetch the aggregates and the soe concurrently, so a sample takes one round trip to the gateway instead of two.
+        :return: the json of the aggregates and the soe endpoints
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="powerwall")
+
+        def fetch_both():
+            soe = self.executor.submit(self.fetch, SOE_PATH)
+            aggregates = self.fetch(AGGREGATES_PATH)
+            return aggregates, soe.result()
+
+        return self.guarded(fetch_both)
+
+    def guarded(self, call: Callable):
+        self.allow()
+        try:
+            result = call()
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True)
+        return result
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"The Powerwall gateway failed {self.failures} times in a row, skipping the "
+                                       f"call")
+            self.probing = True
+
+    def record(self, success: bool):
+        with self.lock:
+            self.probing = False
+            if success:
+                if self.opened_at is not None:
+                    self.logger.info("The Powerwall gateway is reachable again")
+                    CIRCUIT_OPEN.set(0., target="powerwall")
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is None:
+                if self.failures < self.failure_threshold:
+                    return
+                self.logger.warning(f"The Powerwall gateway failed {self.failures} times in a row, pausing the calls "
+                                    f"for {self.reset_timeout:.0f} seconds")
+                CIRCUIT_OPEN.set(1., target="powerwall")
+            # a failed probe keeps the circuit open for another reset_timeout
+            self.opened_at = time.time()
+
+    def fetch(self, path: str) -> dict:
+        for attempt in range(self.retries + 1):
+            try:
+                with track_call("powerwall", path):
+                    response = self.session.get(f"{self.host}{path}", timeout=self.timeout)
+                    response.raise_for_status()
+                    return response.json()
+            except (requests.RequestException, ValueError) as e:
+                if attempt == self.retries:
+                    raise
+                self.logger.debug(f"Retrying {path} after {e}")
+                time.sleep(self.backoff * 2 ** attempt)
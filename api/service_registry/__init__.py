@@ -0,0 +1 @@
+from .service_registry import ServiceRegistry
\ No newline at end of file
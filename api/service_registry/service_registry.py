@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from ...utils.metrics import METRICS
+
+
+class ServiceRegistry:
+    """
+    Maps service names to the module instances of the flow server. Background daemons look up other modules here
+    and call their python methods directly instead of going through the HTTP endpoints.
+    The registry also drives the lifecycle of the services. Constructing a module must not touch the network or start
+    threads, this is done by its start() method, which the registry calls for all services on a background thread
+    so the web server is ready before any device or cloud API answered. stop() ends the background work again.
+    """
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.services: Dict[str, Any] = {}
+        self.states: Dict[str, str] = {}  # service name -> created, starting, running, failed or stopped
+        self.errors: Dict[str, str] = {}
+        self.startup_durations: Dict[str, float] = {}  # seconds
+        self.startup: Optional[threading.Thread] = None
+
+    def register(self, name: str, service: Any):
+        if name in self.services:
+            raise ValueError(f"A service named {name} is already registered")
+        self.services[name] = service
+        self.states[name] = "created"
+        self.logger.info(f"Registered service {name}")
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return self.services[name]
+        except KeyError:
+            raise KeyError(f"Unknown service {name}. Registered services are {list(self.services.keys())}")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.services
+
+    def start(self, name: str):
+        """
+        start a single service. A service that fails to start is marked as failed, the others are not affected.
+        """
+        service = self.services[name]
+        self.states[name] = "starting"
+        start = time.perf_counter()
+        try:
+            if hasattr(service, "start"):
+                service.start()
+        except Exception as e:
+            self.states[name] = "failed"
+            self.errors[name] = str(e)
+            self.logger.exception(f"Could not start service {name}")
+            return
+        finally:
+            self.startup_durations[name] = time.perf_counter() - start
+        self.states[name] = "running"
+        self.errors.pop(name, None)
+        self.logger.info(f"Started service {name} in {self.startup_durations[name] * 1000:.0f} ms")
+
+    def start_all(self, background: bool = True):
+        """
+        start all services in the order of their registration.
+        :param background: start the services on a separate thread and return right away
+        """
+        names = [name for name, state in self.states.items() if state in ("created", "stopped")]
+        if not background:
+            for name in names:
+                self.start(name)
+            return
+
+        def start_services():
+            for name in names:
+                self.start(name)
+
+        self.startup = threading.Thread(target=start_services, name="service_startup", daemon=True)
+        self.startup.start()
+
+    def stop_all(self, timeout: float = 5.):
+        """
+        stop all running services in the reverse order of their registration.
+        :param timeout: the time in seconds to wait for the threads of every service
+        """
+        for name in reversed(list(self.services)):
+            if self.states[name] not in ("starting", "running"):
+                continue
+            service = self.services[name]
+            try:
+                if hasattr(service, "stop"):
+                    service.stop(timeout)
+            except Exception:
+                self.logger.exception(f"Could not stop service {name}")
+            self.states[name] = "stopped"
+        self.logger.info("Stopped all services")
+
+    def is_healthy(self, name: str) -> bool:
+        service = self.services[name]
+        if self.states[name] != "running":
+            return False
+        return service.is_healthy() if hasattr(service, "is_healthy") else True
+
+    def health(self) -> dict:
+        """
+        the lifecycle state and the health of every service. A running service is healthy if it has no is_healthy
+        method or if it reports itself as healthy, e.g. once it reached its device.
+        """
+        return {name: {"state": state,
+                       "healthy": self.is_healthy(name),
+                       "startup_seconds": self.startup_durations.get(name),
+                       "error": self.errors.get(name)}
+                for name, state in list(self.states.items())}
+
+    def service_health(self) -> Dict[tuple, float]:
+        return {(name,): float(self.is_healthy(name)) for name in list(self.services)}
+
+    def watch_health(self):
+        """
+        report the health of every service in flow_service_healthy.
+        """
+        METRICS.gauge("flow_service_healthy", "1 if the service is running and healthy", ("service",),
+                      callback=self.service_health)
@@ -0,0 +1,2 @@
+from .simulation import Simulation, SimulationResult, STRATEGIES
+from .replay import read_trace
\ No newline at end of file
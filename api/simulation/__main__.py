@@ -0,0 +1,44 @@
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import tempfile
+
+from . import Simulation, read_trace
+from ...utils import get_cache_dir, get_config, init_logging
+
+
+def parse_date(value: str) -> float:
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the recorded meter history against a charging strategy.")
+    parser.add_argument("--strategy", help="the control strategy, defaults to the configured one")
+    parser.add_argument("--history", help="the meter_history directory, defaults to the one in the cache")
+    parser.add_argument("--resolution", type=int, help="replay a rollup tier instead of the raw samples, e.g. 10")
+    parser.add_argument("--start", type=parse_date, help="ISO date of the first replayed sample")
+    parser.add_argument("--end", type=parse_date, help="ISO date of the last replayed sample")
+    args = parser.parse_args()
+
+    config = get_config()
+    sim_config = dict(config["modules"].get("simulation", {}))
+    if args.strategy is not None:
+        sim_config["strategy"] = args.strategy
+    strategy = sim_config.get("strategy", "manager")
+    # the simulation section can carry the configuration of a strategy which is not configured as a module
+    strategy_config = sim_config.get(strategy, config["modules"].get(strategy, {}))
+    history = args.history or str(get_cache_dir() / "meter_history")
+    resolution = args.resolution if args.resolution is not None else sim_config.get("resolution")
+
+    with tempfile.TemporaryDirectory() as cache:
+        # the controllers persist their state, keep it away from the cache of the live server
+        os.environ["FLOW_CACHE_DIR"] = cache
+        simulation = Simulation(sim_config, strategy_config, config["vehicles"], init_logging("simulation"))
+        result = simulation.run(read_trace(pathlib.Path(history), resolution, args.start, args.end))
+    print(json.dumps(dict(result._asdict(), speedup=result.speedup), indent=4))
+
+
+if __name__ == '__main__':
+    main()
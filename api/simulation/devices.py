@@ -0,0 +1,196 @@
+import logging
+from math import sqrt
+from typing import Dict, List, Optional, Tuple
+
+from ...utils import Clock
+
+
+class VirtualClock(Clock):
+    """
+    A clock which only moves when the simulation advances it. Sleeping advances the clock instead of blocking.
+    """
+    def __init__(self, timestamp: float = 0.):
+        self.timestamp: float = timestamp
+
+    def time(self) -> float:
+        return self.timestamp
+
+    def sleep(self, seconds: float):
+        self.timestamp += seconds
+
+    def advance_to(self, timestamp: float):
+        self.timestamp = max(self.timestamp, timestamp)
+
+
+class SimulatedPowerwall:
+    """
+    Stands in for the aggregates and soe endpoints of the Powerwall gateway. The house and solar power are taken from
+    the replayed trace, while the battery and the grid balance the power drawn by the simulated wallbox.
+    Power values follow the sign convention of the gateway: a positive battery power discharges the battery and a
+    positive site power imports from the grid.
+    """
+    def __init__(self, capacity: float, max_power: float, soe: float):
+        self.capacity: float = capacity  # Wh
+        self.max_power: float = max_power  # W
+        self.soe: float = soe  # percentage
+
+        self.house: float = 0.
+        self.solar: float = 0.
+        self.wallbox: float = 0.
+        self.battery: float = 0.
+        self.grid: float = 0.
+
+    def update(self, house: float, solar: float, wallbox: float, dt: float):
+        """
+        balance the site for the next dt seconds and integrate the state of energy of the battery.
+        """
+        self.house, self.solar, self.wallbox = house, solar, wallbox
+
+        excess = solar - house - wallbox
+        if excess >= 0:
+            room = (100. - self.soe) / 100. * self.capacity * 3600 / dt
+            self.battery = -min(excess, self.max_power, room)
+        else:
+            available = self.soe / 100. * self.capacity * 3600 / dt
+            self.battery = min(-excess, self.max_power, available)
+        self.grid = house + wallbox - solar - self.battery
+
+        self.soe -= self.battery * dt / 3600 / self.capacity * 100.
+        self.soe = min(100., max(0., self.soe))
+
+    def get_aggregates(self) -> dict:
+        return {"load": {"instant_power": self.house + self.wallbox},
+                "solar": {"instant_power": self.solar},
+                "site": {"instant_power": self.grid},
+                "battery": {"instant_power": self.battery}}
+
+    def get_soe(self) -> dict:
+        return {"percentage": self.soe}
+
+
+class SimulatedVehicle:
+    """
+    Stands in for the connected drive cache. Like the BMW backend, the reported state of charge only follows the
+    battery every state_interval seconds.
+    """
+    def __init__(self, alias: str, capacity: float, max_power: float, clock: Clock, state_interval: float = 600.):
+        self.alias: str = alias
+        self.capacity: float = capacity  # Wh
+        self.max_power: float = max_power  # W
+        self.clock: Clock = clock
+        self.state_interval: float = state_interval  # seconds
+
+        self.soc: float = 0.  # percentage
+        self.reported_soc: float = 0.
+        self.reported_at: float = -float("inf")
+
+    def plug_in(self, soc: float):
+        self.soc = soc
+        self.report()
+
+    def report(self):
+        self.reported_soc = float(int(self.soc))
+        self.reported_at = self.clock.time()
+
+    def charge(self, power: float, dt: float) -> float:
+        """
+        charge with at most power Watts for dt seconds.
+        :return: the power the vehicle accepted in Watts
+        """
+        room = (100. - self.soc) / 100. * self.capacity * 3600 / dt
+        accepted = max(0., min(power, self.max_power, room))
+        self.soc = min(100., self.soc + accepted * dt / 3600 / self.capacity * 100.)
+        return accepted
+
+    def get_vehicle_state(self, alias: str, allow_cache: bool = True) -> dict:
+        if alias != self.alias:
+            raise KeyError(f"Unknown vehicle {alias}")
+        if self.clock.time() - self.reported_at >= self.state_interval:
+            self.report()
+        return {"chargingLevelHv": self.reported_soc, "timestamp": self.reported_at}
+
+
+class SimulatedWallbox:
+    """
+    Stands in for the Keba wallbox and answers with the UDP reports 1, 2, 3, 100 and the session history 101-130 of a
+    KC-P30. A new current limit becomes active after the requested delay, like the currtime command of the wallbox.
+    """
+    voltage = 384.  # effective voltage of the three phases, see Manager.power_to_phase_current
+
+    def __init__(self, vehicles: List[dict], clock: Clock, logger: logging.Logger):
+        self.vehicles: Dict[str, dict] = {vehicle["rfid_token"]: vehicle for vehicle in vehicles}
+        self.clock: Clock = clock
+        self.logger: logging.Logger = logger
+
+        self.vehicle: Optional[SimulatedVehicle] = None
+        self.rfid_tag: str = ""
+        self.session_id: int = 0
+        self.started: float = 0.
+        self.energy: float = 0.  # Wh charged in the current session
+
+        self.current_limit: int = 0  # mA
+        self.pending: Optional[Tuple[float, int]] = None  # activation time and current limit
+        self.power: float = 0.  # W
+        self.limit_changes: int = 0
+        self.history: List[dict] = []  # the finished sessions, from new to old
+
+    def plug_in(self, vehicle: SimulatedVehicle, rfid_tag: str):
+        self.vehicle = vehicle
+        self.rfid_tag = rfid_tag
+        self.session_id += 1
+        self.started = self.clock.time()
+        self.energy = 0.
+
+    def unplug(self):
+        if self.vehicle is not None:
+            session = dict(self.get_report(100), **{"ended[s]": int(self.clock.time()), "reason": 1})
+            self.history = [session] + self.history[:29]
+        self.vehicle = None
+        self.power = 0.
+
+    def update(self, dt: float) -> float:
+        """
+        charge the connected vehicle for the next dt seconds.
+        :return: the charging power in Watts
+        """
+        if self.pending is not None and self.pending[0] <= self.clock.time():
+            if self.pending[1] != self.current_limit:
+                self.limit_changes += 1
+            self.current_limit = self.pending[1]
+            self.pending = None
+
+        self.power = 0.
+        if self.vehicle is not None and self.current_limit >= 6000:
+            self.power = self.vehicle.charge(sqrt(3) * self.voltage * self.current_limit / 1000, dt)
+        self.energy += self.power * dt / 3600
+        return self.power
+
+    def set_current(self, current, delay):
+        self.pending = (self.clock.time() + float(delay or 0), int(current))
+
+    def get_report(self, report_id: int) -> dict:
+        if report_id == 1:
+            return {"ID": "1", "Product": "KC-P30-EC240422-E00", "Serial": "00000000", "Firmware": "simulated"}
+        if report_id == 2:
+            return {"ID": "2", "State": 3 if self.power > 0 else 2, "Plug": 7 if self.vehicle is not None else 1,
+                    "Curr timer": self.current_limit, "Max curr": 32000}
+        if report_id == 3:
+            return {"ID": "3", "P": int(self.power * 1000), "E pres": int(self.energy * 10)}
+        if report_id == 100:
+            return {"ID": "100", "Session ID": self.session_id, "RFID tag": self.rfid_tag,
+                    "E pres": int(self.energy * 10), "started[s]": int(self.started), "ended[s]": 0, "reason": 0}
+        if 101 <= report_id <= 130:
+            if report_id - 101 < len(self.history):
+                return dict(self.history[report_id - 101], ID=str(report_id))
+            return {"ID": str(report_id), "Session ID": -1}
+        raise ValueError(f"The simulated wallbox does not provide report {report_id}")
+
+    def get_power(self) -> dict:
+        return {"power": self.power, "current_limit": self.current_limit}
+
+    def get_session(self) -> dict:
+        report = self.get_report(100)
+        vehicle = self.vehicles.get(report["RFID tag"], None)
+        report["vehicle name"] = vehicle["name"] if vehicle is not None else "Unbekannt"
+        report["vehicle alias"] = vehicle["alias"] if vehicle is not None else "Unbekannt"
+        return report
@@ -0,0 +1,78 @@
+import logging
+import pathlib
+import struct
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from .devices import SimulatedPowerwall, SimulatedWallbox
+from ..manager.manager import MeterHistory
+from ..manager.meter_store import Segment
+from ..meter_sampler import MeterSampler, MeterSnapshot, StaleSnapshotError
+from ...utils import Clock
+
+
+def read_trace(directory: pathlib.Path, resolution: int = None, start: float = None,
+               end: float = None) -> Iterator[Tuple[float, Dict[str, float]]]:
+    """
+    yield the recorded meter values of a meter history directory in ascending timestamp order. The segment files are
+    only read, so the history of a running server can be replayed.
+    :param directory: the meter_history directory in the cache
+    :param resolution: the resolution of the rollup tier to replay, None replays the raw samples
+    :param start: the exclusive lower bound of the timestamps
+    :param end: the inclusive upper bound of the timestamps
+    :return: the timestamp and the power of every meter in Watts
+    """
+    meters = MeterHistory.meters
+    if resolution is None:
+        record = struct.Struct("<d" + "f" * len(meters))
+        first = 1  # timestamp, values
+    else:
+        directory = directory / f"rollup_{resolution}"
+        record = struct.Struct("<dI" + "f" * (3 * len(meters)))
+        first = 2 + len(meters)  # bucket start, count, minima, means, maxima
+
+    for path in sorted(directory.glob("segment_*.bin")):
+        segment = Segment(path, record)
+        try:
+            if len(segment) == 0 or (start is not None and segment.timestamp(len(segment) - 1) <= start):
+                continue
+            for idx in range(0 if start is None else segment.bisect(start), len(segment)):
+                values = segment.read(idx)
+                if end is not None and values[0] > end:
+                    return
+                yield values[0], dict(zip(meters, values[first:first + len(meters)]))
+        finally:
+            segment.close()
+
+
+class ReplaySampler:
+    """
+    Replaces the MeterSampler in a simulation. It samples the simulated Powerwall and wallbox on the virtual clock
+    and offers the read interface of the MeterSampler to the controllers. Snapshots are not passed to subscribers,
+    so the simulated run does not end up in the meter history.
+    """
+    def __init__(self, powerwall: SimulatedPowerwall, wallbox: SimulatedWallbox, clock: Clock,
+                 logger: logging.Logger, max_age: float = 10.):
+        self.powerwall: SimulatedPowerwall = powerwall
+        self.wallbox: SimulatedWallbox = wallbox
+        self.clock: Clock = clock
+        self.logger: logging.Logger = logger
+        self.max_age: float = max_age
+
+        self.snapshot: Optional[MeterSnapshot] = None
+
+    def subscribe(self, callback: Callable[[MeterSnapshot], None]):
+        self.logger.debug(f"Not publishing simulated snapshots to {callback}")
+
+    def sample(self):
+        self.snapshot = MeterSampler.to_snapshot(self.clock.time(), self.powerwall.get_aggregates(),
+                                                 self.powerwall.get_soe(), self.wallbox.get_power()["power"])
+
+    def get_snapshot(self, max_age: float = None, timeout: float = 0.) -> MeterSnapshot:
+        if max_age is None:
+            max_age = self.max_age
+        if not self.is_fresh(self.snapshot, max_age):
+            raise StaleSnapshotError(f"No meter snapshot younger than {max_age} seconds available")
+        return self.snapshot
+
+    def is_fresh(self, snapshot: Optional[MeterSnapshot], max_age: float) -> bool:
+        return snapshot is not None and self.clock.time() - snapshot.timestamp <= max_age
@@ -0,0 +1,198 @@
+import logging
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .devices import SimulatedPowerwall, SimulatedVehicle, SimulatedWallbox, VirtualClock
+from .replay import ReplaySampler
+from ..charge_manager import ChargeManager
+from ..manager import Manager
+from ..service_registry import ServiceRegistry
+
+
+class SimulationResult(NamedTuple):
+    simulated_seconds: float
+    wall_seconds: float
+    ticks: int
+    failed_ticks: int
+    sessions: int
+    charged_energy: float  # Wh
+    charged_from_grid: float  # Wh
+    grid_import: float  # Wh
+    grid_export: float  # Wh
+    limit_changes: int
+    mean_departure_soc: Optional[float]  # percentage
+    missed_targets: int  # departures below the target soc
+
+    @property
+    def speedup(self) -> float:
+        return self.simulated_seconds / max(self.wall_seconds, 1e-9)
+
+
+class ManagerStrategy:
+    """
+    Runs the hysteresis on the Powerwall soe of the Manager.
+    """
+    def __init__(self, config: dict, vehicles: List[dict], sampler: ReplaySampler, services: ServiceRegistry,
+                 clock: VirtualClock, logger: logging.Logger):
+        self.manager = Manager(dict(config, control_loop="external"), vehicles, sampler, services, logger, clock)
+        self.manager.start()
+        self.tick_interval: float = self.manager.tick_interval
+
+    def step(self):
+        self.manager.update_session(self.manager.services["keba"].get_session())
+        self.manager.control_step()
+
+
+class ChargeManagerStrategy:
+    """
+    Runs the excess tracking of the ChargeManager. The ChargeManager does not send its target to the wallbox yet, so
+    the strategy converts the target power into the current limit.
+    """
+    def __init__(self, config: dict, vehicles: List[dict], sampler: ReplaySampler, services: ServiceRegistry,
+                 clock: VirtualClock, logger: logging.Logger):
+        self.charge_manager = ChargeManager(dict(config, control_loop="external"), vehicles, sampler, services,
+                                            logger, clock)
+        self.charge_manager.start()
+        self.services: ServiceRegistry = services
+        self.tick_interval: float = config["power_read_interval"]
+        self.reads_per_update: int = max(1, round(config["wallbox_update_interval"] / config["power_read_interval"]))
+        self.reads: int = 0
+
+    def step(self):
+        if self.reads == 0:
+            self.charge_manager.target.update_target_time()
+        self.charge_manager.get_power_readings()
+        self.reads += 1
+
+        if self.reads == self.reads_per_update:
+            self.reads = 0
+            self.charge_manager.update_wallbox_target_power()
+            self.charge_manager.send_wallbox_target()
+            current = 1000 * Manager.power_to_phase_current(self.charge_manager.wallbox_target_power)
+            self.services["keba"].set_current(int(current), 1)
+
+
+STRATEGIES = {"manager": ManagerStrategy, "charge_manager": ChargeManagerStrategy}
+
+
+class Simulation:
+    """
+    Replays a recorded meter trace on a virtual clock against a control strategy. The Powerwall, the wallbox and the
+    vehicle are replaced by local models, and the clock jumps from step to step instead of sleeping, so months of
+    history are simulated in seconds.
+    The vehicle is plugged in every day at arrival_hour with arrival_soc and leaves at departure_hour.
+    """
+    def __init__(self, config: dict, strategy_config: dict, vehicles: List[dict], logger: logging.Logger):
+        self.config = config
+        self.logger: logging.Logger = logger
+        self.clock = VirtualClock()
+
+        vehicle_config = self.config.get("vehicle", {})
+        vehicle = [vehicle for vehicle in vehicles if vehicle.get("charge_management", False)][0]
+        self.rfid_tag: str = vehicle_config.get("rfid_tag", vehicle["rfid_token"])
+        self.arrival_hour: int = vehicle_config.get("arrival_hour", 17)
+        self.departure_hour: int = vehicle_config.get("departure_hour", 7)
+        self.arrival_soc: float = vehicle_config.get("arrival_soc", 40.)  # percentage
+        self.target_soc: float = vehicle_config.get("target_soc", 60.)  # percentage
+        self.vehicle = SimulatedVehicle(vehicle["alias"], vehicle_config.get("capacity", 37900.),
+                                        vehicle_config.get("max_power", 7400.), self.clock,
+                                        vehicle_config.get("state_interval", 600.))
+
+        powerwall_config = self.config.get("powerwall", {})
+        self.powerwall = SimulatedPowerwall(powerwall_config.get("capacity", 13500.),
+                                            powerwall_config.get("max_power", 5000.),
+                                            powerwall_config.get("initial_soe", 50.))
+        self.wallbox = SimulatedWallbox(vehicles, self.clock, self.logger.getChild("wallbox"))
+        self.sampler = ReplaySampler(self.powerwall, self.wallbox, self.clock, self.logger.getChild("sampler"),
+                                     self.config.get("max_age", 10.))
+
+        self.services = ServiceRegistry(self.logger.getChild("service_registry"))
+        self.services.register("keba", self.wallbox)
+        self.services.register("connected_drive_cache", self.vehicle)
+        self.services.register("meter_sampler", self.sampler)
+
+        strategy = self.config.get("strategy", "manager")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy}, choose one of {list(STRATEGIES.keys())}")
+        self.strategy = STRATEGIES[strategy](strategy_config, vehicles, self.sampler, self.services, self.clock,
+                                             self.logger.getChild(strategy))
+
+        self.step_size: float = self.config.get("step", self.strategy.tick_interval)  # seconds
+        # longer gaps in the trace are skipped instead of holding the last values
+        self.max_gap: float = self.config.get("max_gap", 900.)  # seconds
+
+    def is_plugged_in(self) -> bool:
+        hour = self.clock.now().hour
+        if self.arrival_hour <= self.departure_hour:
+            return self.arrival_hour <= hour < self.departure_hour
+        return hour >= self.arrival_hour or hour < self.departure_hour
+
+    def run(self, trace: Iterable[Tuple[float, Dict[str, float]]]) -> SimulationResult:
+        started = time.perf_counter()
+        simulated = charged = charged_from_grid = grid_import = grid_export = 0.
+        ticks = failed_ticks = sessions = 0
+        departure_socs: List[float] = []
+        next_tick = None
+
+        records = iter(trace)
+        record = next(records, None)
+        if record is None:
+            raise ValueError("The trace is empty")
+        self.clock.timestamp = record[0]
+        upcoming = next(records, None)
+
+        while True:
+            # hold the values of the current record until the clock reaches the next one
+            while upcoming is not None and upcoming[0] <= self.clock.time():
+                record, upcoming = upcoming, next(records, None)
+            if upcoming is None:
+                break
+            if upcoming[0] - record[0] > self.max_gap:
+                self.logger.info(f"Skipping a gap of {upcoming[0] - record[0]:.0f} seconds in the trace")
+                self.clock.timestamp = upcoming[0]
+                next_tick = None
+                continue
+
+            plugged_in = self.is_plugged_in()
+            if plugged_in and self.wallbox.vehicle is None:
+                self.vehicle.plug_in(self.arrival_soc)
+                self.wallbox.plug_in(self.vehicle, self.rfid_tag)
+                sessions += 1
+            elif not plugged_in and self.wallbox.vehicle is not None:
+                self.wallbox.unplug()
+                departure_socs.append(self.vehicle.soc)
+
+            meters = record[1]
+            wallbox = self.wallbox.update(self.step_size)
+            self.powerwall.update(meters["house"], meters["solar"], wallbox, self.step_size)
+            self.sampler.sample()
+
+            if next_tick is None or next_tick <= self.clock.time():
+                next_tick = self.clock.time() + self.strategy.tick_interval
+                ticks += 1
+                try:
+                    self.strategy.step()
+                except Exception:
+                    self.logger.exception(f"Tick at {self.clock.now()} failed")
+                    failed_ticks += 1
+
+            simulated += self.step_size
+            charged += wallbox * self.step_size / 3600
+            charged_from_grid += min(wallbox, max(self.powerwall.grid, 0.)) * self.step_size / 3600
+            grid_import += max(self.powerwall.grid, 0.) * self.step_size / 3600
+            grid_export += max(-self.powerwall.grid, 0.) * self.step_size / 3600
+            self.clock.sleep(self.step_size)
+
+        mean_departure_soc = sum(departure_socs) / len(departure_socs) if departure_socs else None
+        return SimulationResult(simulated_seconds=simulated,
+                                wall_seconds=time.perf_counter() - started,
+                                ticks=ticks,
+                                failed_ticks=failed_ticks,
+                                sessions=sessions,
+                                charged_energy=charged,
+                                charged_from_grid=charged_from_grid,
+                                grid_import=grid_import,
+                                grid_export=grid_export,
+                                limit_changes=self.wallbox.limit_changes,
+                                mean_departure_soc=mean_departure_soc,
+                                missed_targets=sum(soc < self.target_soc for soc in departure_socs))
@@ -0,0 +1 @@
+from .telemetry_stream import TelemetryStream
\ No newline at end of file
@@ -0,0 +1,99 @@
+import json
+import logging
+import threading
+from typing import Optional, Set
+
+import flask
+
+from ..meter_sampler import MeterSampler, MeterSnapshot
+from ..service_registry import ServiceRegistry
+
+
+class StreamClient:
+    """
+    Holds the latest undelivered message of one connected client. A client that is slower than the sampler skips
+    the intermediate messages instead of queueing them, so slow clients neither block the sampler nor grow memory.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.message: Optional[bytes] = None
+        self.dropped: int = 0
+
+    def offer(self, message: bytes):
+        with self.condition:
+            if self.message is not None:
+                self.dropped += 1
+            self.message = message
+            self.condition.notify()
+
+    def next(self, timeout: float) -> Optional[bytes]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.message is not None, timeout=timeout)
+            message, self.message = self.message, None
+            return message
+
+
+class TelemetryStream:
+    """
+    Pushes one multiplexed update of the meters, the powerwall soe, the manager mode and session and the wallbox
+    power to every connected dashboard as Server-Sent Events each time the sampler publishes a new snapshot.
+    The update is serialized once and shared by all clients.
+    """
+    def __init__(self, config: dict, sampler: MeterSampler, services: ServiceRegistry, logger: logging.Logger):
+        self.config = config
+        self.services: ServiceRegistry = services
+        self.logger = logger
+
+        self.max_clients: int = self.config.get("max_clients", 32)
+        self.keepalive_interval: float = self.config.get("keepalive_interval", 15.)  # seconds
+
+        self.lock = threading.Lock()
+        self.clients: Set[StreamClient] = set()
+        sampler.subscribe(self.publish)
+
+    def attach_endpoints(self, app: flask.Flask):
+        app.add_url_rule("/stream", "telemetry_stream", self.handle_stream, methods=["GET"])
+        self.logger.info("Attached endpoints.")
+
+    def publish(self, snapshot: MeterSnapshot):
+        with self.lock:
+            clients = list(self.clients)
+        if not clients:
+            return
+
+        manager = self.services["manager"]
+        session = manager.get_session()
+        update = {"timestamp": snapshot.timestamp,
+                  "meters": dict(snapshot.meters),
+                  "powerwall": {"percentage": snapshot.powerwall_soe},
+                  "mode": {"mode": "automatic" if manager.automatic_mode else "manual"},
+                  "session": None if session is None else dict(session),
+                  "wallbox": {"power": snapshot.meters["wallbox"]}
+                  }
+        message = f"id: {snapshot.timestamp}\nevent: telemetry\ndata: {json.dumps(update)}\n\n".encode()
+        for client in clients:
+            client.offer(message)
+
+    def handle_stream(self):
+        client = StreamClient()
+        with self.lock:
+            if len(self.clients) >= self.max_clients:
+                flask.abort(503, f"The telemetry stream is limited to {self.max_clients} clients")
+            self.clients.add(client)
+            count = len(self.clients)
+        self.logger.info(f"Telemetry client connected, {count} clients in total")
+
+        def events():
+            try:
+                # tell the browser how long to wait before reconnecting
+                yield b"retry: 5000\n\n"
+                while True:
+                    message = client.next(self.keepalive_interval)
+                    yield b": keepalive\n\n" if message is None else message
+            finally:
+                with self.lock:
+                    self.clients.discard(client)
+                self.logger.info(f"Telemetry client disconnected after skipping {client.dropped} updates")
+
+        return flask.Response(events(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,43 +1,106 @@
+import atexit
 import json
 
 import urllib3
 
-from flask import Flask, send_from_directory, render_template
+from flask import Flask, Response, jsonify, send_from_directory
 
 from .api.manager import Manager
+from .api.charge_manager import ChargeManager
 from .api.connected_drive_cache import ConnectedDriveCache
 from .api.audi_cache import AudiCache
 from .api.keba_rest import KebaP30
 from .api.billing import Billing
-from .utils import init_logging, get_site_map, reboot_server, get_config
+from .api.coordinator import LoadCoordinator
+from .api.meter_sampler import MeterSampler
+from .api.service_registry import ServiceRegistry
+from .api.telemetry_stream import TelemetryStream
+from .pages import attach_pages
+from .utils import configure_logging, init_logging, get_site_map, reboot_server, get_config
+from .utils.metrics import METRICS, instrument_app
+
+config = get_config()
+configure_logging(config.get("logging", {}))
 
 LOGGER = init_logging("flow_server")
 LOGGER.info("Flow server is starting...")
 urllib3.disable_warnings()
 LOGGER.critical("Disabled urllib3 warnings!")
-
-
-config = get_config()
 LOGGER.info(json.dumps(config, indent=4))
 
 
 app = Flask(__name__)
+instrument_app(app)
+attach_pages(app, config["vehicles"], LOGGER)
+services = ServiceRegistry(init_logging("service_registry"))
+services.watch_health()
 
 connected_drive_cache = ConnectedDriveCache(config["modules"]["connected_drive_cache"], config["vehicles"],
                                             init_logging("connected_drive_cache"))
-manager = Manager(config["modules"]["manager"], app, init_logging("manager"))
+services.register("connected_drive_cache", connected_drive_cache)
 
 keba_api = KebaP30(config["modules"]["keba_rest"], config["vehicles"], init_logging("keba_rest"))
+services.register("keba", keba_api)
+
+# additional wallboxes are only controlled by the coordinator and do not get their own endpoints
+for name, wallbox_config in config["modules"]["keba_rest"].get("wallboxes", {}).items():
+    services.register(f"keba_{name}", KebaP30(dict(config["modules"]["keba_rest"], **wallbox_config),
+                                              config["vehicles"], init_logging(f"keba_rest_{name}")))
+
+meter_sampler_config = config["modules"].get("meter_sampler")
+if meter_sampler_config is None:
+    # configs written before the meter sampler existed keep the Powerwall in the manager section
+    if "powerwall_host" not in config["modules"]["manager"]:
+        raise KeyError("The config has no Powerwall host. Add a meter_sampler section to the modules with the "
+                       "powerwall_host, see sample_config.json")
+    LOGGER.warning("The config has no meter_sampler section, using the powerwall_host of the manager section. "
+                   "Move it to a meter_sampler section, see sample_config.json")
+    meter_sampler_config = {"powerwall_host": config["modules"]["manager"]["powerwall_host"]}
+meter_sampler = MeterSampler(meter_sampler_config, keba_api, init_logging("meter_sampler"))
+services.register("meter_sampler", meter_sampler)
+
+if "coordinator" in config["modules"]:
+    # the coordinator sets the current limits of all wallboxes, including the one of the manager
+    config["modules"]["manager"]["control_loop"] = "external"
+manager = Manager(config["modules"]["manager"], config["vehicles"], meter_sampler, services, init_logging("manager"))
+services.register("manager", manager)
+
+# the charge manager plans the charging power, it is started after the manager whose history it learns from
+charge_manager = None
+if "charge_manager" in config["modules"]:
+    charge_manager = ChargeManager(config["modules"]["charge_manager"], config["vehicles"], meter_sampler, services,
+                                   init_logging("charge_manager"))
+    services.register("charge_manager", charge_manager)
 
 audi_cache = AudiCache({}, config["vehicles"], init_logging("audi_cache"))
 
-billing = Billing(config["modules"]["billing"], config["vehicles"], app, init_logging("billing"))
+billing = Billing(config["modules"]["billing"], config["vehicles"], services, init_logging("billing"))
+services.register("billing", billing)
+
+coordinator = None
+if "coordinator" in config["modules"]:
+    coordinator = LoadCoordinator(config["modules"]["coordinator"], config["vehicles"], meter_sampler, services,
+                                  init_logging("coordinator"))
+    services.register("coordinator", coordinator)
+
+telemetry_stream = TelemetryStream(config["modules"].get("telemetry_stream", {}), meter_sampler, services,
+                                   init_logging("telemetry_stream"))
 
 connected_drive_cache.attach_endpoints(app)
 audi_cache.attach_endpoints(app)
 keba_api.attach_endpoints(app)
 manager.attach_endpoints(app)
 billing.attach_endpoints(app)
+telemetry_stream.attach_endpoints(app)
+if charge_manager is not None:
+    charge_manager.attach_endpoints(app)
+if coordinator is not None:
+    coordinator.attach_endpoints(app)
+
+# the modules connect to their devices and start their threads in the background, the endpoints are available right
+# away and report 503 until the data they need arrived
+services.start_all()
+atexit.register(services.stop_all)
 
 
 @app.route('/sitemap')
@@ -46,28 +109,21 @@ def handle_sitemap():
     return get_site_map(app)
 
 
+@app.route('/health')
+def handle_health():
+    health = services.health()
+    healthy = all(service["healthy"] for service in health.values())
+    return jsonify(healthy=healthy, services=health), 200 if healthy else 503
+
+
+@app.route('/metrics')
+def handle_metrics():
+    return Response(METRICS.expose(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/dev/restart')
 def handle_restart():
     LOGGER.info("Received reboot request.")
     reboot_server()
     return None
 
-
-@app.route('/dynamic')
-def handle_dynamic():
-    LOGGER.info("Received dynamic request.")
-
-    return render_template("index.html", vehicles=config["vehicles"])
-
-
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
-def handle_default(path):
-    LOGGER.info(path)
-    if path == "":
-        LOGGER.info("sent default static file")
-        return render_template("index.html", vehicles=config["vehicles"])
-    else:
-        return app.send_static_file(path)
-
-
@@ -0,0 +1,209 @@
+import http.server
+import json
+import logging
+import math
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from ..api.simulation.devices import SimulatedPowerwall, SimulatedVehicle, SimulatedWallbox, VirtualClock
+from ..utils import Clock
+
+# a transparent 1x1 png for the vehicle thumbnail
+THUMBNAIL = bytes.fromhex("89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+                          "0000000d49444154789c6360000002000001e221bc330000000049454e44ae426082")
+
+
+def create_certificate(directory: str) -> Optional[Tuple[str, str]]:
+    """
+    create a self signed certificate with the openssl command line tool, like the one of the Powerwall gateway.
+    :return: the paths of the certificate and the key or None if openssl is not available
+    """
+    if shutil.which("openssl") is None:
+        return None
+    cert, key = os.path.join(directory, "powerwall.crt"), os.path.join(directory, "powerwall.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+                    "-days", "1", "-subj", "/CN=powerwall"], check=True, capture_output=True)
+    return cert, key
+
+
+class FakePowerwall:
+    """
+    Serves the aggregates and soe endpoints of the Powerwall gateway over HTTPS from a SimulatedPowerwall, with a
+    fixed latency per request.
+    """
+    def __init__(self, powerwall: SimulatedPowerwall, lock: threading.Lock, address: Tuple[str, int],
+                 latency: float, certificate: Optional[Tuple[str, str]]):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep the connections alive like the gateway does, without waiting for delayed acks between the
+            # header and the body
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with lock:
+                    if self.path == "/api/meters/aggregates":
+                        body = powerwall.get_aggregates()
+                    elif self.path == "/api/system_status/soe":
+                        body = powerwall.get_soe()
+                    else:
+                        body = None
+                time.sleep(fake.latency)
+                if body is None:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.latency: float = latency  # seconds
+        self.server = http.server.ThreadingHTTPServer(address, Handler)
+        self.scheme = "http"
+        if certificate is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*certificate)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+            self.scheme = "https"
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"{self.scheme}://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake_powerwall", daemon=True).start()
+
+
+class FakeKeba:
+    """
+    Answers the UDP commands "report N" and "currtime CURRENT DELAY" of a Keba P30 from a SimulatedWallbox. Like the
+    wallbox, it processes one datagram at a time and replies to the sender.
+    """
+    def __init__(self, wallbox: SimulatedWallbox, lock: threading.Lock, address: Tuple[str, int], latency: float,
+                 logger: logging.Logger):
+        self.wallbox: SimulatedWallbox = wallbox
+        self.lock = lock
+        self.latency: float = latency  # seconds
+        self.logger: logging.Logger = logger
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+
+    def start(self):
+        threading.Thread(target=self.serve, name="fake_keba", daemon=True).start()
+
+    def serve(self):
+        while True:
+            data, sender = self.socket.recvfrom(1024)
+            time.sleep(self.latency)
+            try:
+                self.socket.sendto(self.handle(data.decode().strip()).encode(), sender)
+            except Exception:
+                self.logger.exception(f"Could not answer {data}")
+
+    def handle(self, command: str) -> str:
+        parts = command.split()
+        with self.lock:
+            if parts[0] == "report":
+                return json.dumps(self.wallbox.get_report(int(parts[1])))
+            if parts[0] == "currtime":
+                self.wallbox.set_current(int(parts[1]), int(parts[2]) if len(parts) > 2 else 0)
+                return "TCH-OK :done"
+        return "TCH-ERR :unknown command"
+
+
+class FakeVehicleState:
+    def __init__(self, attributes: dict):
+        self.attributes: dict = attributes
+
+
+class FakeConnectedDriveVehicle:
+    """
+    Stands in for a vehicle of bimmer_connected. Updating the state takes as long as a call to the BMW backend.
+    """
+    def __init__(self, vin: str, latency: float):
+        self.vin: str = vin
+        self.latency: float = latency  # seconds
+        self.state = FakeVehicleState({})
+        self.soc: float = 40.
+
+    def update_state(self):
+        time.sleep(self.latency)
+        self.soc = min(100., self.soc + 1.)
+        self.state = FakeVehicleState({"chargingLevelHv": self.soc, "chargingStatus": "CHARGING",
+                                       "remainingRangeElectric": int(2.5 * self.soc)})
+
+    def get_vehicle_image(self, width: int, height: int, direction) -> bytes:
+        time.sleep(self.latency)
+        return THUMBNAIL
+
+
+class FakeConnectedDriveAccount:
+    """
+    Stands in for the ConnectedDriveAccount of bimmer_connected. It is handed to the ConnectedDriveCache instead of
+    logging into the BMW backend.
+    """
+    server_url = "fake connected drive"
+
+    def __init__(self, vins: List[str], latency: float):
+        self.vehicles: List[FakeConnectedDriveVehicle] = [FakeConnectedDriveVehicle(vin, latency) for vin in vins]
+
+
+def run_devices(vehicles: List[dict], powerwall_address: Tuple[str, int], keba_address: Tuple[str, int],
+                latency: float, urls):
+    """
+    run the fake Powerwall and the fake wallbox and simulate the site once per second. Meant to run in its own
+    process, so the devices do not compete with the load generator for the interpreter.
+    :param urls: a queue which receives the url of the Powerwall once the devices are listening
+    """
+    logger = logging.getLogger("flow.benchmarks.devices")
+    lock = threading.Lock()
+    vehicle_config = [vehicle for vehicle in vehicles if vehicle.get("charge_management", False)][0]
+
+    # record a month of finished sessions for the bills, then switch to the wall clock
+    clock = VirtualClock(time.time() - 30 * 86400)
+    wallbox = SimulatedWallbox(vehicles, clock, logger.getChild("wallbox"))
+    vehicle = SimulatedVehicle(vehicle_config["alias"], 37900., 7400., clock)
+    wallbox.set_current(16000, 0)
+    for _ in range(30):
+        vehicle.plug_in(40.)
+        wallbox.plug_in(vehicle, vehicle_config["rfid_token"])
+        clock.sleep(3600)
+        wallbox.update(3600)
+        wallbox.unplug()
+        clock.sleep(86400 - 3600)
+    wallbox.clock = vehicle.clock = Clock()
+    vehicle.plug_in(40.)
+    wallbox.plug_in(vehicle, vehicle_config["rfid_token"])
+
+    powerwall = SimulatedPowerwall(13500., 5000., 60.)
+    with tempfile.TemporaryDirectory() as directory:
+        fake_powerwall = FakePowerwall(powerwall, lock, powerwall_address, latency, create_certificate(directory))
+    fake_powerwall.start()
+    FakeKeba(wallbox, lock, keba_address, latency, logger.getChild("keba")).start()
+    urls.put(fake_powerwall.url)
+
+    last = time.time()
+    while True:
+        time.sleep(1.)
+        now = time.time()
+        # a clear day with the peak at noon
+        hour = time.localtime(now).tm_hour + time.localtime(now).tm_min / 60
+        solar = max(0., 8000. * math.sin(math.pi * (hour - 6) / 14)) if 6 <= hour <= 20 else 0.
+        with lock:
+            wallbox_power = wallbox.update(now - last)
+            powerwall.update(500. + 200. * math.sin(now / 60), solar, wallbox_power, now - last)
+        last = now
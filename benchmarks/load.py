@@ -0,0 +1,302 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import requests
+
+from .devices import FakeConnectedDriveAccount, run_devices
+from ..utils import get_root_dir
+
+# the routes a dashboard polls and their polling interval in seconds
+DASHBOARD_ROUTES = {"meters": ("/manager/meters", 1.),
+                    "keba_power": ("/keba/power", 1.),
+                    "bmw_state": ("/bmw/state?vehicle={alias}", 10.),
+                    "billing": ("/billing/downloads?year={year}&month={month}&rfid={rfid}&euros_per_kWh=0.3", 60.)}
+TICK_LOOPS = ("meter_sampler", "manager")
+BUCKET_PATTERN = re.compile(r'^(flow_control_loop_(?:jitter|tick)_seconds)_bucket'
+                            r'\{loop="(\w+)",le="([^"]+)"\} (\S+)$')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def serve(port: int, bmw_latency: float, workers: int):
+    """
+    run the flow server with the fake Connected Drive account. Runs in the server process.
+    :param workers: the number of HTTP workers in front of the control plane, 0 to serve from a single process
+    """
+    from werkzeug.serving import make_server
+
+    from ..app import app, connected_drive_cache, config
+    from ..serve import serve as serve_workers
+
+    vins = [vehicle["vin"] for vehicle in config["vehicles"] if vehicle["manufacturer"] == "bmw"]
+    connected_drive_cache.connection = FakeConnectedDriveAccount(vins, bmw_latency)
+    if workers > 0:
+        serve_workers("127.0.0.1", port, workers)
+    else:
+        make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+def create_config(directory: str, config: dict, powerwall_url: str, keba_host: str) -> str:
+    """
+    write the config with the stand-in devices and without the background refresh of the vehicle states, which
+    would log into the BMW backend before the fake account is in place.
+    :return: the path of the config
+    """
+    modules = config["modules"]
+    modules["meter_sampler"]["powerwall_host"] = powerwall_url
+    modules["keba_rest"]["host"] = keba_host
+    modules["connected_drive_cache"]["background_refresh"] = False
+    for module in ("coordinator", "simulation"):
+        modules.pop(module, None)
+    path = os.path.join(directory, "config.json")
+    with open(path, "w") as fp:
+        json.dump(config, fp)
+    return path
+
+
+def read_tick_histograms(base_url: str) -> Dict[Tuple[str, str], Dict[float, float]]:
+    """
+    :return: the cumulative bucket counts of the tick duration and jitter histograms per (metric, loop)
+    """
+    histograms = {}
+    for line in requests.get(f"{base_url}/metrics", timeout=10).text.splitlines():
+        match = BUCKET_PATTERN.match(line)
+        if match is not None and match.group(2) in TICK_LOOPS:
+            bound = float("inf") if match.group(3) == "+Inf" else float(match.group(3))
+            histograms.setdefault((match.group(1), match.group(2)), {})[bound] = float(match.group(4))
+    return histograms
+
+
+def histogram_quantile(before: Dict[float, float], after: Dict[float, float], fraction: float):
+    """
+    the upper bound of the bucket containing the quantile of the observations made between two scrapes.
+    """
+    counts = [(bound, after[bound] - before.get(bound, 0.)) for bound in sorted(after)]
+    total = counts[-1][1] if counts else 0
+    if total <= 0:
+        return None
+    for bound, count in counts:
+        if count >= fraction * total:
+            return bound
+    return None
+
+
+class LoadLevel:
+    """
+    Runs a number of clients against the server for a fixed duration. In the dashboard mode every client polls the
+    routes of a dashboard at their intervals, in the saturate mode the clients request the routes back to back.
+    """
+    def __init__(self, base_url: str, clients: int, duration: float, mode: str, parameters: dict):
+        self.base_url: str = base_url
+        self.clients: int = clients
+        self.duration: float = duration  # seconds
+        self.mode: str = mode
+        self.routes = {name: (path.format(**parameters), interval)
+                       for name, (path, interval) in DASHBOARD_ROUTES.items()}
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {name: [] for name in self.routes}
+        self.errors: Dict[str, int] = {name: 0 for name in self.routes}
+
+    def request(self, session: requests.Session, name: str):
+        start = time.perf_counter()
+        try:
+            ok = session.get(self.base_url + self.routes[name][0], timeout=30).status_code < 500
+        except requests.RequestException:
+            ok = False
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.latencies[name].append(latency)
+            if not ok:
+                self.errors[name] += 1
+
+    def client(self, end: float):
+        session = requests.Session()
+        names = list(self.routes)
+        if self.mode == "saturate":
+            # request the routes in the proportions of a dashboard
+            weights = [1 / interval for _, interval in self.routes.values()]
+            while time.perf_counter() < end:
+                self.request(session, random.choices(names, weights)[0])
+            return
+
+        # dashboards are opened at random times, so their polls are spread out
+        now = time.perf_counter()
+        due = {name: now + random.uniform(0, min(interval, 1.)) for name, (_, interval) in self.routes.items()}
+        while True:
+            name = min(due, key=due.get)
+            if due[name] >= end:
+                return
+            time.sleep(max(0., due[name] - time.perf_counter()))
+            self.request(session, name)
+            due[name] += self.routes[name][1]
+
+    def run(self) -> dict:
+        before = read_tick_histograms(self.base_url)
+        start = time.perf_counter()
+        end = start + self.duration
+        threads = [threading.Thread(target=self.client, args=(end,), daemon=True) for _ in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        after = read_tick_histograms(self.base_url)
+
+        routes = {name: {"count": len(values),
+                         "errors": self.errors[name],
+                         "p50": percentile(values, 0.5) if values else None,
+                         "p99": percentile(values, 0.99) if values else None}
+                  for name, values in self.latencies.items()}
+        ticks = {}
+        for (metric, loop), values in after.items():
+            previous = before.get((metric, loop), {})
+            kind = "jitter" if "jitter" in metric else "duration"
+            ticks[f"{loop}_{kind}"] = {"p50": histogram_quantile(previous, values, 0.5),
+                                       "p99": histogram_quantile(previous, values, 0.99)}
+        return {"clients": self.clients,
+                "throughput": sum(len(values) for values in self.latencies.values()) / elapsed,
+                "routes": routes,
+                "ticks": ticks}
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """
+    :return: a description of every latency, jitter or throughput figure which is worse than the baseline by more
+    than the tolerance
+    """
+    regressions = []
+    baseline = {level["clients"]: level for level in baseline}
+    for level in results:
+        reference = baseline.get(level["clients"])
+        if reference is None:
+            continue
+        prefix = f"{level['clients']} clients"
+        if level["throughput"] < (1 - tolerance) * reference["throughput"]:
+            regressions.append(f"{prefix}: throughput {level['throughput']:.1f}/s < {reference['throughput']:.1f}/s")
+        figures = [(f"{name} p99", route["p99"], reference["routes"].get(name, {}).get("p99"))
+                   for name, route in level["routes"].items()]
+        figures += [(f"{name} p99", tick["p99"], reference["ticks"].get(name, {}).get("p99"))
+                    for name, tick in level["ticks"].items()]
+        for name, value, reference_value in figures:
+            if value is not None and reference_value is not None and value > (1 + tolerance) * reference_value:
+                regressions.append(f"{prefix}: {name} {value * 1000:.1f} ms > {reference_value * 1000:.1f} ms")
+    return regressions
+
+
+def print_table(results: List[dict]):
+    for level in results:
+        print(f"{level['clients']} clients, {level['throughput']:.1f} requests/s")
+        for name, route in level["routes"].items():
+            if route["count"]:
+                print(f"    {name:<12} n={route['count']:<6} errors={route['errors']:<4} "
+                      f"p50={route['p50'] * 1000:8.1f} ms  p99={route['p99'] * 1000:8.1f} ms")
+        for name, tick in sorted(level["ticks"].items()):
+            if tick["p50"] is not None:
+                print(f"    {name:<24} p50<={tick['p50'] * 1000:.1f} ms  p99<={tick['p99'] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the flow server against stand-in devices and report the "
+                                                 "latency of the dashboard routes and the control loop jitter.")
+    parser.add_argument("--clients", default="1,8,32", help="comma separated numbers of concurrent clients")
+    parser.add_argument("--duration", type=float, default=30., help="seconds per number of clients")
+    parser.add_argument("--mode", choices=("dashboard", "saturate"), default="dashboard")
+    parser.add_argument("--device-latency", type=float, default=0.02,
+                        help="seconds the Powerwall and the wallbox take to answer")
+    parser.add_argument("--bmw-latency", type=float, default=2., help="seconds the BMW backend takes to answer")
+    parser.add_argument("--keba-address", default="127.0.0.2:7090",
+                        help="the address of the fake wallbox, the UDP port of the Keba protocol is fixed")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve through this many HTTP workers and a control plane, 0 for a single process")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare the results to a json file written with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="the allowed relative regression")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve, args.bmw_latency, args.workers)
+        return
+
+    with open(get_root_dir() / "sample_config.json", "r") as fp:
+        config = json.load(fp)
+    vehicles = config["vehicles"]
+
+    keba_host, keba_port = args.keba_address.rsplit(":", 1)
+    urls = multiprocessing.Queue()
+    devices = multiprocessing.Process(target=run_devices, daemon=True,
+                                      args=(vehicles, ("127.0.0.1", free_port()), (keba_host, int(keba_port)),
+                                            args.device_latency, urls))
+    devices.start()
+    powerwall_url = urls.get(timeout=30)
+
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    package = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, FLOW_CONFIG=create_config(directory, config, powerwall_url, keba_host),
+                   FLOW_CACHE_DIR=os.path.join(directory, "cache"))
+        server = subprocess.Popen([sys.executable, "-m", f"{package}.benchmarks.load", "--serve", str(port),
+                                   "--bmw-latency", str(args.bmw_latency), "--workers", str(args.workers)],
+                                  cwd=package_parent, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 60
+            while True:
+                try:
+                    if requests.get(f"{base_url}/health", timeout=1).status_code == 200:
+                        break
+                except requests.RequestException:
+                    pass
+                if time.time() > deadline or server.poll() is not None:
+                    raise RuntimeError("The flow server did not become healthy")
+                time.sleep(0.2)
+
+            vehicle = [vehicle for vehicle in vehicles if vehicle["manufacturer"] == "bmw"][0]
+            today = datetime.date.today()
+            parameters = {"alias": vehicle["alias"], "rfid": vehicle["rfid_token"], "year": today.year,
+                          "month": today.month}
+            results = []
+            for clients in [int(value) for value in args.clients.split(",")]:
+                results.append(LoadLevel(base_url, clients, args.duration, args.mode, parameters).run())
+                print_table(results[-1:])
+        finally:
+            server.terminate()
+            server.wait()
+            devices.terminate()
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(results, fp, indent=4)
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
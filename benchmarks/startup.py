@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RESULT_PREFIX = "STARTUP_RESULT "
+
+
+def measure(deadline: float) -> dict:
+    """
+    import the flow server and measure when it answers its first request and when every service became healthy.
+    :param deadline: the time in seconds to wait for the services
+    :return: the durations in seconds since the import started
+    """
+    start = time.perf_counter()
+    from ..app import app, services
+    imported = time.perf_counter() - start
+
+    client = app.test_client()
+    status = client.get("/health").status_code
+    first_response = time.perf_counter() - start
+
+    healthy = {}
+    while len(healthy) < len(services.services) and time.perf_counter() - start < deadline:
+        for name in services.services:
+            if name not in healthy and services.is_healthy(name):
+                healthy[name] = time.perf_counter() - start
+        time.sleep(0.01)
+    services.stop_all(timeout=1.)
+
+    return {"import": imported,
+            "first_response": first_response,
+            "first_status": status,
+            "healthy": {name: healthy.get(name) for name in services.services},
+            "start": dict(services.startup_durations),
+            "states": dict(services.states)}
+
+
+def run(repetitions: int, deadline: float, cache: str = None) -> list:
+    """
+    start the server repetitions times, every time in a fresh interpreter so imports are not cached.
+    """
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    package = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results = []
+    for _ in range(repetitions):
+        with tempfile.TemporaryDirectory() as tmp_cache:
+            env = dict(os.environ, FLOW_CACHE_DIR=cache or tmp_cache)
+            process = subprocess.run([sys.executable, "-m", f"{package}.benchmarks.startup", "--child",
+                                      "--deadline", str(deadline)],
+                                     cwd=package_parent, env=env, capture_output=True, text=True)
+        lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+        if process.returncode != 0 or not lines:
+            raise RuntimeError(f"The server did not start:\n{process.stderr[-2000:]}")
+        results.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+    return results
+
+
+def summarize(results: list) -> dict:
+    def stats(values):
+        values = [value for value in values if value is not None]
+        if not values:
+            return None
+        return {"median": statistics.median(values), "max": max(values)}
+
+    names = results[0]["healthy"].keys()
+    return {"repetitions": len(results),
+            "import": stats([result["import"] for result in results]),
+            "first_response": stats([result["first_response"] for result in results]),
+            "healthy": {name: stats([result["healthy"][name] for result in results]) for name in names},
+            "unhealthy_runs": {name: sum(result["healthy"][name] is None for result in results) for name in names}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long the flow server takes to start. Stop the live "
+                                                 "server before, the benchmark talks to the configured devices.")
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--deadline", type=float, default=10., help="seconds to wait for the services to be healthy")
+    parser.add_argument("--cache", help="the cache directory to start from, defaults to an empty one")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(RESULT_PREFIX + json.dumps(measure(args.deadline)), flush=True)
+        # the background threads of the modules must not keep the child alive
+        os._exit(0)
+    print(json.dumps(summarize(run(args.repetitions, args.deadline, args.cache)), indent=4))
+
+
+if __name__ == '__main__':
+    main()
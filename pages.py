@@ -0,0 +1,44 @@
+import logging
+import pathlib
+
+import flask
+
+from .utils import init_logging
+from .utils.assets import ASSETS
+
+
+def is_page(path: str) -> bool:
+    """
+    whether a request path is answered by the routes of attach_pages, i.e. without any module.
+    """
+    return path in ("/", "/dynamic") or path.startswith("/static/") or path[1:] in ASSETS.static
+
+
+def attach_pages(app: flask.Flask, vehicles: list, logger: logging.Logger):
+    """
+    serve the dashboard and the static files from the asset cache.
+    """
+    ASSETS.logger = init_logging("assets")
+    ASSETS.load_directory(pathlib.Path(app.static_folder))
+    app.jinja_env.globals["asset"] = ASSETS.url
+
+    def send_index():
+        # the page only depends on the vehicles of the config, so it is rendered once
+        return ASSETS.send_page("index.html", lambda: flask.render_template("index.html", vehicles=vehicles))
+
+    @app.route('/dynamic')
+    def handle_dynamic():
+        logger.debug("Received dynamic request.")
+        return send_index()
+
+    @app.route('/', defaults={'path': ''})
+    @app.route('/<path:path>')
+    def handle_default(path):
+        logger.debug(path)
+        if path == "":
+            logger.debug("sent default static file")
+            return send_index()
+        response = ASSETS.send_static(path)
+        if response is None:
+            return app.send_static_file(path)
+        return response
@@ -0,0 +1,83 @@
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+from typing import List
+
+
+def run_worker(host: str, fd: int):
+    """
+    serve HTTP requests on the listening socket inherited from the control plane process.
+    """
+    from werkzeug.serving import make_server
+
+    from .worker import app
+
+    try:
+        make_server(host, 0, app, threaded=True, fd=fd).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def spawn_worker(host: str, listener: socket.socket) -> subprocess.Popen:
+    # a fresh interpreter instead of a fork, the control plane process already runs the threads of the modules
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen([sys.executable, "-m", f"{__package__}.serve", "--host", host,
+                             "--worker-fd", str(listener.fileno())], cwd=package_parent, pass_fds=(listener.fileno(),))
+
+
+def serve(host: str, port: int, workers: int):
+    """
+    run the control plane with the modules in this process and the HTTP workers in child processes, which share one
+    listening socket. Without workers only the control plane runs, e.g. for workers run by another wsgi server.
+    """
+    listener = socket.create_server((host, port)) if workers > 0 else None
+
+    from .api.control_plane import ControlPlane
+    from .app import LOGGER, app, config, services
+
+    logger = LOGGER.getChild("serve")
+    services.register("control_plane", ControlPlane(app, config.get("serving", {}), logger.getChild("control_plane")))
+    services.start("control_plane")
+
+    stopped = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopped.set())
+
+    processes: List[subprocess.Popen] = [spawn_worker(host, listener) for _ in range(workers)]
+    logger.info(f"Serving on {host}:{port} with {workers} workers")
+    try:
+        while not stopped.wait(1.):
+            for index, process in enumerate(processes):
+                if process.poll() is not None:
+                    logger.error(f"Worker {process.pid} exited with {process.returncode}, restarting it")
+                    processes[index] = spawn_worker(host, listener)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        services.stop_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve flow with one control plane process, which owns the devices "
+                                                 "and the control loops, and several HTTP worker processes.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="the number of HTTP workers, 0 to only run the control plane")
+    parser.add_argument("--worker-fd", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_fd is not None:
+        run_worker(args.host, args.worker_fd)
+    else:
+        serve(args.host, args.port, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@ config = {
     vehicle_refresh_interval: 5000,
     wallbox_refresh_interval: 3000,
     power_refresh_interval: 2000,
+    mode_refresh_interval: 2000,
+    power_history_resolution: 60,
+    power_history_points: 120,
     dateFormat: {
         weekday: 'long',
         year: 'numeric',
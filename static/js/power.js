@@ -9,11 +9,7 @@ function updatePowerReadings() {
                 }
                 return response.json();
             })
-            .then(json => {
-                for (let indicator of document.getElementsByClassName("pw-level-indicator")) {
-                        indicator.innerText = Math.round(json["percentage"]);
-                }
-            });
+            .then(json => renderPowerwallLevel(json));
 
     fetch("/manager/meters")
         .then(response => {
@@ -25,40 +21,49 @@ function updatePowerReadings() {
         })
         .then(json => {
             console.log("Received power info from manager");
-            document.getElementById("pr-solar").innerText = (json["solar"] / 1000).toPrecision(2);
-            document.getElementById("pr-house").innerText = (json["house"] / 1000).toPrecision(2);
-            document.getElementById("pr-battery").innerText = (json["battery"] / 1000).toPrecision(2);
-
-            if (Math.abs(json["grid"]) > 80) {
-                document.getElementById("pr-grid").innerText = (json["grid"] / 1000).toPrecision(2);
-                if (json["grid"] < 0) {
-                    document.getElementById("pr-grid").parentElement.classList.add("has-text-success");
-                    document.getElementById("pr-grid").parentElement.classList.remove("has-text-danger");
-                } else {
-                    document.getElementById("pr-grid").parentElement.classList.add("has-text-danger");
-                    document.getElementById("pr-grid").parentElement.classList.remove("has-text-success");
-                }
-            } else {
-                document.getElementById("pr-grid").parentElement.classList.remove("has-text-danger");
-                document.getElementById("pr-grid").parentElement.classList.remove("has-text-success");
-                document.getElementById("pr-grid").innerText = "0.0";
-            }
+            renderPowerReadings(json);
+        }).catch((error) => {
+        console.error('Could not get new power readings:', error);
+    });
 
-            if (json["battery"] < 0) {
-                document.getElementById("pr-battery").parentElement.classList.add("has-text-success");
-                document.getElementById("pr-battery").parentElement.classList.remove("has-text-danger");
-            } else {
-                document.getElementById("pr-battery").parentElement.classList.add("has-text-danger");
-                document.getElementById("pr-battery").parentElement.classList.remove("has-text-success");
-            }
+}
 
+function renderPowerwallLevel(json) {
+    for (let indicator of document.getElementsByClassName("pw-level-indicator")) {
+        indicator.innerText = Math.round(json["percentage"]);
+    }
+}
 
-            document.getElementById("pr-wallbox").innerText = (json["wallbox"] / 1000).toPrecision(2);
+function renderPowerReadings(json) {
+    document.getElementById("pr-solar").innerText = (json["solar"] / 1000).toPrecision(2);
+    document.getElementById("pr-house").innerText = (json["house"] / 1000).toPrecision(2);
+    document.getElementById("pr-battery").innerText = (json["battery"] / 1000).toPrecision(2);
+
+    if (Math.abs(json["grid"]) > 80) {
+        document.getElementById("pr-grid").innerText = (json["grid"] / 1000).toPrecision(2);
+        if (json["grid"] < 0) {
+            document.getElementById("pr-grid").parentElement.classList.add("has-text-success");
+            document.getElementById("pr-grid").parentElement.classList.remove("has-text-danger");
+        } else {
+            document.getElementById("pr-grid").parentElement.classList.add("has-text-danger");
+            document.getElementById("pr-grid").parentElement.classList.remove("has-text-success");
+        }
+    } else {
+        document.getElementById("pr-grid").parentElement.classList.remove("has-text-danger");
+        document.getElementById("pr-grid").parentElement.classList.remove("has-text-success");
+        document.getElementById("pr-grid").innerText = "0.0";
+    }
+
+    if (json["battery"] < 0) {
+        document.getElementById("pr-battery").parentElement.classList.add("has-text-success");
+        document.getElementById("pr-battery").parentElement.classList.remove("has-text-danger");
+    } else {
+        document.getElementById("pr-battery").parentElement.classList.add("has-text-danger");
+        document.getElementById("pr-battery").parentElement.classList.remove("has-text-success");
+    }
 
-        }).catch((error) => {
-        console.error('Could not get new power readings:', error);
-    });
 
+    document.getElementById("pr-wallbox").innerText = (json["wallbox"] / 1000).toPrecision(2);
 }
 
 let ctx = document.getElementById('powerHistoryChart');
@@ -146,8 +151,8 @@ function addData(chart, data) {
             dataset.data.push(entry[datasetNameMap[dataset.label]] / 1000);
         });
     });
-    while (powerHistoryChart.data.length > 100) {
-        removeOldestDataPoint(powerHistoryChart);
+    while (chart.data.labels.length > config["power_history_points"]) {
+        removeOldestDataPoint(chart);
     }
     chart.update();
 }
@@ -162,11 +167,12 @@ function removeOldestDataPoint(chart) {
 
 function updateHistoryChart() {
     let labels = powerHistoryChart.data.labels;
-    let query = "";
+    let resolution = config["power_history_resolution"];
+    let from = Date.now() / 1000 - resolution * config["power_history_points"];
     if (labels.length > 1) {
-        query = "?timestamp=" + labels[labels.length - 1]
+        from = labels[labels.length - 1] / 1000;
     }
-    fetch("/manager/meters/history" + query)
+    fetch("/manager/meters/history?from=" + from + "&resolution=" + resolution)
         .then(response => {
             if (!response.ok) {
                 console.log(response.statusText)
@@ -184,4 +190,4 @@ function updateHistoryChart() {
 }
 
 updateHistoryChart();
-window.setTimeout(updateHistoryChart, 5000)
\ No newline at end of file
+window.setInterval(updateHistoryChart, config["power_history_resolution"] * 1000)
\ No newline at end of file
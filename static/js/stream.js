@@ -0,0 +1,27 @@
+class TelemetryStream {
+    constructor(onUpdate, onConnected, onDisconnected) {
+        this.onUpdate = onUpdate;
+        this.onConnected = onConnected;
+        this.onDisconnected = onDisconnected;
+        this.source = null;
+    }
+
+    connect() {
+        if (!window.EventSource) {
+            console.log("Server-Sent Events are not supported, falling back to polling");
+            this.onDisconnected();
+            return;
+        }
+        this.source = new EventSource("/stream");
+        this.source.onopen = () => {
+            console.log("Connected to telemetry stream");
+            this.onConnected();
+        };
+        this.source.onerror = () => {
+            // the browser reconnects on its own, until then the dashboard polls
+            console.log("Telemetry stream disconnected");
+            this.onDisconnected();
+        };
+        this.source.addEventListener("telemetry", event => this.onUpdate(JSON.parse(event.data)));
+    }
+}
@@ -57,7 +57,7 @@ window.setInterval(function () {
     }
 }, 1000);
 
-window.setInterval(function () {
+function updateMode() {
     fetch("/manager/mode")
         .then(response => {
             if (!response.ok) {
@@ -66,12 +66,16 @@ window.setInterval(function () {
             return response.json()
         })
         .then(json => {
-            document.getElementById("wallbox-mode-toggle").checked = json["mode"] !== "manual";
+            renderMode(json);
             console.log("Received mode info from manager");
         }).catch((error) => {
         console.error('Could not get new manager mode info:', error);
     });
-}, 2000)
+}
+
+function renderMode(json) {
+    document.getElementById("wallbox-mode-toggle").checked = json["mode"] !== "manual";
+}
 
 class WallboxCard {
     constructor() {
@@ -90,12 +94,7 @@ class WallboxCard {
             })
             .then(json => {
                 console.log("Received charging session info from wallbox");
-                if (json["reason"] === 0) {
-                    this.root.getElementsByClassName("vehicle-name-text")[0].innerText = json["vehicle name"];
-                } else {
-                    this.root.getElementsByClassName("vehicle-name-text")[0].innerText = "nicht verbunden";
-                }
-                this.root.getElementsByClassName("wb-session-energy")[0].innerText = json["E pres"] / 10000;
+                this.renderSession(json);
             }).catch((error) => {
             console.error('Could not update wallbox info:', error);
         });
@@ -109,10 +108,23 @@ class WallboxCard {
             })
             .then(json => {
                 console.log("Received power info from wallbox");
-                this.root.getElementsByClassName("wb-momentary-power")[0].innerText = (json["power"] / 1000).toPrecision(2);
+                this.renderPower(json);
 
             }).catch((error) => {
             console.error('Could not update wallbox info:', error);
         });
     }
+
+    renderSession(json) {
+        if (json["reason"] === 0) {
+            this.root.getElementsByClassName("vehicle-name-text")[0].innerText = json["vehicle name"];
+        } else {
+            this.root.getElementsByClassName("vehicle-name-text")[0].innerText = "nicht verbunden";
+        }
+        this.root.getElementsByClassName("wb-session-energy")[0].innerText = json["E pres"] / 10000;
+    }
+
+    renderPower(json) {
+        this.root.getElementsByClassName("wb-momentary-power")[0].innerText = (json["power"] / 1000).toPrecision(2);
+    }
 }
\ No newline at end of file
@@ -0,0 +1,27 @@
+import logging
+import pathlib
+import sys
+import types
+
+import pytest
+
+# the package is imported as flow without running its __init__, which loads the config and starts the app
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+if "flow" not in sys.modules:
+    package = types.ModuleType("flow")
+    package.__path__ = [str(ROOT)]
+    sys.modules["flow"] = package
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch) -> pathlib.Path:
+    """
+    redirect get_cache_dir to a temporary directory.
+    """
+    monkeypatch.setenv("FLOW_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def logger() -> logging.Logger:
+    return logging.getLogger("flow.tests")
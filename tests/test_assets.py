@@ -0,0 +1,94 @@
+import gzip
+import os
+
+import flask
+import pytest
+
+from flow.utils.assets import IMMUTABLE_MAX_AGE, AssetCache, make_asset
+
+SCRIPT = b"function update() { return fetch('/manager/state'); }\n" * 20
+
+
+@pytest.fixture
+def app() -> flask.Flask:
+    return flask.Flask(__name__)
+
+
+@pytest.fixture
+def assets(tmp_path, logger) -> AssetCache:
+    static = tmp_path / "static"
+    (static / "js").mkdir(parents=True)
+    (static / "js" / "app.js").write_bytes(SCRIPT)
+    cache = AssetCache(logger)
+    cache.load_directory(static)
+    return cache
+
+
+def test_small_and_binary_assets_are_not_compressed():
+    assert list(make_asset(b"x" * 100, "text/css").encodings) == ["identity"]
+    assert list(make_asset(os.urandom(1000), "image/png").encodings) == ["identity"]
+    assert gzip.decompress(make_asset(SCRIPT, "application/javascript").encodings["gzip"]) == SCRIPT
+
+
+def test_static_file_is_sent_compressed_and_revalidated(app, assets):
+    with app.test_request_context("/js/app.js", headers={"Accept-Encoding": "gzip"}):
+        response = assets.send_static("js/app.js")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == SCRIPT
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+    with app.test_request_context("/js/app.js", headers={"Accept-Encoding": "gzip",
+                                                         "If-None-Match": response.headers["ETag"]}):
+        assert assets.send_static("js/app.js").status_code == 304
+    with app.test_request_context("/js/app.js", headers={"If-None-Match": response.headers["ETag"]}):
+        # the etag of the gzip encoding does not match the uncompressed body
+        response = assets.send_static("js/app.js")
+    assert response.status_code == 200
+    assert response.get_data() == SCRIPT
+
+
+def test_fingerprinted_url_is_immutable(app, assets):
+    url = assets.url("js/app.js")
+    assert url.startswith("js/app.js?v=")
+    assert assets.url("js/missing.js") == "js/missing.js"
+
+    with app.test_request_context(f"/{url}"):
+        response = assets.send_static("js/app.js")
+    assert response.headers["Cache-Control"] == f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+
+    with app.test_request_context("/js/missing.js"):
+        assert assets.send_static("js/missing.js") is None
+
+
+def test_page_is_rendered_once(app, assets):
+    renders = []
+
+    def render():
+        renders.append(1)
+        return "<html>dashboard</html>"
+
+    for _ in range(3):
+        with app.test_request_context("/"):
+            response = assets.send_page("index.html", render)
+
+    assert len(renders) == 1
+    assert response.get_data() == b"<html>dashboard</html>"
+    assert response.mimetype == "text/html"
+
+
+def test_file_is_reloaded_when_it_changes(app, assets, tmp_path):
+    image = tmp_path / "vehicle.png"
+    image.write_bytes(b"old")
+    with app.test_request_context("/bmw/thumbnail"):
+        first = assets.send_file(image, "image/png", max_age=86400)
+
+    image.write_bytes(b"new")
+    os.utime(image, (0, 0))
+    with app.test_request_context("/bmw/thumbnail", headers={"If-None-Match": first.headers["ETag"]}):
+        second = assets.send_file(image, "image/png", max_age=86400)
+
+    assert first.get_data() == b"old"
+    assert second.status_code == 200
+    assert second.get_data() == b"new"
+    assert second.headers["Cache-Control"] == "public, max-age=86400"
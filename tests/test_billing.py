@@ -0,0 +1,144 @@
+import datetime
+import json
+
+import pytest
+
+from flow.api.billing import Billing
+from flow.api.billing.session_index import SessionIndex
+
+TAG = "0400069ad8648500"
+OTHER_TAG = "0400069ad8648501"
+
+
+def make_report(session_id: int, started: datetime.datetime, energy: int = 10000, rfid_tag: str = TAG,
+                ended: int = None) -> dict:
+    started_at = int(started.timestamp())
+    return {"ID": "100", "Session ID": session_id, "RFID tag": rfid_tag, "E pres": energy, "started[s]": started_at,
+            "ended[s]": started_at + 3600 if ended is None else ended, "reason": 1}
+
+
+@pytest.fixture
+def index(tmp_path, logger) -> SessionIndex:
+    return SessionIndex(tmp_path / "sessions.sqlite3", logger)
+
+
+def test_index_filters_by_month_and_tag_from_new_to_old(index):
+    index.add(make_report(1, datetime.datetime(2024, 1, 5)))
+    index.add(make_report(2, datetime.datetime(2024, 1, 20), rfid_tag=OTHER_TAG))
+    index.add(make_report(3, datetime.datetime(2024, 1, 28)))
+    index.add(make_report(4, datetime.datetime(2024, 2, 1)))
+    index.add(make_report(5, datetime.datetime(2024, 1, 30), energy=0))
+
+    assert [report["Session ID"] for report in index.filter(2024, 1, TAG)] == [3, 1]
+    assert [report["Session ID"] for report in index.filter(2024, 1)] == [3, 2, 1]
+    assert [report["Session ID"] for report in index.filter(rfid_tag=TAG)] == [4, 3, 1]
+    assert 5 in index and 6 not in index
+    assert index.max_session_id() == 5
+
+
+def test_index_replaces_a_session_that_is_added_again(index):
+    index.add(make_report(1, datetime.datetime(2024, 1, 5), energy=100))
+    index.add(make_report(1, datetime.datetime(2024, 1, 5), energy=200))
+
+    assert [report["E pres"] for report in index.filter()] == [200]
+
+
+def test_index_imports_only_new_and_valid_files(index, tmp_path):
+    sessions = tmp_path / "sessions"
+    sessions.mkdir()
+    for session_id in (1, 2):
+        with open(sessions / f"session_{session_id}.json", "w") as fp:
+            json.dump(make_report(session_id, datetime.datetime(2024, 1, session_id)), fp)
+    (sessions / "session_3.json").write_text("{")
+    index.add(make_report(1, datetime.datetime(2024, 1, 1), energy=500))
+
+    index.import_files(sessions)
+
+    assert [(report["Session ID"], report["E pres"]) for report in index.filter()] == [(2, 10000), (1, 500)]
+
+
+class FakeKeba:
+    def __init__(self, latest: dict, history: list):
+        self.reports = {100: latest}
+        for idx in range(101, 131):
+            self.reports[idx] = history[idx - 101] if idx - 101 < len(history) else {"Session ID": -1}
+        self.requested = []
+
+    def get_report(self, report_id: int) -> dict:
+        self.requested.append(report_id)
+        return dict(self.reports[report_id])
+
+
+def make_billing(keba: FakeKeba, logger) -> Billing:
+    billing = Billing({}, [], {"keba": keba}, logger)
+    billing.index.import_files(billing.sessions_cache)
+    billing.watermark = billing.restore_watermark()
+    return billing
+
+
+def test_sync_stores_the_sessions_newer_than_the_watermark(cache_dir, logger):
+    day = datetime.datetime(2024, 3, 1)
+    history = [make_report(session_id, day) for session_id in (12, 11, 10, 9)]
+    running = make_report(13, day, ended=0)
+    billing = make_billing(FakeKeba(running, history), logger)
+    billing.index.add(history[-1])
+    billing.watermark = 9
+
+    billing.update_charging_session_cache()
+
+    assert [report["Session ID"] for report in billing.index.filter()] == [12, 11, 10, 9]
+    assert (cache_dir / "sessions" / "session_12.json").is_file()
+    assert billing.watermark == 12
+    assert json.loads((cache_dir / "billing_sync.json").read_text()) == {"session_id": 12}
+
+
+def test_sync_skips_the_history_while_report_100_is_unchanged(cache_dir, logger):
+    keba = FakeKeba(make_report(5, datetime.datetime(2024, 3, 1), ended=0), [])
+    billing = make_billing(keba, logger)
+    billing.watermark = 4
+
+    billing.update_charging_session_cache()
+    billing.update_charging_session_cache()
+
+    assert keba.requested == [100, 100]
+    assert billing.last_report["Session ID"] == 5
+
+
+def test_finished_session_in_report_100_is_stored_right_away(cache_dir, logger):
+    billing = make_billing(FakeKeba(make_report(5, datetime.datetime(2024, 3, 1)), []), logger)
+    billing.watermark = 4
+
+    billing.update_charging_session_cache()
+
+    assert 5 in billing.index
+    assert billing.watermark == 5
+
+
+def test_failed_watermark_write_is_retried_with_the_next_poll(cache_dir, logger, monkeypatch):
+    day = datetime.datetime(2024, 3, 1)
+    billing = make_billing(FakeKeba(make_report(3, day, ended=0), [make_report(2, day), make_report(1, day)]), logger)
+    write = billing.state.write
+
+    def fail(document):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(billing.state, "write", fail)
+    with pytest.raises(OSError):
+        billing.update_charging_session_cache()
+    assert billing.last_report is None
+
+    monkeypatch.setattr(billing.state, "write", write)
+    billing.update_charging_session_cache()
+    assert billing.last_report["Session ID"] == 3
+    assert json.loads((cache_dir / "billing_sync.json").read_text()) == {"session_id": 2}
+
+
+def test_watermark_is_restored_from_the_state_or_the_index(cache_dir, logger):
+    day = datetime.datetime(2024, 3, 1)
+    keba = FakeKeba(make_report(3, day, ended=0), [make_report(2, day), make_report(1, day)])
+    make_billing(keba, logger).update_charging_session_cache()
+
+    assert make_billing(keba, logger).watermark == 2
+
+    (cache_dir / "billing_sync.json").unlink()
+    assert make_billing(keba, logger).watermark == 2
@@ -0,0 +1,42 @@
+import threading
+
+from flow.api.charge_manager.charge_manager import ChargeManager
+from flow.api.meter_sampler import MeterSnapshot, StaleSnapshotError
+
+METERS = {"house": 500., "wallbox": 0., "solar": 3000., "grid": 0., "battery": 0.}
+
+
+class FlakySampler:
+    """
+    A sampler whose Powerwall is unreachable for the first calls.
+    """
+    def __init__(self, failures: int):
+        self.failures: int = failures
+        self.calls: int = 0
+        self.recovered = threading.Event()
+
+    def get_snapshot(self, max_age: float = None, timeout: float = 0.) -> MeterSnapshot:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise StaleSnapshotError("The Powerwall is unreachable")
+        if self.calls > self.failures + 1:
+            # the first reading after the outage was processed completely
+            self.recovered.set()
+        return MeterSnapshot(1_700_000_000. + self.calls, METERS, 50.)
+
+
+def test_control_loop_survives_an_outage(cache_dir, logger):
+    sampler = FlakySampler(failures=3)
+    config = {"wallbox_update_interval": 0.02, "power_read_interval": 0.01, "power_smoothing_window": 3,
+              "scheduler": "reactive"}
+    manager = ChargeManager(config, [], sampler, {}, logger)
+    manager.update_wallbox_target_power = lambda: None
+    manager.send_wallbox_target = lambda: None
+
+    manager.start()
+    try:
+        assert sampler.recovered.wait(5.)
+        assert manager.daemon.is_alive()
+        assert manager.meter_information == METERS
+    finally:
+        manager.stop(5.)
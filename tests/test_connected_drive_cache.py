@@ -0,0 +1,43 @@
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("bimmer_connected")
+
+from flow.api.connected_drive_cache.connected_drive_cache import ConnectedDriveCache  # noqa: E402
+
+VEHICLES = [{"manufacturer": "bmw", "vin": f"WBY{idx:014d}", "alias": f"i3_{idx}"} for idx in range(8)]
+
+
+def make_cache(logger) -> ConnectedDriveCache:
+    return ConnectedDriveCache({"max_staleness": 30, "background_refresh": False}, VEHICLES, logger)
+
+
+def test_concurrent_refreshes_persist_a_consistent_snapshot(cache_dir, logger):
+    cache = make_cache(logger)
+    errors = []
+
+    def refresh(vehicle: dict):
+        try:
+            for update in range(50):
+                with cache.state_lock:
+                    cache.vehicle_states[vehicle["vin"]] = {"chargingLevelHv": update}
+                    cache.vehicle_update_timestamps[vehicle["vin"]] = 1_700_000_000. + update
+                cache.persist_states()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=refresh, args=(vehicle,)) for vehicle in VEHICLES]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    snapshot = json.loads((cache_dir / "connected_drive_state.json").read_text())
+    assert {vin: entry["attributes"] for vin, entry in snapshot.items()} == \
+        {vehicle["vin"]: {"chargingLevelHv": 49} for vehicle in VEHICLES}
+
+    restored = make_cache(logger)
+    assert restored.get_vehicle_state("i3_3") == {"chargingLevelHv": 49}
@@ -0,0 +1,55 @@
+import io
+import time
+
+import flask
+import pytest
+
+from flow.api.control_plane import ControlPlane, ControlPlaneClient
+
+
+@pytest.fixture
+def config(tmp_path) -> dict:
+    return {"address": str(tmp_path / "control_plane.sock"), "key_file": str(tmp_path / "control_plane.key"),
+            "timeout": 5.}
+
+
+@pytest.fixture
+def control_plane(config, logger):
+    app = flask.Flask(__name__)
+    app.add_url_rule("/manager/mode", "mode", lambda: {"mode": "automatic"})
+    control_plane = ControlPlane(app, config, logger)
+    control_plane.start()
+    yield control_plane
+    control_plane.stop(1.)
+
+
+def get(client: ControlPlaneClient, path: str):
+    started = []
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "SERVER_NAME": "localhost", "SERVER_PORT": "5000",
+               "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO()}
+    body = b"".join(client.forward(environ, lambda status, headers: started.append(status)))
+    return started[0], body
+
+
+def test_requests_are_forwarded_over_pooled_connections(control_plane, config, logger):
+    client = ControlPlaneClient(config, logger)
+
+    for _ in range(3):
+        status, body = get(client, "/manager/mode")
+        assert status == "200 OK"
+        assert flask.json.loads(body) == {"mode": "automatic"}
+    assert len(control_plane.connections) == 1
+
+
+def test_stop_joins_the_accept_and_connection_threads(control_plane, config, logger):
+    client = ControlPlaneClient(config, logger)
+    get(client, "/manager/mode")
+    threads = [control_plane.daemon, *control_plane.connections.values()]
+
+    started = time.monotonic()
+    control_plane.stop(2.)
+
+    assert time.monotonic() - started < 1.
+    assert not any(thread.is_alive() for thread in threads)
+    assert control_plane.connections == {}
+    assert get(client, "/manager/mode")[0] == "503 SERVICE UNAVAILABLE"
@@ -0,0 +1,48 @@
+import random
+
+from flow.api.coordinator.coordinator import Demand, allocate
+
+
+def test_excess_is_split_evenly_above_the_lower_bounds():
+    demands = [Demand("a", 6000, 32000, (0,)), Demand("b", 6000, 32000, (1,))]
+
+    assert allocate(20000., demands) == {"a": 10000, "b": 10000}
+
+
+def test_capped_demand_passes_its_share_on():
+    demands = [Demand("a", 6000, 8000, (0,)), Demand("b", 6000, 32000, (1,)), Demand("c", 6000, 16000, (2,))]
+
+    assert allocate(40000., demands) == {"a": 8000, "b": 16000, "c": 16000}
+
+
+def test_lowest_priorities_are_dropped_if_the_lower_bounds_do_not_fit():
+    demands = [Demand("a", 6000, 32000, (1, 0.)), Demand("b", 6000, 32000, (0, 50.)),
+               Demand("c", 6000, 32000, (0, 20.))]
+
+    assert allocate(13000., demands) == {"a": 0, "b": 6500, "c": 6500}
+    assert allocate(5000., demands) == {"a": 0, "b": 0, "c": 0}
+    assert allocate(5000., []) == {}
+
+
+def test_allocation_is_feasible_and_max_min_fair():
+    rng = random.Random(7)
+    for _ in range(500):
+        demands = []
+        for idx in range(rng.randint(1, 6)):
+            demands.append(Demand(f"wallbox_{idx}", 6000, rng.randint(6000, 32000), (rng.random(),)))
+        total = rng.uniform(0., 100000.)
+
+        currents = allocate(total, demands)
+
+        by_priority = sorted(demands, key=lambda demand: demand.priority)
+        served = [demand for demand in by_priority if currents[demand.wallbox] > 0]
+        # the served demands are those with the highest priority
+        assert served == by_priority[:len(served)]
+        assert len(served) == len(demands) or sum(demand.lower for demand in by_priority[:len(served) + 1]) > total
+        assert sum(currents.values()) <= total
+        assert all(demand.lower <= currents[demand.wallbox] <= demand.upper for demand in served)
+        # a demand below its upper bound receives at least as much extra current as every other served demand
+        extras = {demand.wallbox: currents[demand.wallbox] - demand.lower for demand in served}
+        for demand in served:
+            if currents[demand.wallbox] < demand.upper - 1:
+                assert extras[demand.wallbox] >= max(extras.values()) - 1
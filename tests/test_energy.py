@@ -0,0 +1,105 @@
+import datetime
+
+import pytest
+
+from flow.api.manager.energy import EnergyIntegrator
+from flow.api.meter_sampler import MeterSnapshot
+from flow.utils.state_store import StateStore
+
+
+def snapshot(timestamp: float, house=0., wallbox=0., solar=0., grid=0., battery=0.) -> MeterSnapshot:
+    return MeterSnapshot(timestamp, {"house": house, "wallbox": wallbox, "solar": solar, "grid": grid,
+                                     "battery": battery}, 50.)
+
+
+def timestamp(day: datetime.date, hour: int, minute: int = 0, second: float = 0.) -> float:
+    return datetime.datetime(day.year, day.month, day.day, hour, minute).timestamp() + second
+
+
+@pytest.fixture
+def state(tmp_path, logger) -> StateStore:
+    return StateStore(tmp_path / "energy.json", logger, flush_delay=60.)
+
+
+DAY = datetime.date(2024, 6, 1)
+NEXT_DAY = DAY + datetime.timedelta(days=1)
+
+
+def test_power_is_integrated_per_meter_and_direction(state, logger):
+    integrator = EnergyIntegrator(state, logger)
+    start = timestamp(DAY, 12)
+    for second in range(0, 3601, 10):
+        integrator.add(snapshot(start + second, house=1000., solar=3000., grid=-1500., battery=-500.))
+
+    [day] = integrator.get_days(DAY, DAY)
+    assert day["date"] == DAY.isoformat()
+    assert day["house"] == pytest.approx(1.)
+    assert day["solar"] == pytest.approx(3.)
+    assert day["grid_export"] == pytest.approx(1.5)
+    assert day["battery_charge"] == pytest.approx(0.5)
+    assert day["grid_import"] == day["battery_discharge"] == 0.
+
+
+def test_interval_across_midnight_belongs_to_the_day_it_ends_on(state, logger):
+    integrator = EnergyIntegrator(state, logger)
+    integrator.add(snapshot(timestamp(DAY, 23, 59, 30), house=3600.))
+    integrator.add(snapshot(timestamp(NEXT_DAY, 0, 0, 10), house=3600.))
+    integrator.add(snapshot(timestamp(NEXT_DAY, 0, 0, 20), house=3600.))
+
+    assert [(day["date"], day["house"]) for day in integrator.get_days(DAY, NEXT_DAY)] == \
+        [(NEXT_DAY.isoformat(), pytest.approx(0.05))]
+    assert integrator.get_days(DAY, DAY) == []
+
+
+def test_gaps_and_backwards_timestamps_are_not_integrated(state, logger):
+    integrator = EnergyIntegrator(state, logger, max_gap=60.)
+    start = timestamp(DAY, 8)
+    for offset in (0., 120., 110., 130.):
+        integrator.add(snapshot(start + offset, house=3600.))
+
+    [day] = integrator.get_days(DAY, DAY)
+    assert day["house"] == pytest.approx(0.02)
+
+
+def test_wallbox_energy_is_attributed_to_the_supplying_sources(state, logger):
+    integrator = EnergyIntegrator(state, logger)
+    start = timestamp(DAY, 12)
+    # 6 kW of solar, 2 kW from the battery and 2 kW from the grid supply the house and the wallbox
+    for second in range(0, 1801, 10):
+        integrator.add(snapshot(start + second, house=10000., wallbox=4000., solar=6000., grid=2000., battery=2000.),
+                       session_id=7)
+
+    session = integrator.get_session(7)
+    assert session["energy"] == pytest.approx(2.)
+    assert session["solar"] == pytest.approx(1.2)
+    assert session["battery"] == pytest.approx(0.4)
+    assert session["grid"] == pytest.approx(0.4)
+    assert integrator.get_session(8) is None
+
+
+def test_days_and_sessions_survive_a_restart(state, tmp_path, logger):
+    integrator = EnergyIntegrator(state, logger)
+    start = timestamp(DAY, 23, 59)
+    for second in range(0, 121, 10):
+        integrator.add(snapshot(start + second, house=3600., wallbox=3600., solar=3600.),
+                       session_id=7 if second < 60 else 8)
+    state.flush()
+
+    restored = EnergyIntegrator(StateStore(tmp_path / "energy.json", logger), logger)
+
+    assert restored.get_days(DAY, NEXT_DAY) == integrator.get_days(DAY, NEXT_DAY)
+    assert [day["date"] for day in restored.get_days(DAY, NEXT_DAY)] == [DAY.isoformat(), NEXT_DAY.isoformat()]
+    assert restored.get_session(7) == integrator.get_session(7)
+    # the interval that ends with the first snapshot of a session belongs to that session
+    assert restored.get_session(7)["energy"] == pytest.approx(0.05)
+    assert restored.get_session(8)["energy"] == pytest.approx(0.07)
+
+
+def test_old_days_are_pruned(state, logger):
+    integrator = EnergyIntegrator(state, logger, retention_days=2)
+    for day in (DAY + datetime.timedelta(days=offset) for offset in range(5)):
+        integrator.add(snapshot(timestamp(day, 12), house=1000.))
+        integrator.add(snapshot(timestamp(day, 12, 0, 10), house=1000.))
+
+    assert [day["date"] for day in integrator.get_days(DAY, DAY + datetime.timedelta(days=4))] == \
+        [(DAY + datetime.timedelta(days=offset)).isoformat() for offset in (2, 3, 4)]
@@ -0,0 +1,70 @@
+import random
+import statistics
+
+import pytest
+
+from flow.api.charge_manager.utils import FilterBank, MovingAverage, MovingAverageFilter, RingBuffer
+
+
+def windows(values, size):
+    return [values[max(0, idx + 1 - size):idx + 1] for idx in range(len(values))]
+
+
+def test_ring_buffer_evicts_the_oldest_value():
+    buffer = RingBuffer(3)
+    assert [buffer.push(value) for value in (1., 2., 3., 4., 5.)] == [None, None, None, 1., 2.]
+    assert len(buffer) == 3
+
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+@pytest.mark.parametrize("kind, reference", [("mean", statistics.fmean), ("median", statistics.median),
+                                             ("min", min), ("max", max)])
+@pytest.mark.parametrize("window_size", [1, 4, 7])
+def test_window_filters_match_the_full_window(kind, reference, window_size):
+    values = [random.Random(window_size).uniform(-5000., 5000.) for _ in range(200)]
+    bank = FilterBank(kind, window_size)
+
+    smoothed = [bank("power", value) for value in values]
+
+    assert smoothed == pytest.approx([reference(window) for window in windows(values, window_size)])
+    assert bank["power"] == smoothed[-1]
+
+
+def test_exponential_filter_starts_at_the_first_value():
+    bank = FilterBank("exponential", 3)
+
+    assert bank("power", 10.) == 10.
+    assert bank("power", 20.) == 15.
+
+
+def test_moving_average_bounds_the_drift_of_the_running_sum(monkeypatch):
+    monkeypatch.setattr(MovingAverage, "resum_interval", 100)
+    window_filter = MovingAverage(10)
+    for idx in range(1000):
+        window_filter(1e15 if idx % 2 else 0.1)
+    for _ in range(100):
+        value = window_filter(1.)
+
+    assert value == 1.
+
+
+def test_filter_bank_keeps_one_filter_per_signal():
+    bank = FilterBank("mean", 2)
+
+    assert bank.update({"solar": 100., "house": 10.}) == {"solar": 100., "house": 10.}
+    assert bank.update({"solar": 200., "house": 30.}) == {"solar": 150., "house": 20.}
+    assert bank.values() == {"solar": 150., "house": 20.}
+
+    with pytest.raises(ValueError):
+        FilterBank("gaussian")
+
+
+def test_moving_average_filter_restarts_when_the_window_changes():
+    moving_average = MovingAverageFilter()
+    for value in (1., 2., 3.):
+        moving_average("power", value, window_size=3)
+
+    assert moving_average("power", 10., window_size=2) == 10.
+    assert moving_average("power", 20., window_size=2) == 15.
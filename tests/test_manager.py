@@ -0,0 +1,38 @@
+import flask
+import pytest
+
+from flow.api.manager.manager import Manager, MeterHistory
+
+START = 1_700_000_000.
+
+
+@pytest.fixture
+def client(cache_dir, logger):
+    manager = Manager({}, [], None, None, logger)
+    manager.history = MeterHistory(logger)
+    for idx in range(10):
+        manager.history.add_entry({meter: float(idx) for meter in MeterHistory.meters}, START + idx)
+    app = flask.Flask(__name__)
+    manager.attach_endpoints(app)
+    return app.test_client()
+
+
+def test_history_between_from_and_to(client):
+    response = client.get(f"/manager/meters/history?from={START + 5.5}&to={START + 8}&resolution=1")
+
+    assert response.status_code == 200
+    assert [entry["timestamp"] for entry in response.json["history"]] == [START + 6, START + 7, START + 8]
+    assert response.json["resolution"] is None
+
+
+def test_history_accepts_the_legacy_timestamp_parameter(client):
+    response = client.get(f"/manager/meters/history?timestamp={START + 7.5}&resolution=1")
+
+    assert response.status_code == 200
+    assert [entry["timestamp"] for entry in response.json["history"]] == [START + 8, START + 9]
+
+
+def test_from_takes_precedence_over_timestamp(client):
+    response = client.get(f"/manager/meters/history?from={START + 8.5}&timestamp={START}&resolution=1")
+
+    assert [entry["timestamp"] for entry in response.json["history"]] == [START + 9]
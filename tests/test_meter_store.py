@@ -0,0 +1,145 @@
+import math
+
+import pytest
+
+from flow.api.manager.manager import MeterHistory
+from flow.api.manager.meter_store import SegmentStore
+from flow.api.manager.rollup import RollupTier
+
+METERS = ("house", "wallbox")
+
+
+@pytest.fixture
+def store(tmp_path, logger) -> SegmentStore:
+    return SegmentStore(tmp_path / "store", "<dff", logger, records_per_segment=10, max_segments=3)
+
+
+def fill(store: SegmentStore, timestamps):
+    for timestamp in timestamps:
+        store.append((float(timestamp), float(timestamp) * 2, 1.))
+
+
+def test_query_returns_the_half_open_range(store):
+    fill(store, range(25))
+
+    assert [record[0] for record in store.query(4., 7.)] == [5., 6., 7.]
+    assert [record[0] for record in store.query(22.)] == [23., 24.]
+    assert store.query(4., 7.)[0] == (5., 10., 1.)
+    assert store.query(24.) == []
+
+
+def test_iterate_matches_query_across_segments_and_chunks(store):
+    fill(store, range(25))
+
+    for start, end in ((-math.inf, None), (3., 21.), (9., 10.), (24., None)):
+        assert list(store.iterate(start, end, chunk_size=4)) == store.query(start, end)
+
+
+def test_iterate_skips_a_segment_which_expired_meanwhile(store):
+    fill(store, range(20))
+    records = store.iterate(-math.inf, chunk_size=4)
+    assert next(records)[0] == 0.
+
+    # the first segment expires once the fourth one is created
+    fill(store, range(20, 31))
+
+    assert [record[0] for record in records][:4] == [1., 2., 3., 10.]
+
+
+def test_append_ignores_older_records(store):
+    fill(store, (1, 2, 3))
+    store.append((2.5, 0., 0.))
+
+    assert [record[0] for record in store.query(-math.inf)] == [1., 2., 3.]
+    assert store.last()[0] == 3.
+
+
+def test_appends_are_buffered_until_they_are_read(store, tmp_path):
+    fill(store, range(3))
+    segment = tmp_path / "store" / "segment_00000000.bin"
+    assert segment.stat().st_size == 0
+
+    assert [record[0] for record in store.latest(2)] == [1., 2.]
+    assert segment.stat().st_size == 3 * store.record.size
+
+
+def test_appends_are_written_once_max_pending_records_are_buffered(tmp_path, logger):
+    store = SegmentStore(tmp_path / "store", "<dff", logger, max_pending=4)
+    fill(store, range(5))
+
+    assert (tmp_path / "store" / "segment_00000000.bin").stat().st_size == 4 * store.record.size
+    assert len(store) == 5
+
+
+def test_rotation_deletes_the_oldest_segments(store, tmp_path):
+    fill(store, range(35))
+
+    assert len(list((tmp_path / "store").glob("segment_*.bin"))) == 3
+    assert store.time_range() == (10., 34.)
+    assert len(store) == 25
+    assert [record[0] for record in store.latest(3)] == [32., 33., 34.]
+
+
+def test_reopening_drops_an_incomplete_record(store, tmp_path, logger):
+    fill(store, range(5))
+    store.flush()
+    store.fp.write(b"\x00" * 3)
+    store.fp.flush()
+
+    reopened = SegmentStore(tmp_path / "store", "<dff", logger, records_per_segment=10, max_segments=3)
+    reopened.append((3.5, 7., 1.))
+    reopened.append((5., 10., 1.))
+
+    assert [record[0] for record in reopened.query(-math.inf)] == [0., 1., 2., 3., 4., 5.]
+
+
+def make_tier(tmp_path, logger, resolution: int = 10) -> RollupTier:
+    return RollupTier(tmp_path, resolution, METERS, logger, retention_days=1)
+
+
+def test_rollup_writes_min_mean_max_once_the_next_bucket_starts(tmp_path, logger):
+    tier = make_tier(tmp_path, logger)
+    for timestamp, house in ((100., 1.), (104., 5.), (109., 3.)):
+        tier.add(timestamp, (house, 0.))
+    assert tier.query(-math.inf) == []
+
+    tier.add(110., (7., 0.))
+
+    [entry] = tier.query(-math.inf)
+    assert entry["timestamp"] == 100.
+    assert entry["house"] == pytest.approx(3.)
+    assert entry["min"]["house"] == 1.
+    assert entry["max"]["house"] == 5.
+    assert tier.flushed_until == 100.
+
+
+def test_rollup_ignores_samples_of_written_buckets(tmp_path, logger):
+    tier = make_tier(tmp_path, logger)
+    for timestamp in (100., 110., 120.):
+        tier.add(timestamp, (1., 1.))
+    tier.store.flush()
+
+    restarted = make_tier(tmp_path, logger)
+    assert restarted.flushed_until == 110.
+    for timestamp in (105., 115., 120., 125., 130.):
+        restarted.add(timestamp, (2., 2.))
+
+    assert [(entry["timestamp"], entry["house"]) for entry in restarted.query(-math.inf)] == \
+        [(100., 1.), (110., 1.), (120., 2.)]
+
+
+def test_restore_replays_every_tier_from_its_own_buckets(cache_dir, logger):
+    history = MeterHistory(logger)
+    start = 1_700_000_000.
+    for idx in range(2 * 3600):
+        history.add_entry({meter: float(idx) for meter in history.meters}, start + idx)
+    expected = {tier.resolution: tier.query(-math.inf) for tier in history.tiers}
+    history.flush()
+
+    # a newly added tier has no buckets and is filled from the raw samples
+    for path in (cache_dir / "meter_history" / "rollup_60").iterdir():
+        path.unlink()
+    restored = MeterHistory(logger)
+
+    for tier in restored.tiers:
+        assert tier.query(-math.inf) == expected[tier.resolution]
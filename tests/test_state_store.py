@@ -0,0 +1,94 @@
+import json
+import time
+
+import pytest
+
+from flow.utils import state_store
+from flow.utils.state_store import StateStore
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "manager_state.json"
+
+
+def count_writes(store: StateStore, monkeypatch) -> list:
+    documents = []
+    write = store.write
+
+    def counting_write(document: str):
+        documents.append(document)
+        write(document)
+
+    monkeypatch.setattr(store, "write", counting_write)
+    return documents
+
+
+def test_values_survive_a_restart(path, logger):
+    store = StateStore(path, logger, flush_delay=60.)
+    store.put("session_info", {"rfid": "0400069ad8648500", "soc": [50, 80]})
+    assert store.flush()
+
+    restored = StateStore(path, logger)
+    assert restored.get("session_info") == {"rfid": "0400069ad8648500", "soc": [50, 80]}
+    assert restored.get("automatic_mode", True) is True
+
+
+def test_changes_are_coalesced_and_unchanged_values_not_written(path, logger, monkeypatch):
+    store = StateStore(path, logger, flush_delay=60.)
+    documents = count_writes(store, monkeypatch)
+    for limit in (1000, 2000, 3000):
+        store.put("manual_power_limit", limit)
+    store.flush()
+    store.put("manual_power_limit", 3000)
+    store.flush()
+
+    assert documents == ['{"manual_power_limit":3000}']
+    assert store.timer is None
+
+
+def test_pending_changes_are_written_after_the_flush_delay(path, logger):
+    store = StateStore(path, logger, flush_delay=0.05)
+    store.put("automatic_mode", False)
+
+    deadline = time.time() + 5.
+    while not path.exists() and time.time() < deadline:
+        time.sleep(0.01)
+    assert json.loads(path.read_text()) == {"automatic_mode": False}
+
+
+def test_failed_write_keeps_the_previous_document(path, logger, monkeypatch):
+    store = StateStore(path, logger)
+    store.put("automatic_mode", True)
+    store.flush()
+
+    def fail(src, dst):
+        raise OSError("read-only file system")
+
+    monkeypatch.setattr(state_store.os, "replace", fail)
+    store.put("automatic_mode", False)
+    assert not store.flush()
+    assert json.loads(path.read_text()) == {"automatic_mode": True}
+
+    # the change stays pending and is written by the next flush
+    monkeypatch.undo()
+    assert store.flush()
+    assert json.loads(path.read_text()) == {"automatic_mode": False}
+    assert not path.with_name(path.name + ".tmp").exists()
+
+
+def test_damaged_document_starts_without_state(path, logger):
+    path.write_text('{"automatic_mode": tr')
+
+    assert StateStore(path, logger).get("automatic_mode") is None
+
+
+def test_stored_values_are_copies(path, logger):
+    store = StateStore(path, logger, flush_delay=60.)
+    session = {"soc": [50]}
+    store.put("session_info", session)
+    session["soc"].append(60)
+    store.get("session_info")["soc"].append(70)
+
+    assert store.get("session_info") == {"soc": [50]}
+    store.flush()
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import pathlib
+import threading
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+import flask
+
+from .metrics import CACHE_REQUESTS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "image/x-icon",
+                      "image/vnd.microsoft.icon")
+IMMUTABLE_MAX_AGE = 365 * 86400  # seconds
+
+
+class Asset(NamedTuple):
+    digest: str
+    mimetype: str
+    encodings: Dict[str, bytes]  # content encoding -> body, "identity" is always present
+
+
+def make_asset(data: bytes, mimetype: str, brotli_quality: int = 9) -> Asset:
+    """
+    hash the data and compress it with gzip and brotli if that makes it smaller.
+    """
+    encodings = {"identity": data}
+    if mimetype.startswith(COMPRESSIBLE_TYPES) and len(data) > 256:
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data):
+            encodings["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=brotli_quality)
+            if len(compressed) < len(data):
+                encodings["br"] = compressed
+    return Asset(hashlib.sha256(data).hexdigest()[:16], mimetype, encodings)
+
+
+class AssetCache:
+    """
+    Serves static files, rendered pages and images from memory. Every asset carries an ETag derived from its content,
+    so repeated requests are answered with 304 Not Modified, and is kept precompressed with gzip and, if the brotli
+    package is installed, brotli. URLs built by url() carry the content hash and are cached by clients for a year,
+    all other responses have to be revalidated.
+    """
+    def __init__(self, logger: logging.Logger = None):
+        self.logger = logger or logging.getLogger("flow.assets")
+        self.lock = threading.Lock()
+        self.static: Dict[str, Asset] = {}  # path relative to the static folder -> asset
+        self.pages: Dict[str, Asset] = {}
+        self.files: Dict[str, Tuple[float, Asset]] = {}  # absolute path -> modification time and asset
+
+    def load_directory(self, directory: pathlib.Path, brotli_quality: int = 9):
+        """
+        load and precompress all files of the static folder.
+        """
+        static = {}
+        for path in directory.rglob("*"):
+            if path.is_file():
+                mimetype = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+                static[path.relative_to(directory).as_posix()] = make_asset(path.read_bytes(), mimetype,
+                                                                            brotli_quality)
+        with self.lock:
+            self.static = static
+        size = sum(len(asset.encodings["identity"]) for asset in static.values())
+        self.logger.info(f"Loaded {len(static)} static assets with {size / 1e6:.1f} MB, "
+                         f"brotli {'enabled' if brotli is not None else 'not installed'}")
+
+    def url(self, path: str) -> str:
+        """
+        the fingerprinted url of a static file, for use in templates.
+        """
+        asset = self.static.get(path)
+        return path if asset is None else f"{path}?v={asset.digest}"
+
+    def send_static(self, path: str) -> Optional[flask.Response]:
+        """
+        :return: the response for the static file or None if the file was not loaded at startup
+        """
+        asset = self.static.get(path)
+        if asset is None:
+            CACHE_REQUESTS.inc(cache="assets", result="miss")
+            return None
+        immutable = flask.request.args.get("v") == asset.digest
+        return self.respond(asset, IMMUTABLE_MAX_AGE if immutable else None, immutable)
+
+    def send_page(self, name: str, render: Callable[[], str]) -> flask.Response:
+        """
+        send a page which is rendered on its first request only. Use this for pages whose inputs do not change while
+        the server is running.
+        """
+        asset = self.pages.get(name)
+        if asset is None:
+            asset = make_asset(render().encode("utf-8"), "text/html; charset=utf-8")
+            with self.lock:
+                self.pages[name] = asset
+        return self.respond(asset)
+
+    def send_file(self, path: pathlib.Path, mimetype: str, max_age: int = None) -> flask.Response:
+        """
+        send a file from disk which is reloaded when its modification time changes, e.g. a downloaded image.
+        """
+        key = str(pathlib.Path(path).resolve())
+        mtime = os.stat(key).st_mtime
+        entry = self.files.get(key)
+        if entry is None or entry[0] != mtime:
+            with open(key, "rb") as fp:
+                entry = (mtime, make_asset(fp.read(), mimetype))
+            with self.lock:
+                self.files[key] = entry
+        return self.respond(entry[1], max_age)
+
+    def respond(self, asset: Asset, max_age: int = None, immutable: bool = False) -> flask.Response:
+        """
+        answer the current request with the asset, or with 304 if the client already has it.
+        :param max_age: the seconds the client may use the asset without revalidating it, None to always revalidate
+        :param immutable: whether the content behind the url never changes
+        """
+        encoding = "identity"
+        accepted = flask.request.accept_encodings
+        for candidate in ("br", "gzip"):
+            if candidate in asset.encodings and accepted[candidate]:
+                encoding = candidate
+                break
+        etag = asset.digest if encoding == "identity" else f"{asset.digest}-{encoding}"
+
+        if flask.request.if_none_match.contains(etag):
+            CACHE_REQUESTS.inc(cache="assets", result="not_modified")
+            response = flask.Response(status=304)
+        else:
+            CACHE_REQUESTS.inc(cache="assets", result="hit")
+            response = flask.Response(asset.encodings[encoding], mimetype=asset.mimetype)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        if max_age is None:
+            response.headers["Cache-Control"] = "no-cache"
+        else:
+            response.headers["Cache-Control"] = f"public, max-age={max_age}" + (", immutable" if immutable else "")
+        return response
+
+
+ASSETS = AssetCache()
@@ -0,0 +1,144 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from .metrics import METRICS
+
+DROPPED_RECORDS = METRICS.counter("flow_log_records_dropped_total", "Log records which were not written",
+                                  ("logger", "reason"))
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A RotatingFileHandler which leaves flushing to the log writer, so a batch of records costs one write to disk.
+    """
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+    def close(self):
+        self.flush_batch()
+        super().close()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most burst records of every call site through within burst / rate seconds and drops the rest. The next
+    record which passes reports how many were dropped. Warnings and errors are never dropped.
+    """
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate: float = rate  # records per second
+        self.burst: int = burst
+        self.lock = threading.Lock()
+        # call site -> tokens, last update and number of suppressed records
+        self.buckets: Dict[Tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [float(self.burst), now, 0]
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.:
+                bucket[2] += 1
+                DROPPED_RECORDS.inc(logger=record.name, reason="rate_limit")
+                return False
+            bucket[0] -= 1.
+            suppressed, bucket[2] = bucket[2], 0
+
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+            record.args = None
+        return True
+
+
+class TargetedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records of one logger on the queue of the log writer together with the handler that writes them.
+    The caller never blocks: if the queue is full the record is dropped.
+    """
+    def __init__(self, writer: "LogWriter", target: logging.Handler):
+        super().__init__(writer.queue)
+        self.writer: "LogWriter" = writer
+        self.target: logging.Handler = target
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait((self.target, record))
+        except queue.Full:
+            DROPPED_RECORDS.inc(logger=record.name, reason="queue_full")
+
+
+class LogWriter:
+    """
+    Writes the records of all loggers on one thread. The writer collects records until it has batch_size of them or
+    flush_interval seconds passed since the first one, hands the records to their file handlers and to the handlers of
+    the root logger and flushes every file once per batch.
+    """
+    def __init__(self, batch_size: int = 512, flush_interval: float = 1., max_queued: int = 10000):
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval  # seconds
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def attach(self, target: logging.Handler) -> TargetedQueueHandler:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="log_writer", daemon=True)
+                self.thread.start()
+                METRICS.watch_thread(self.thread)
+                atexit.register(self.stop)
+        return TargetedQueueHandler(self, target)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # a full batch is written right away, only a short batch waits up to flush_interval for more records
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0., deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            self.write([item for item in batch if item is not None])
+            if stop:
+                return
+
+    def write(self, batch):
+        targets: Set[logging.Handler] = set()
+        root_handlers = logging.getLogger().handlers
+        for target, record in batch:
+            try:
+                target.handle(record)
+                targets.add(target)
+                for handler in root_handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            except Exception:
+                target.handleError(record)
+        for target in targets:
+            getattr(target, "flush_batch", target.flush)()
+
+    def stop(self):
+        """
+        write all queued records and stop the writer thread.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5.)
@@ -0,0 +1,229 @@
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+import flask
+
+# latency buckets in seconds, from a cached report to a slow cloud API
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name: str = name
+        self.description: str = description
+        self.labels: Tuple[str, ...] = tuple(labels)
+        self.lock = threading.Lock()
+
+    def key(self, labels: dict) -> Tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1., **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Gauge(Metric):
+    """
+    A value which is either set by the owner or computed by a callback when the metrics are scraped. The callback
+    returns the value of every label combination.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 callback: Callable[[], Dict[Tuple, float]] = None):
+        super().__init__(name, description, labels)
+        self.values: Dict[Tuple, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = dict(self.values)
+        if self.callback is not None:
+            values.update(self.callback())
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # per label combination the count of every bucket (the last one is +Inf), the sum and the count
+        self.values: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0., 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        observe the duration of the with block in seconds, also if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()]
+
+        lines = []
+        names = self.labels + ("le",)
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(names, key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds all metrics of the flow server and renders them in the Prometheus text exposition format. Recording a
+    value only updates a dict under an uncontended lock, the text is built when /metrics is scraped.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: Dict[str, Metric] = {}
+        self.threads: Dict[str, threading.Thread] = {}
+        self.gauge("flow_thread_alive", "1 if the background thread is running", ("thread",),
+                   callback=self.thread_liveness)
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"Metric {metric.name} is already registered with a different type or labels")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, description: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: Sequence[str] = (),
+              callback: Callable[[], Dict[Tuple, float]] = None) -> Gauge:
+        return self.register(Gauge(name, description, labels, callback))
+
+    def histogram(self, name: str, description: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def watch_thread(self, thread: threading.Thread):
+        """
+        report the liveness of a background thread in flow_thread_alive.
+        """
+        self.threads[thread.name] = thread
+
+    def thread_liveness(self) -> Dict[Tuple, float]:
+        return {(name,): float(thread.is_alive()) for name, thread in list(self.threads.items())}
+
+    def expose(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+# the metrics shared by several modules
+OUTBOUND_LATENCY = METRICS.histogram("flow_outbound_request_seconds", "Latency of calls to devices and cloud APIs",
+                                     ("target", "operation"))
+OUTBOUND_ERRORS = METRICS.counter("flow_outbound_request_errors_total", "Failed calls to devices and cloud APIs",
+                                  ("target", "operation"))
+CACHE_REQUESTS = METRICS.counter("flow_cache_requests_total", "Cache lookups by result", ("cache", "result"))
+TICK_DURATION = METRICS.histogram("flow_control_loop_tick_seconds", "Duration of a control loop tick", ("loop",))
+TICK_JITTER = METRICS.histogram("flow_control_loop_jitter_seconds",
+                                "Delay of a control loop tick behind its schedule", ("loop",))
+HTTP_LATENCY = METRICS.histogram("flow_http_request_seconds", "Latency of the HTTP endpoints",
+                                 ("endpoint", "method", "status"))
+
+
+@contextlib.contextmanager
+def track_call(target: str, operation: str):
+    """
+    observe the latency of an outbound call and count it as failed if it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        OUTBOUND_ERRORS.inc(target=target, operation=operation)
+        raise
+    finally:
+        OUTBOUND_LATENCY.observe(time.perf_counter() - start, target=target, operation=operation)
+
+
+def instrument_app(app: flask.Flask):
+    """
+    observe the latency of every request of a flask app per endpoint, method and status code.
+    """
+    @app.before_request
+    def start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_latency(response):
+        start = getattr(flask.g, "metrics_start", None)
+        if start is not None:
+            HTTP_LATENCY.observe(time.perf_counter() - start, endpoint=flask.request.endpoint or "unknown",
+                                 method=flask.request.method, status=response.status_code)
+        return response
@@ -0,0 +1,109 @@
+import copy
+import json
+import logging
+import os
+import pathlib
+import threading
+from typing import Any, Dict, Optional
+
+from .metrics import METRICS
+
+STATE_WRITES = METRICS.counter("flow_state_writes_total", "Writes of persisted module state", ("store",))
+STATE_UPDATES = METRICS.counter("flow_state_updates_total", "Updates of persisted module state by whether they "
+                                                            "changed the state", ("store", "changed"))
+
+
+class StateStore:
+    """
+    Persists a small json document of named values. Only values which changed are written, and all changes within
+    flush_delay seconds are coalesced into one write, so a state that is updated every few seconds but rarely changes
+    costs almost no writes to the flash storage.
+    The document is written to a temporary file, synced and renamed over the previous one, so a crash leaves either
+    the old or the new document behind and never a partially written one.
+    """
+    def __init__(self, path: pathlib.Path, logger: logging.Logger, flush_delay: float = 2.):
+        self.path: pathlib.Path = pathlib.Path(path)
+        self.logger: logging.Logger = logger
+        self.flush_delay: float = flush_delay  # seconds
+
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # keeps concurrent flushes in order
+        self.values: Dict[str, Any] = self.load()
+        self.dirty: bool = False
+        self.timer: Optional[threading.Timer] = None
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "r") as fp:
+                values = json.load(fp)
+            self.logger.info(f"Restored {list(values.keys())} from {self.path.name}")
+            return values
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            # only possible if the storage itself is damaged, the rename never exposes a partial document
+            self.logger.exception(f"Could not restore {self.path.name}, starting without state")
+            return {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self.lock:
+            return copy.deepcopy(self.values.get(key, default))
+
+    def put(self, key: str, value: Any):
+        """
+        store a json serializable value and schedule a write if it differs from the stored one.
+        """
+        with self.lock:
+            if key in self.values and self.values[key] == value:
+                STATE_UPDATES.inc(store=self.path.stem, changed="false")
+                return
+            STATE_UPDATES.inc(store=self.path.stem, changed="true")
+            self.values[key] = copy.deepcopy(value)
+            self.dirty = True
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.name = f"{self.path.stem}_flush"
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> bool:
+        """
+        write the pending changes right away.
+        :return: whether all changes are written, a failed write is retried by the next flush
+        """
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return True
+                document = json.dumps(self.values, separators=(",", ":"))
+                self.dirty = False
+
+            try:
+                self.write(document)
+            except OSError:
+                self.logger.exception(f"Could not write {self.path.name}")
+                with self.lock:
+                    self.dirty = True
+                return False
+            return True
+
+    def write(self, document: str):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as fp:
+            fp.write(document)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        try:
+            # persist the rename itself
+            directory = os.open(self.path.parent, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        except OSError:
+            pass
+        STATE_WRITES.inc(store=self.path.stem)
@@ -1,8 +1,31 @@
+import datetime
 import json
 import logging
 import logging.handlers
 import pathlib
 import os
+import time
+from typing import Optional
+
+from .log_queue import BufferedRotatingFileHandler, LogWriter, RateLimitFilter
+
+
+LOGGING = {"mode": "sync"}
+LOG_WRITER: Optional[LogWriter] = None
+
+
+def configure_logging(config: dict):
+    """
+    choose how the loggers created by init_logging afterwards write their records.
+    :param config: the logging section of the config. The mode "sync" writes on the calling thread, "queue" hands
+    the records to a writer thread which writes them in batches of up to batch_size records, at the latest
+    flush_interval seconds after the first record of a batch. rate and burst limit the info and debug records per call site
+    """
+    global LOG_WRITER
+    LOGGING.clear()
+    LOGGING.update(config)
+    if LOGGING.get("mode", "sync") == "queue" and LOG_WRITER is None:
+        LOG_WRITER = LogWriter(LOGGING.get("batch_size", 512), LOGGING.get("flush_interval", 1.))
 
 
 def init_logging(name, level=logging.INFO) -> logging.Logger:
@@ -14,9 +37,18 @@ def init_logging(name, level=logging.INFO) -> logging.Logger:
 
     logger = logging.getLogger("flow." + name)
     logger.setLevel(level)
-    fh = logging.handlers.RotatingFileHandler(str(logdir / f"{name}.log"), maxBytes=1000000, backupCount=5)
+    queued = LOGGING.get("mode", "sync") == "queue"
+    handler_class = BufferedRotatingFileHandler if queued else logging.handlers.RotatingFileHandler
+    fh = handler_class(str(logdir / f"{name}.log"), maxBytes=1000000, backupCount=5)
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    handler = fh
+    if queued:
+        # the writer thread also passes the records on to the console handler of the root logger
+        handler = LOG_WRITER.attach(fh)
+        logger.propagate = False
+    if "rate" in LOGGING:
+        handler.addFilter(RateLimitFilter(LOGGING["rate"], LOGGING.get("burst", 10)))
+    logger.addHandler(handler)
     return logger
 
 
@@ -25,11 +57,26 @@ def get_root_dir() -> pathlib.Path:
 
 
 def get_cache_dir() -> pathlib.Path:
-    cache = get_root_dir() / "cache"
+    # FLOW_CACHE_DIR redirects the persisted state, e.g. to keep a simulation run away from the live cache
+    cache = pathlib.Path(os.environ.get("FLOW_CACHE_DIR", get_root_dir() / "cache"))
     cache.mkdir(exist_ok=True, parents=False)
     return cache
 
 
+class Clock:
+    """
+    The wall clock. Control loops read the time from a clock object so the simulation can run them on virtual time.
+    """
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.time())
+
+
 def get_site_map(app):
     overview = "<h1>Flow API overview</h1>"
     overview += "<table><tr><th>url</th><th>methods</th><th>description</th></tr>"
@@ -47,6 +94,7 @@ def reboot_server():
 
 
 def get_config():
-    with open(str(get_root_dir() / "config.json"), "r") as fp:
+    # FLOW_CONFIG selects another config file, e.g. one pointing to the stand-in devices of a benchmark
+    with open(os.environ.get("FLOW_CONFIG", str(get_root_dir() / "config.json")), "r") as fp:
         config = json.load(fp)
     return config
@@ -0,0 +1,24 @@
+from flask import Flask
+
+from .api.control_plane import ControlPlaneClient
+from .pages import attach_pages, is_page
+from .utils import configure_logging, init_logging, get_config
+
+config = get_config()
+configure_logging(config.get("logging", {}))
+
+LOGGER = init_logging("flow_worker")
+
+# the worker only serves the dashboard and the static files itself, it holds no module state and starts no threads
+pages = Flask(__name__)
+attach_pages(pages, config["vehicles"], LOGGER)
+control_plane = ControlPlaneClient(config.get("serving", {}), LOGGER.getChild("control_plane"))
+
+
+def app(environ, start_response):
+    """
+    the wsgi app of an HTTP worker. Every request that needs a module is forwarded to the control plane.
+    """
+    if environ["REQUEST_METHOD"] in ("GET", "HEAD") and is_page(environ.get("PATH_INFO", "/")):
+        return pages(environ, start_response)
+    return control_plane.forward(environ, start_response)